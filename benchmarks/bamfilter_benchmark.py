@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+'''Compares run time of BamFilter.run using one fetch per contig region,
+   reading the BAM file in a single pass, letting BamFilter choose between
+   those two, and using more than one process. By default, runs on a BAM with
+   many short contigs and on a BAM with a few long contigs'''
+import argparse
+import filecmp
+import os
+import tempfile
+import time
+from circlator import bamfilter
+import synthetic
+
+
+methods = [
+    ('fetch per region', {'single_pass': False}),
+    ('single pass', {'single_pass': True}),
+    ('chosen by BamFilter', {}),
+    ('parallel', {'single_pass': False}),
+]
+
+
+# (name, number of contigs, contig length) of the BAM files made when
+# --contigs and --contig_length are not used
+cases = [
+    ('many short contigs', 500, 20000),
+    ('few long contigs', 10, 500000),
+]
+
+
+def time_bamfilter(bam, outprefix, options, **kwargs):
+    b = bamfilter.BamFilter(
+        bam,
+        outprefix,
+        fastq_out=options.fastq,
+        length_cutoff=options.length_cutoff,
+        **kwargs
+    )
+    start = time.perf_counter()
+    b.run()
+    return time.perf_counter() - start, b.reads_outfile
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--contigs', type=int, help='Number of contigs. If used with --contig_length, only this case is run, instead of the cases: ' + '; '.join(x[0] + ' ' + str(x[1]) + 'x' + str(x[2]) + 'bp' for x in cases), metavar='INT')
+    parser.add_argument('--contig_length', type=int, help='Length of each contig', metavar='INT')
+    parser.add_argument('--length_cutoff', type=int, help='bam2reads length cutoff [%(default)s]', default=10000, metavar='INT')
+    parser.add_argument('--depth', type=int, help='Read depth [%(default)s]', default=20, metavar='INT')
+    parser.add_argument('--fastq', action='store_true', help='Write FASTQ instead of FASTA')
+    parser.add_argument('--threads', type=int, help='Number of processes to use for the parallel method [%(default)s]', default=4, metavar='INT')
+    parser.add_argument('--repeats', type=int, help='Number of times to run each method [%(default)s]', default=3, metavar='INT')
+    options = parser.parse_args()
+
+    if options.contigs is None and options.contig_length is None:
+        to_run = cases
+    elif options.contigs is None or options.contig_length is None:
+        parser.error('Must use both or neither of --contigs and --contig_length')
+    else:
+        to_run = [('custom', options.contigs, options.contig_length)]
+
+    for case_name, contig_number, contig_length in to_run:
+        run_case(case_name, contig_number, contig_length, options)
+        print()
+
+
+def run_case(case_name, contig_number, contig_length, options):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        bam = os.path.join(tmpdir, 'reads.bam')
+        contigs = synthetic.random_contigs(contig_number, contig_length)
+        reads = synthetic.write_bam(contigs, bam, read_length=2000, depth=options.depth)
+        print(case_name + ': made BAM with', contig_number, 'contigs of length', contig_length, 'and', reads, 'reads')
+        results = []
+
+        for i, (name, kwargs) in enumerate(methods):
+            if name == 'parallel':
+                kwargs = dict(kwargs, threads=options.threads)
+            times = []
+            for j in range(options.repeats):
+                t, outfile = time_bamfilter(bam, os.path.join(tmpdir, 'out.' + str(i)), options, **kwargs)
+                times.append(t)
+            results.append((name, min(times), outfile))
+
+        print('method', 'time (s)', 'speedup', sep='\t')
+        for name, t, outfile in results:
+            assert filecmp.cmp(results[0][2], outfile, shallow=False)
+            print(name, round(t, 3), round(results[0][1] / t, 2), sep='\t')
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+'''Measures how long it takes to import each circlator task, using
+   python -X importtime, and how long the circlator script takes to run
+   the lightweight tasks. Exits with an error if a lightweight task takes
+   longer than --max_ms to import, or imports any of the slow modules that
+   are only needed by the real work (pysam, pymummer etc)'''
+import argparse
+import os
+import re
+import subprocess
+import sys
+import time
+
+# tasks that should start quickly, because they do not do any real work
+lightweight_tasks = ['version', 'progcheck']
+all_tasks = ['all', 'assemble', 'bam2reads', 'batch', 'clean', 'fixstart', 'get_dnaa', 'mapreads', 'merge', 'minimus2', 'progcheck', 'version']
+
+# modules that lightweight tasks should not import
+slow_modules = ['distutils', 'openpyxl', 'pkg_resources', 'pymummer', 'pysam', 'setuptools']
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+script = os.path.join(repo_dir, 'scripts', 'circlator')
+
+
+def import_time(module):
+    '''Returns (total import time in ms, set of modules imported) of importing module in a new python'''
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([repo_dir, os.environ.get('PYTHONPATH', '')]))
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module], env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    imported = set()
+    total_us = None
+    for line in completed.stderr.split('\n'):
+        # lines look like: "import time:       266 |      83593 |   circlator.tasks"
+        match = re.match(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$', line)
+        if match is None:
+            continue
+        imported.add(match.group(4))
+        if match.group(4) == module:
+            total_us = int(match.group(2))
+    return total_us / 1000, imported
+
+
+def run_time(task, repeats):
+    '''Returns min wall clock time in ms of running the circlator script with task'''
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([repo_dir, os.environ.get('PYTHONPATH', '')]))
+    times = []
+    for i in range(repeats):
+        start_time = time.perf_counter()
+        subprocess.run([sys.executable, script, task], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start_time)
+    return 1000 * min(times)
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeats', type=int, help='Number of times to import/run each task. The fastest time is reported [%(default)s]', default=5, metavar='INT')
+    parser.add_argument('--max_ms', type=float, help='Max import time in ms of lightweight tasks [%(default)s]', default=100, metavar='FLOAT')
+    options = parser.parse_args()
+
+    baseline = min(import_time('argparse')[0] for i in range(options.repeats))
+    print('Import time of argparse, for comparison (ms):', round(baseline, 1))
+    print('task', 'import (ms)', 'run (ms)', 'slow modules imported', sep='\t')
+    failed = []
+
+    for task in all_tasks:
+        results = [import_time('circlator.tasks.' + task) for i in range(options.repeats)]
+        ms = min(x[0] for x in results)
+        slow_imported = sorted(x for x in slow_modules if x in results[0][1])
+        run_ms = round(run_time(task, options.repeats), 1) if task in lightweight_tasks else '.'
+        print(task, round(ms, 1), run_ms, ','.join(slow_imported) if len(slow_imported) else '.', sep='\t')
+
+        if task in lightweight_tasks:
+            if ms > options.max_ms:
+                failed.append(task + ' took ' + str(round(ms, 1)) + 'ms to import')
+            if len(slow_imported):
+                failed.append(task + ' imported ' + ', '.join(slow_imported))
+
+    if len(failed):
+        print('\nFAILED:', *failed, sep='\n', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    run()
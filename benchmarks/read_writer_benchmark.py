@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+'''Microbenchmark of BamFilter._get_region, comparing writing reads using
+   mapping.aligned_read_to_record with the old way of making a pyfastaq
+   object for each read using mapping.aligned_read_to_read'''
+import argparse
+import io
+import os
+import tempfile
+import timeit
+import pysam
+from circlator import bamfilter, mapping
+import synthetic
+
+
+def old_get_region(bam_filter, contig, start, end, fout, min_length=250):
+    '''This is how BamFilter._get_region used to work'''
+    sam_reader = pysam.Samfile(bam_filter.bam, "rb")
+    trimming_end = (start == 0)
+    for read in sam_reader.fetch(contig, start, end):
+        seq = mapping.aligned_read_to_read(read, ignore_quality=not bam_filter.fastq_out, revcomp=False)
+
+        if trimming_end:
+            bases_off_end = max(0, read.reference_end - 1 - end)
+            seq = seq.subseq(0, read.query_alignment_end - bases_off_end)
+        else:
+            bases_off_start = max(0, start - read.pos + 1)
+            seq = seq.subseq(bases_off_start  + read.query_alignment_start, len(seq))
+
+        if read.is_reverse:
+            seq.revcomp()
+
+        if len(seq) >= min_length:
+            print(seq, file=fout)
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--contig_length', type=int, help='Length of contig [%(default)s]', default=500000, metavar='INT')
+    parser.add_argument('--read_length', type=int, help='Length of reads [%(default)s]', default=10000, metavar='INT')
+    parser.add_argument('--depth', type=int, help='Read depth [%(default)s]', default=50, metavar='INT')
+    parser.add_argument('--repeats', type=int, help='Number of times to run each method [%(default)s]', default=5, metavar='INT')
+    options = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        bam = os.path.join(tmpdir, 'reads.bam')
+        contigs = synthetic.random_contigs(1, options.contig_length)
+        reads = synthetic.write_bam(contigs, bam, read_length=options.read_length, depth=options.depth, unmapped_reads=0)
+        contig = list(contigs.keys())[0]
+        print('Made BAM with', reads, 'reads')
+        print('output', 'old (s)', 'new (s)', 'speedup', sep='\t')
+
+        for fastq_out in False, True:
+            b = bamfilter.BamFilter(bam, os.path.join(tmpdir, 'out'), fastq_out=fastq_out)
+            results = {}
+            for name, function in ('old', old_get_region), ('new', bamfilter.BamFilter._get_region):
+                for region in (0, options.contig_length - 1), (1, options.contig_length):
+                    f = io.StringIO()
+                    function(b, contig, *region, f)
+                    results[name, region] = f.getvalue()
+
+                results[name] = min(timeit.repeat(
+                    lambda: [function(b, contig, *region, io.StringIO()) for region in [(0, options.contig_length - 1), (1, options.contig_length)]],
+                    number=1, repeat=options.repeats
+                ))
+
+            for region in (0, options.contig_length - 1), (1, options.contig_length):
+                assert results['old', region] == results['new', region]
+            print('FASTQ' if fastq_out else 'FASTA', round(results['old'], 3), round(results['new'], 3), round(results['old'] / results['new'], 2), sep='\t')
+
+
+if __name__ == '__main__':
+    run()
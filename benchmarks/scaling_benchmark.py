@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+'''Measures how the pure python parts of bamfilter, merge, clean and fixstart
+   scale with the number of contigs, genome size and read depth, using synthetic
+   data. The external tools are not run: their output is made by synthetic.py.
+   The benchmarks are classes in the style of asv (airspeed velocity): each one
+   has params, setup() and time_* methods, and maybe track_* methods that return
+   a value (eg memory) in the class's unit. This script runs them and prints a
+   table of the results, and optionally writes them to a JSON file'''
+import argparse
+import io
+import itertools
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import pymummer
+import pyfastaq
+from circlator import bamfilter, clean, contig_store, hits, merge, start_fixer
+import synthetic
+
+
+class BamFilterGetRegion:
+    '''BamFilter._get_region on both ends of every contig, like BamFilter.run does for long contigs'''
+    params = ([10, 100, 500], [10, 40])
+    param_names = ['contigs', 'depth']
+    number = 1
+    contig_length = 20000
+    read_length = 2000
+
+    def setup(self, contigs, depth):
+        self.tmpdir = tempfile.mkdtemp(prefix='circlator.benchmark.')
+        bam = synthetic.cached_bam(contigs, self.contig_length, self.read_length, depth)
+        self.bam_filter = bamfilter.BamFilter(bam, os.path.join(self.tmpdir, 'out'), fastq_out=True, length_cutoff=10000)
+        self.sam_reader = bamfilter.pysam.AlignmentFile(bam, 'rb')
+
+    def teardown(self, contigs, depth):
+        self.sam_reader.close()
+        shutil.rmtree(self.tmpdir)
+
+    def time_get_region(self, contigs, depth):
+        fout = io.StringIO()
+        end_bases = self.bam_filter.length_cutoff // 2
+        for contig, length in zip(self.sam_reader.references, self.sam_reader.lengths):
+            self.bam_filter._get_region(contig, 0, end_bases - 1, fout, sam_reader=self.sam_reader)
+            self.bam_filter._get_region(contig, length - end_bases, length, fout, sam_reader=self.sam_reader)
+
+
+class MergeCirculariseContigs:
+    '''Merger._circularise_contigs on an assembly where every contig is circular
+       but has overlapping ends, and a reassembly that has each replicon in one
+       contig, half of which are called circular by the assembler. Contigs
+       are done in a pool of processes when threads > 1'''
+    params = ([10, 100, 1000], [5000, 50000], [1, 4])
+    param_names = ['contigs', 'contig_length', 'threads']
+    number = 1
+    overlap = 1000
+
+    def setup(self, contigs, contig_length, threads):
+        self.tmpdir = tempfile.mkdtemp(prefix='circlator.benchmark.')
+        genome = synthetic.circular_genome(contigs, contig_length)
+        original = synthetic.fragmented_assembly(genome, 1, overlap=self.overlap)
+        reassembly = synthetic.fragmented_assembly(genome, 1, reverse_percent=50, seed=1)
+        original_fasta = os.path.join(self.tmpdir, 'original.fa')
+        reassembly_dir = os.path.join(self.tmpdir, 'reassembly')
+        synthetic.write_layout(genome, original, original_fasta)
+        synthetic.write_canu_assembly(genome, reassembly, reassembly_dir, circular=sorted(reassembly)[::2])
+        self.merger = merge.Merger(original_fasta, reassembly_dir, os.path.join(self.tmpdir, 'merge'), assembler='canu', nucmer_min_length_for_merges=500, threads=threads)
+        self.nucmer_hits = {}
+        for line in synthetic.exact_hits(genome, original, reassembly, min_length=self.merger.nucmer_min_length):
+            hit = pymummer.alignment.Alignment(line)
+            self.nucmer_hits.setdefault(hit.ref_name, []).append(hit)
+
+    def teardown(self, contigs, contig_length, threads):
+        shutil.rmtree(self.tmpdir)
+
+    def time_circularise_contigs(self, contigs, contig_length, threads):
+        self.merger._circularise_contigs(self.nucmer_hits)
+
+
+class MergeHitClassification:
+    '''Merger._get_possible_circular_ref_contigs and Merger._get_possible_query_bridging_contigs
+       on random nucmer hits, where the hits are to only a few query contigs
+       (like a reassembly with a few long contigs) or to many of them'''
+    params = ([1000, 10000, 100000], [2, 100])
+    param_names = ['hits', 'qry_contigs']
+    number = 1
+
+    def setup(self, number_of_hits, qry_contigs):
+        coords_file = synthetic.cached_coords_file(number_of_hits, max(10, number_of_hits // 50), qry_contigs=qry_contigs)
+        self.merger = merge.Merger(os.devnull, os.devnull, 'out', ref_end_tolerance=2000, qry_end_tolerance=1000)
+        self.nucmer_hits = self.merger._load_nucmer_hits(coords_file)
+        self.nucmer_hits_by_qry = self.merger._hits_hashed_by_query([x for y in self.nucmer_hits.values() for x in y])
+
+    def time_get_possible_circular_ref_contigs(self, number_of_hits, qry_contigs):
+        self.merger._get_possible_circular_ref_contigs(self.nucmer_hits)
+
+    def time_get_possible_query_bridging_contigs(self, number_of_hits, qry_contigs):
+        self.merger._get_possible_query_bridging_contigs(self.nucmer_hits_by_qry)
+
+
+class CleanIdenticalContigs:
+    '''Cleaner._collapse_list_of_sets on the pairs of identical contigs in an
+       assembly that has copies of every contig, and Cleaner._get_identical_contigs,
+       which finds the pairs and then collapses them'''
+    params = ([100, 1000, 10000, 100000], [1, 3])
+    param_names = ['contigs', 'copies']
+    number = 1
+
+    def setup(self, contigs, copies):
+        rng = random.Random(42)
+        names = ['contig' + str(i) for i in range(contigs)]
+        pairs = [(name, name + '.copy' + str(i + 1)) for name in names for i in range(copies)]
+        rng.shuffle(pairs)
+        self.cleaner = clean.Cleaner(os.devnull, 'out')
+        self.sets = [set(x) for x in pairs]
+        self.containing = {}
+        for name1, name2 in pairs:
+            self.containing.setdefault(name1, set()).add(name2)
+            self.containing.setdefault(name2, set()).add(name1)
+
+    def time_collapse_list_of_sets(self, contigs, copies):
+        self.cleaner._collapse_list_of_sets(self.sets)
+
+    def time_get_identical_contigs(self, contigs, copies):
+        self.cleaner._get_identical_contigs(self.containing)
+
+
+class CleanContainedContigs:
+    '''The python part of Cleaner.run (everything after loading the nucmer hits)
+       on an assembly that has copies of every contig and contigs inside them'''
+    params = ([10, 100, 500], [1, 3])
+    param_names = ['contigs', 'copies']
+    number = 1
+
+    def setup(self, contigs, copies):
+        genome = synthetic.circular_genome(max(1, contigs // 10), 10000)
+        layout = synthetic.redundant_assembly(genome, min(10, contigs), copies=copies, contained=1)
+        self.cleaner = clean.Cleaner(os.devnull, 'out')
+        self.lengths = {name: window.length for name, window in layout.items()}
+        self.hits = {}
+        for line in synthetic.exact_hits(genome, layout, layout, min_length=500):
+            hit = pymummer.alignment.Alignment(line)
+            if hit.qry_name != hit.ref_name:
+                self.hits.setdefault(hit.qry_name, []).append(hit)
+
+    def time_contained_contigs(self, contigs, copies):
+        containing = self.cleaner._get_containing_contigs(self.hits)
+        containing = self.cleaner._expand_containing_using_transitivity(containing)
+        self.cleaner._remove_identical_contigs(containing, self.lengths)
+
+
+def load_hits(coords_file, method):
+    '''Loads the hits in coords_file, either into pymummer Alignments in a dict of
+       query name => list of hits (how clean used to do it), into hits.Hit records
+       in the same kind of dict (Cleaner._load_nucmer_hits), or only into a
+       hits.HitTable (Cleaner.run)'''
+    if method == 'pymummer':
+        loaded = {}
+        for hit in pymummer.coords_file.reader(coords_file):
+            loaded.setdefault(hit.qry_name, []).append(hit)
+        return loaded
+    elif method == 'hit_records':
+        return hits.HitTable.from_coords_file(coords_file).group_by('qry_name')
+    else:
+        return hits.HitTable.from_coords_file(coords_file)
+
+
+class LoadNucmerHits:
+    '''Time and memory of loading a coords file, in each of the ways in load_hits'''
+    params = ([10000, 100000, 1000000], ['pymummer', 'hit_records', 'hit_table'])
+    param_names = ['hits', 'method']
+    number = 1
+    unit = 'MB'
+
+    def setup(self, number_of_hits, method):
+        self.coords_file = synthetic.cached_coords_file(number_of_hits, max(10, number_of_hits // 1000))
+
+    def time_load(self, number_of_hits, method):
+        load_hits(self.coords_file, method)
+
+    def track_memory(self, number_of_hits, method):
+        tracemalloc.start()
+        try:
+            loaded = load_hits(self.coords_file, method)
+            memory = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+        return round(memory / (1024 * 1024), 1)
+
+
+class CleanGetContainingContigs:
+    '''Cleaner._get_containing_contigs on the hits loaded by load_hits, or
+       Cleaner._get_containing_contigs_from_table on the HitTable'''
+    params = ([10000, 100000], ['pymummer', 'hit_records', 'hit_table'])
+    param_names = ['hits', 'method']
+    number = 1
+
+    def setup(self, number_of_hits, method):
+        self.cleaner = clean.Cleaner(os.devnull, 'out', min_contig_percent_match=10)
+        self.loaded = load_hits(synthetic.cached_coords_file(number_of_hits, max(10, number_of_hits // 1000)), method)
+
+    def time_get_containing_contigs(self, number_of_hits, method):
+        if method == 'hit_table':
+            self.cleaner._get_containing_contigs_from_table(self.loaded)
+        else:
+            self.cleaner._get_containing_contigs(self.loaded)
+
+
+class LoadContigs:
+    '''Time and memory of loading a FASTA file with pyfastaq.tasks.file_to_dict, or
+       into a contig_store.ContigStore, and then reading the ends of each contig
+       like merge does'''
+    params = ([10, 100, 1000], [50000, 500000], ['file_to_dict', 'contig_store'])
+    param_names = ['contigs', 'contig_length', 'method']
+    number = 1
+    unit = 'MB'
+
+    def setup(self, contigs, contig_length, method):
+        self.tmpdir = tempfile.mkdtemp(prefix='circlator.benchmark.')
+        self.fasta = os.path.join(self.tmpdir, 'contigs.fa')
+        genome = synthetic.circular_genome(contigs, contig_length)
+        synthetic.write_layout(genome, synthetic.fragmented_assembly(genome, 1), self.fasta)
+
+    def teardown(self, contigs, contig_length, method):
+        shutil.rmtree(self.tmpdir)
+
+    def load(self, method):
+        if method == 'file_to_dict':
+            loaded = {}
+            pyfastaq.tasks.file_to_dict(self.fasta, loaded)
+        else:
+            loaded = contig_store.ContigStore(self.fasta)
+        for contig in loaded.values():
+            contig[:1000] + contig[-1000:]
+        return loaded
+
+    def time_load(self, contigs, contig_length, method):
+        self.load(method)
+
+    def track_memory(self, contigs, contig_length, method):
+        tracemalloc.start()
+        try:
+            loaded = self.load(method)
+            memory = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+        return round(memory / (1024 * 1024), 1)
+
+
+class FixstartRearrangeContigs:
+    '''StartFixer._rearrange_contigs, with the genes found by promer (some across the
+       ends of the contigs) and prodigal, on both strands'''
+    params = ([10, 100, 1000], [5000, 50000])
+    param_names = ['contigs', 'contig_length']
+    number = 1
+    end_length = 1500
+
+    def setup(self, contigs, contig_length):
+        self.tmpdir = tempfile.mkdtemp(prefix='circlator.benchmark.')
+        genome = synthetic.circular_genome(contigs, contig_length)
+        self.contigs = synthetic.layout_to_contigs(genome, synthetic.fragmented_assembly(genome, 1))
+        rng = random.Random(42)
+        self.promer = {}
+        self.prodigal = {}
+        self.ignore = set()
+        gene_length = 1000
+
+        for i, name in enumerate(sorted(self.contigs)):
+            length = len(self.contigs[name])
+            reverse = rng.random() < 0.5
+            if i % 5 in [0, 1]:
+                start = rng.randint(1, length - gene_length)
+                ref_name = name
+                if i % 5 == 1:
+                    start = rng.randint(1, 2 * self.end_length - gene_length)
+                    ref_name = name + '__ends'
+                coords = (start + gene_length - 1, start) if reverse else (start, start + gene_length - 1)
+                self.promer[name] = pymummer.alignment.Alignment(synthetic.promer_line(ref_name, *coords, length, 'dnaA', gene_length))
+            elif i % 5 in [2, 3]:
+                start = rng.randint(1, length - gene_length)
+                self.prodigal[name] = synthetic.prodigal_gff_line(name, start, start + gene_length - 1, '-' if reverse else '+')
+            else:
+                self.ignore.add(name)
+
+    def teardown(self, contigs, contig_length):
+        shutil.rmtree(self.tmpdir)
+
+    def time_rearrange_contigs(self, contigs, contig_length):
+        start_fixer.StartFixer._rearrange_contigs(self.contigs, self.promer, self.prodigal, self.ignore, self.end_length, os.path.join(self.tmpdir, 'log'))
+
+
+benchmarks = [
+    BamFilterGetRegion,
+    MergeCirculariseContigs,
+    MergeHitClassification,
+    CleanIdenticalContigs,
+    CleanContainedContigs,
+    LoadNucmerHits,
+    CleanGetContainingContigs,
+    LoadContigs,
+    FixstartRearrangeContigs,
+]
+
+
+def time_benchmark(benchmark_class, method_name, params, repeats):
+    '''Returns min time in seconds of running the method repeats times, with setup
+       (and teardown) run before (and after) each one, as asv does when number = 1'''
+    times = []
+    for i in range(repeats):
+        benchmark = benchmark_class()
+        benchmark.setup(*params)
+        try:
+            start_time = time.perf_counter()
+            getattr(benchmark, method_name)(*params)
+            times.append(time.perf_counter() - start_time)
+        finally:
+            if hasattr(benchmark, 'teardown'):
+                benchmark.teardown(*params)
+    return min(times)
+
+
+def track_benchmark(benchmark_class, method_name, params):
+    '''Returns the value returned by the method, run once between setup and teardown'''
+    benchmark = benchmark_class()
+    benchmark.setup(*params)
+    try:
+        return getattr(benchmark, method_name)(*params)
+    finally:
+        if hasattr(benchmark, 'teardown'):
+            benchmark.teardown(*params)
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--bench', help='Only run benchmarks whose name matches this regular expression', metavar='REGEX')
+    parser.add_argument('--quick', action='store_true', help='Only use the smallest value of each parameter')
+    parser.add_argument('--repeats', type=int, help='Number of times to run each benchmark. The fastest time is reported [%(default)s]', default=3, metavar='INT')
+    parser.add_argument('--json', help='Write the results to this JSON file', metavar='FILENAME')
+    options = parser.parse_args()
+
+    results = []
+    print('benchmark', 'params', 'value', 'unit', sep='\t')
+
+    for benchmark_class in benchmarks:
+        for method_name in sorted(x for x in dir(benchmark_class) if x.startswith('time_') or x.startswith('track_')):
+            name = benchmark_class.__name__ + '.' + method_name
+            if options.bench is not None and re.search(options.bench, name) is None:
+                continue
+
+            all_params = [[x[0]] for x in benchmark_class.params] if options.quick else benchmark_class.params
+            for params in itertools.product(*all_params):
+                if method_name.startswith('time_'):
+                    value = round(time_benchmark(benchmark_class, method_name, params, options.repeats), 4)
+                    unit = 'seconds'
+                else:
+                    value = track_benchmark(benchmark_class, method_name, params)
+                    unit = getattr(benchmark_class, 'unit', 'unit')
+                params_string = ','.join(x + '=' + str(y) for x, y in zip(benchmark_class.param_names, params))
+                print(name, params_string, value, unit, sep='\t', flush=True)
+                results.append({'name': name, 'params': dict(zip(benchmark_class.param_names, params)), 'value': value, 'unit': unit})
+
+    if options.json is not None:
+        with open(options.json, 'w') as f:
+            json.dump({'python': sys.version.split()[0], 'repeats': options.repeats, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,284 @@
+'''Makes synthetic data for the benchmarks. Everything is made from a seeded random
+number generator, so the same arguments always give the same files'''
+import os
+import atexit
+import random
+import shutil
+import tempfile
+import functools
+import collections
+import pysam
+import pyfastaq
+
+complement = str.maketrans('ACGTacgt', 'TGCAtgca')
+
+
+def random_contigs(number_of_contigs, contig_length, seed=42):
+    '''Returns dict of contig name => random sequence'''
+    rng = random.Random(seed)
+    return {
+        'contig' + str(i).zfill(6): ''.join(rng.choice('ACGT') for x in range(contig_length))
+        for i in range(number_of_contigs)
+    }
+
+
+def write_contigs(contigs, outfile):
+    f = pyfastaq.utils.open_file_write(outfile)
+    for name in sorted(contigs):
+        print(pyfastaq.sequences.Fasta(name, contigs[name]), file=f)
+    pyfastaq.utils.close(f)
+
+
+def write_bam(contigs, outfile, read_length=5000, depth=20, unmapped_reads=100, with_quals=True, seed=42):
+    '''Writes sorted and indexed BAM file of error-free reads sampled from the
+       contigs, plus some unmapped reads. Returns the number of reads written'''
+    rng = random.Random(seed)
+    names = sorted(contigs)
+    header = {'HD': {'VN': '1.0', 'SO': 'coordinate'}, 'SQ': [{'SN': x, 'LN': len(contigs[x])} for x in names]}
+    reads = []
+
+    for tid, name in enumerate(names):
+        seq = contigs[name]
+        this_read_length = min(read_length, len(seq))
+        for i in range(int(depth * len(seq) / this_read_length)):
+            pos = rng.randint(0, len(seq) - this_read_length)
+            reads.append((tid, pos, rng.random() < 0.5))
+
+    reads.sort()
+    count = 0
+
+    with pysam.AlignmentFile(outfile, 'wb', header=header) as f:
+        for tid, pos, is_reverse in reads:
+            read = pysam.AlignedSegment()
+            read.query_name = 'read' + str(count)
+            read.query_sequence = contigs[names[tid]][pos:pos + read_length]
+            read.flag = 16 if is_reverse else 0
+            read.reference_id = tid
+            read.reference_start = pos
+            read.mapping_quality = 60
+            read.cigartuples = [(0, len(read.query_sequence))]
+            if with_quals:
+                read.query_qualities = pysam.qualitystring_to_array('I' * len(read.query_sequence))
+            f.write(read)
+            count += 1
+
+        for i in range(unmapped_reads):
+            read = pysam.AlignedSegment()
+            read.query_name = 'unmapped' + str(i)
+            read.query_sequence = ''.join(rng.choice('ACGT') for x in range(read_length))
+            read.flag = 4
+            read.reference_id = -1
+            read.reference_start = -1
+            if with_quals:
+                read.query_qualities = pysam.qualitystring_to_array('I' * read_length)
+            f.write(read)
+            count += 1
+
+    pysam.index(outfile)
+    return count
+
+
+# Everything below makes synthetic genomes and assemblies of them, plus the output
+# that the external tools (nucmer, promer, prodigal, canu) would make, so that the
+# python parts of circlator can be benchmarked without running the tools.
+# An assembly is described by a "layout": dict contig name => Window, where the
+# window says which part of the genome the contig is.
+
+Window = collections.namedtuple('Window', ['replicon', 'start', 'length', 'reverse'])
+
+_bases = bytes(b'ACGT'[i % 4] for i in range(256))
+
+
+def revcomp(seq):
+    return seq.translate(complement)[::-1]
+
+
+@functools.lru_cache(maxsize=8)
+def circular_genome(replicons, replicon_length, seed=42):
+    '''Returns dict replicon name => random sequence. The replicons are circular'''
+    rng = random.Random(seed)
+    return {
+        'replicon' + str(i).zfill(5): rng.randbytes(replicon_length).translate(_bases).decode()
+        for i in range(replicons)
+    }
+
+
+def window_sequence(genome, window):
+    '''Returns the sequence of a window of a (circular) genome'''
+    seq = genome[window.replicon]
+    repeats = 2 + (window.start + window.length) // len(seq)
+    bases = (seq * repeats)[window.start:window.start + window.length]
+    return revcomp(bases) if window.reverse else bases
+
+
+def fragmented_assembly(genome, contigs_per_replicon, overlap=0, reverse_percent=0, seed=42):
+    '''Returns layout of an assembly where each replicon is broken at random positions
+       into contigs_per_replicon contigs. Each contig is extended by overlap bases into the
+       next one (the last one wraps round into the first one). So with one contig per
+       replicon and overlap > 0, the contigs are circular but not circularised.
+       reverse_percent of the contigs are reverse complemented'''
+    rng = random.Random(seed)
+    layout = {}
+    for replicon, seq in sorted(genome.items()):
+        starts = sorted(rng.sample(range(len(seq)), min(contigs_per_replicon, len(seq))))
+        for i, start in enumerate(starts):
+            end = starts[i + 1] if i + 1 < len(starts) else starts[0] + len(seq)
+            name = replicon + '.' + str(i + 1)
+            layout[name] = Window(replicon, start, end - start + overlap, 100 * rng.random() < reverse_percent)
+    return layout
+
+
+def redundant_assembly(genome, contigs_per_replicon, copies=1, contained=1, overlap=0, seed=42):
+    '''Returns layout of an assembly like fragmented_assembly, plus, for each contig,
+       copies identical contigs and contained contigs that are in the middle of it.
+       Half of the extra contigs are reverse complemented'''
+    rng = random.Random(seed)
+    layout = fragmented_assembly(genome, contigs_per_replicon, overlap=overlap, seed=seed)
+    for name, window in list(layout.items()):
+        for i in range(copies):
+            layout[name + '.copy' + str(i + 1)] = window._replace(reverse=rng.random() < 0.5)
+        for i in range(contained):
+            length = max(1, window.length // 2)
+            start = (window.start + rng.randint(0, window.length - length)) % len(genome[window.replicon])
+            layout[name + '.contained' + str(i + 1)] = Window(window.replicon, start, length, rng.random() < 0.5)
+    return layout
+
+
+def write_layout(genome, layout, outfile):
+    '''Writes FASTA file of the contigs in the layout'''
+    f = pyfastaq.utils.open_file_write(outfile)
+    for name in sorted(layout):
+        print(pyfastaq.sequences.Fasta(name, window_sequence(genome, layout[name])), file=f)
+    pyfastaq.utils.close(f)
+
+
+def layout_to_contigs(genome, layout):
+    '''Returns dict contig name => pyfastaq.sequences.Fasta'''
+    return {name: pyfastaq.sequences.Fasta(name, window_sequence(genome, window)) for name, window in layout.items()}
+
+
+def write_canu_assembly(genome, layout, outdir, circular=None):
+    '''Makes a directory like the output of canu, that circlator.assembly.Assembly
+       can load. circular = names of contigs to call circular in the GFA file'''
+    os.mkdir(outdir)
+    write_layout(genome, layout, os.path.join(outdir, 'contigs.fasta'))
+    with open(os.path.join(outdir, 'contigs.gfa'), 'w') as f:
+        print('H', 'VN:Z:1.0', sep='\t', file=f)
+        for name in sorted(layout):
+            print('S', name, '*', 'LN:i:' + str(layout[name].length), sep='\t', file=f)
+        for name in sorted(set() if circular is None else circular):
+            print('L', name, '+', name, '+', '0M', sep='\t', file=f)
+            print('L', name, '-', name, '-', '0M', sep='\t', file=f)
+
+
+def _window_position(window, genome_position):
+    '''Returns position in the contig of window of unrolled genome_position'''
+    offset = genome_position - window.start
+    return window.length - 1 - offset if window.reverse else offset
+
+
+def exact_hits(genome, ref_layout, qry_layout, min_length=1):
+    '''Stand-in for nucmer plus show-coords -dTlro. Returns list of show-coords lines
+       of the exact matches between the contigs in ref_layout and qry_layout, which
+       come from where contigs are made from the same part of the genome. Like
+       nucmer --maxmatch, this includes the hits of a contig to itself'''
+    qry_by_replicon = {}
+    for name, window in qry_layout.items():
+        qry_by_replicon.setdefault(window.replicon, []).append((name, window))
+
+    lines = []
+    for ref_name, ref in sorted(ref_layout.items()):
+        replicon_length = len(genome[ref.replicon])
+        for qry_name, qry in qry_by_replicon.get(ref.replicon, []):
+            for k in range(-2, 3):
+                start = max(ref.start, qry.start + k * replicon_length)
+                end = min(ref.start + ref.length, qry.start + k * replicon_length + qry.length)
+                if end - start < min_length:
+                    continue
+                shifted_qry = qry._replace(start=qry.start + k * replicon_length)
+                ref_start, ref_end = _window_position(ref, start), _window_position(ref, end - 1)
+                qry_start, qry_end = _window_position(shifted_qry, start), _window_position(shifted_qry, end - 1)
+                if ref_start > ref_end:
+                    ref_start, ref_end, qry_start, qry_end = ref_end, ref_start, qry_end, qry_start
+                lines.append('\t'.join([str(x) for x in [
+                    ref_start + 1, ref_end + 1, qry_start + 1, qry_end + 1,
+                    end - start, end - start, '100.00', ref.length, qry.length,
+                    1, 1 if qry_start < qry_end else -1, ref_name, qry_name,
+                ]]))
+    return lines
+
+
+def promer_line(ref_name, ref_start, ref_end, ref_length, qry_name, qry_length):
+    '''Stand-in for promer plus show-coords. Returns one line of a match of the whole
+       of the query gene to the reference, with 1-based coordinates. The match is on
+       the reverse strand if ref_start > ref_end'''
+    hit_length = abs(ref_end - ref_start) + 1
+    frame = 1 if ref_start < ref_end else -1
+    return '\t'.join([str(x) for x in [
+        ref_start, ref_end, 1, qry_length, hit_length, qry_length,
+        '100.00', '100.00', '0.00', ref_length, qry_length, frame, 1, ref_name, qry_name,
+    ]])
+
+
+def random_hits(number_of_hits, contigs, contig_length=50000, min_length=500, seed=42, qry_contigs=None):
+    '''Returns list of show-coords -dTlro lines of random hits between contigs
+       called contig1, contig2, ... Each contig is contig_length long. Half the
+       hits are at the start or end of the reference, and half are reversed.
+       The query contigs are the first qry_contigs contigs (default all of them)'''
+    rng = random.Random(seed)
+    lines = []
+    if qry_contigs is None:
+        qry_contigs = contigs
+    for i in range(number_of_hits):
+        ref_name = 'contig' + str(rng.randint(1, contigs))
+        qry_name = 'contig' + str(rng.randint(1, qry_contigs))
+        hit_length = rng.randint(min_length, contig_length // 5)
+        ref_start = rng.choice([1, contig_length - hit_length + 1, rng.randint(1, contig_length - hit_length + 1)])
+        qry_start = rng.randint(1, contig_length - hit_length + 1)
+        qry_end = qry_start + hit_length - 1
+        if rng.random() < 0.5:
+            qry_start, qry_end = qry_end, qry_start
+        lines.append('\t'.join([str(x) for x in [
+            ref_start, ref_start + hit_length - 1, qry_start, qry_end,
+            hit_length, hit_length, '{:.2f}'.format(rng.uniform(95, 100)), contig_length, contig_length,
+            1, 1 if qry_start < qry_end else -1, ref_name, qry_name,
+        ]]))
+    return lines
+
+
+def write_coords(lines, outfile, ref_fasta='ref.fa', qry_fasta='qry.fa'):
+    '''Writes a coords file like show-coords -dTlro makes, with the given hit lines'''
+    with open(outfile, 'w') as f:
+        print(ref_fasta, qry_fasta, file=f)
+        print('NUCMER', file=f)
+        print(file=f)
+        print('[S1]', '[E1]', '[S2]', '[E2]', '[LEN 1]', '[LEN 2]', '[% IDY]', '[LEN R]', '[LEN Q]', '[FRM]', '[TAGS]', sep='\t', file=f)
+        for line in lines:
+            print(line, file=f)
+
+
+def prodigal_gff_line(contig_name, start, end, strand):
+    '''Stand-in for prodigal. Returns one line of prodigal's GFF output, with 1-based coordinates'''
+    return '\t'.join([contig_name, 'Prodigal_v2.6.3', 'CDS', str(start), str(end), '100.0', strand, '0', 'ID=1_1;partial=00'])
+
+
+@functools.lru_cache(maxsize=8)
+def cached_bam(contigs, contig_length, read_length, depth, seed=42):
+    '''Returns name of BAM file made by write_bam, which is only made once
+       for the same arguments. It is deleted when python exits'''
+    outdir = tempfile.mkdtemp(prefix='circlator.benchmark.')
+    atexit.register(shutil.rmtree, outdir, ignore_errors=True)
+    bam = os.path.join(outdir, 'reads.bam')
+    write_bam(random_contigs(contigs, contig_length, seed=seed), bam, read_length=read_length, depth=depth, unmapped_reads=0, seed=seed)
+    return bam
+
+
+@functools.lru_cache(maxsize=8)
+def cached_coords_file(number_of_hits, contigs, seed=42, qry_contigs=None):
+    '''Returns name of coords file of random_hits, which is only made once
+       for the same arguments. It is deleted when python exits'''
+    outdir = tempfile.mkdtemp(prefix='circlator.benchmark.')
+    atexit.register(shutil.rmtree, outdir, ignore_errors=True)
+    coords_file = os.path.join(outdir, 'hits.coords')
+    write_coords(random_hits(number_of_hits, contigs, seed=seed, qry_contigs=qry_contigs), coords_file)
+    return coords_file
@@ -1,27 +1,50 @@
-from pkg_resources import get_distribution
-
-try:
-    __version__ = get_distribution('circlator').version
-except:
-    __version__ = 'local'
+import importlib
 
 
 __all__ = [
     'assemble',
     'assembly',
     'bamfilter',
+    'bgzf',
+    'cache',
     'clean',
     'common',
+    'contig_store',
     'dnaa',
     'external_progs',
+    'hits',
     'mapping',
     'merge',
     'minimus2',
+    'perf',
+    'pipeline',
     'program',
+    'runner',
     'start_fixer',
     'tasks',
     'versions',
 ]
 
-from circlator import *
 
+def _get_version():
+    try:
+        from importlib import metadata
+        return metadata.version('circlator')
+    except:
+        return 'local'
+
+
+def __getattr__(name):
+    '''Modules are imported when they are first used, instead of all of them
+       when circlator is imported, so that circlator starts up quickly.
+       Same for __version__, because importlib.metadata is slow to import'''
+    if name in __all__:
+        return importlib.import_module('circlator.' + name)
+    elif name == '__version__':
+        globals()['__version__'] = _get_version()
+        return globals()['__version__']
+    raise AttributeError("module 'circlator' has no attribute '" + name + "'")
+
+
+def __dir__():
+    return sorted(set(list(globals()) + __all__ + ['__version__']))
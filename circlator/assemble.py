@@ -1,12 +1,96 @@
 import os
+import json
+import time
+import hashlib
 import tempfile
 import sys
 import shutil
+import threading
+import contextvars
+import concurrent.futures
 import pyfastaq
-from circlator import common, external_progs
+from circlator import assembly, cache, common, external_progs, runner
 
 class Error (Exception): pass
 
+# Used when adaptive stopping of the SPAdes kmer sweep is on. The sweep stops when
+# this many kmers in a row have not made the N50 any bigger, or when an assembly
+# has a circular contig that has at least this percent of the assembled bases
+adaptive_plateau_kmers = 2
+adaptive_circular_percent = 95
+
+# file written in the assembly directory, with the result of each SPAdes kmer
+spades_kmers_log = 'circlator.spades_kmers.log'
+
+# environment variables that set the directory and maximum size in GB of the reassembly cache
+reassembly_cache_env = 'CIRCLATOR_REASSEMBLY_CACHE'
+reassembly_cache_size_env = 'CIRCLATOR_REASSEMBLY_CACHE_SIZE'
+default_reassembly_cache_size_gb = 5
+
+
+def fasta_length_stats(filename):
+    '''Returns dictionary of length stats of the sequences in a FASTA file, the same as
+       pyfastaq.tasks.stats_from_fai, but reads the FASTA file instead of needing a fai file.
+       Also has key 'lengths' = dict of sequence name -> length'''
+    names = []
+    lengths = []
+    with open(filename, 'rb') as f:
+        for line in f:
+            if line.startswith(b'>'):
+                fields = line[1:].split()
+                names.append(fields[0].decode() if len(fields) else '')
+                lengths.append(0)
+            elif len(lengths):
+                lengths[-1] += len(line.rstrip())
+
+    stats = {x: 0 for x in ('longest', 'shortest', 'mean', 'N50', 'total_length', 'number')}
+    stats['lengths'] = dict(zip(names, lengths))
+    if len(lengths) == 0:
+        return stats
+
+    sorted_lengths = sorted(lengths, reverse=True)
+    stats['longest'] = sorted_lengths[0]
+    stats['shortest'] = sorted_lengths[-1]
+    stats['total_length'] = sum(sorted_lengths)
+    stats['mean'] = stats['total_length'] / len(sorted_lengths)
+    stats['number'] = len(sorted_lengths)
+    cumulative_length = 0
+    for length in sorted_lengths:
+        cumulative_length += length
+        if cumulative_length >= 0.5 * stats['total_length']:
+            stats['N50'] = length
+            break
+
+    return stats
+
+
+class ReassemblyCache(cache.Cache):
+    '''Cache of assemblies (see cache.Cache), so that an assembly is not run again
+       when nothing that changes it has changed. Each result has the files from the
+       assembly output directory in cached_files'''
+    cached_files = [
+        'contigs.fasta',
+        'contigs.fastg',
+        'contigs.paths',
+        'assembly_graph.fastg',
+        'contigs.gfa',
+        spades_kmers_log,
+    ]
+
+    def __init__(self, directory, max_size_gb=None):
+        if max_size_gb is None:
+            max_size_gb = float(os.environ.get(reassembly_cache_size_env, default_reassembly_cache_size_gb))
+        super().__init__(directory, max_size_gb)
+
+
+    @classmethod
+    def copy_files(cls, from_dir, to_dir):
+        '''Copies the files in cached_files that exist in from_dir to to_dir'''
+        for filename in cls.cached_files:
+            if os.path.exists(os.path.join(from_dir, filename)):
+                shutil.copy(os.path.join(from_dir, filename), os.path.join(to_dir, filename))
+
+
 class Assembler:
     def __init__(self,
       reads,
@@ -20,6 +104,10 @@ class Assembler:
       assembler='spades',
       genomeSize=100000, # only matters for Canu if correcting reads (which we're not)
       data_type='pacbio-corrected',
+      spades_concurrent_runs=None,
+      spades_adaptive=False,
+      cache_dir=None,
+      cache_size_gb=None,
     ):
         self.outdir = os.path.abspath(outdir)
         self.reads = os.path.abspath(reads)
@@ -27,7 +115,6 @@ class Assembler:
             raise Error('Reads file not found:' + self.reads)
 
         self.verbose = verbose
-        self.samtools = external_progs.make_and_check_prog('samtools', verbose=self.verbose)
         self.threads = threads
         self.assembler = assembler
 
@@ -35,6 +122,8 @@ class Assembler:
             self.spades = external_progs.make_and_check_prog('spades', verbose=self.verbose, required=True)
             self.spades_kmers = self._build_spades_kmers(spades_kmers)
             self.spades_use_first_success = spades_use_first_success
+            self.spades_concurrent_runs = spades_concurrent_runs
+            self.spades_adaptive = spades_adaptive
             self.careful = careful
             self.only_assembler = only_assembler
         elif self.assembler == 'canu':
@@ -44,6 +133,10 @@ class Assembler:
         else:
             raise Error('Unknown assembler: "' + self.assembler + '". cannot continue')
 
+        if cache_dir is None:
+            cache_dir = os.environ.get(reassembly_cache_env)
+        self.cache = None if cache_dir is None else ReassemblyCache(cache_dir, max_size_gb=cache_size_gb)
+
 
 
     def _build_spades_kmers(self, kmers):
@@ -61,12 +154,12 @@ class Assembler:
             raise Error('Error getting list of kmers from:' + str(kmers))
 
 
-    def _make_spades_command(self, kmer, outdir):
+    def _make_spades_command(self, kmer, outdir, threads=None):
         cmd = [
             self.spades.exe(),
             '-s', self.reads,
             '-o', outdir,
-            '-t', str(self.threads),
+            '-t', str(self.threads if threads is None else threads),
             '-k', str(kmer),
         ]
 
@@ -96,29 +189,145 @@ class Assembler:
 
     def run_spades_once(self, kmer, outdir):
         cmd = self._make_spades_command(kmer, outdir)
-        return common.syscall(cmd, verbose=self.verbose, allow_fail=True)
+        return common.syscall(cmd, verbose=self.verbose, allow_fail=True, name='spades k' + str(kmer))
+
+
+    def _spades_runs_and_threads(self):
+        '''Returns tuple (number of SPAdes runs at the same time, threads per run)'''
+        if self.spades_concurrent_runs is None:
+            # small reassemblies do not use many threads well, so give each run about 4
+            runs = max(1, self.threads // 4)
+        else:
+            runs = self.spades_concurrent_runs
+        runs = max(1, min(runs, len(self.spades_kmers), self.threads))
+        return runs, max(1, self.threads // runs)
+
+
+    def _run_spades_for_sweep(self, kmer, threads, kmer_to_dir, stop):
+        '''Runs SPAdes with one kmer, as part of run_spades. Returns dict with keys:
+           status ('ok', 'failed', 'stopped' if killed because stop (a threading.Event)
+           was set, or 'not run'), seconds, N50, and circular (True iff the
+           assembly is a circular contig plus not much else)'''
+        result = {'status': 'not run', 'seconds': 0, 'N50': None, 'circular': False}
+        if stop.is_set():
+            return result
+
+        tmpdir = tempfile.mkdtemp(prefix=self.outdir + '.tmp.spades.' + str(kmer) + '.', dir=os.getcwd())
+        kmer_to_dir[kmer] = tmpdir
+        cmd = self._make_spades_command(kmer, tmpdir, threads=threads)
+        metrics = runner.run(cmd, name='spades k' + str(kmer), allow_fail=True, verbose=self.verbose, stop=stop)
+        result['seconds'] = metrics['wall_seconds']
+        if metrics['status'] != 'ok':
+            # a timeout counts as failed, so that the sweep carries on
+            result['status'] = 'stopped' if metrics['status'] == 'stopped' else 'failed'
+            return result
+
+        result['status'] = 'ok'
+        stats = fasta_length_stats(os.path.join(tmpdir, 'contigs.fasta'))
+        result['N50'] = stats['N50']
+
+        if self.spades_adaptive and stats['N50'] > 0:
+            try:
+                circular = assembly.Assembly(tmpdir, 'spades').circular_contigs()
+            except assembly.Error:
+                circular = set()
+            result['circular'] = len(circular) > 0 and 100 * max(stats['lengths'].get(x, 0) for x in circular) >= adaptive_circular_percent * stats['total_length']
+
+        return result
+
+
+    def _stop_sweep_after(self, results, stop_at_first_success):
+        '''Given list of the results of the first n kmers from _run_spades_for_sweep,
+           returns a reason to not run any more kmers, or None to carry on'''
+        n50s = [x['N50'] for x in results if x['status'] == 'ok' and x['N50'] > 0]
+        if len(n50s) == 0 or results[-1]['status'] != 'ok' or results[-1]['N50'] == 0:
+            return None
+        elif stop_at_first_success:
+            return 'first success'
+        elif not self.spades_adaptive:
+            return None
+        elif results[-1]['circular']:
+            return 'circular contig'
+
+        best = max(n50s)
+        since_best = 0
+        for result in reversed(results):
+            if result['status'] == 'ok' and result['N50'] == best:
+                break
+            since_best += 1
+        if since_best >= adaptive_plateau_kmers:
+            return 'N50 plateau'
+        return None
+
+
+    def _write_sweep_log(self, results, stop_reason, wall_seconds, runs):
+        '''Writes the per kmer results from run_spades to the log file in the output directory'''
+        seconds = [x['seconds'] for x in results if x['status'] in {'ok', 'failed'}]
+        mean_seconds = sum(seconds) / len(seconds) if len(seconds) else 0
+        # a kmer that was not run would have taken about as long as the ones that were.
+        # Killed runs only saved the rest of their time
+        saved = sum(max(0, mean_seconds - x['seconds']) for x in results if x['status'] in {'not run', 'stopped'}) / runs
+
+        with open(os.path.join(self.outdir, spades_kmers_log), 'w') as f:
+            print('#kmer', 'status', 'N50', 'seconds', sep='\t', file=f)
+            for kmer, result in zip(self.spades_kmers, results):
+                print(kmer, result['status'], '.' if result['N50'] is None else result['N50'], round(result['seconds'], 2), sep='\t', file=f)
+            print('#stopped early:', 'no' if stop_reason is None else stop_reason, file=f)
+            print('#wall clock seconds:', round(wall_seconds, 2), file=f)
+            print('#estimated seconds saved by stopping early:', round(saved, 2), file=f)
+
+        if self.verbose and stop_reason is not None:
+            print('[assemble] stopped kmer sweep early (', stop_reason, '). Estimated time saved: ', round(saved, 2), ' seconds', sep='', flush=True)
 
 
     def run_spades(self, stop_at_first_success=False):
         '''Runs spades on all kmers. Each a separate run because SPAdes dies if any kmer does
-           not work. Chooses the 'best' assembly to be the one with the biggest N50'''
+           not work. Chooses the 'best' assembly to be the one with the biggest N50.
+           Several kmers are run at once (see _spades_runs_and_threads), with the threads
+           split between them. If stop_at_first_success, uses the first kmer in the list
+           that works. If self.spades_adaptive, stops after a kmer that makes a circular
+           contig, or when the N50 has not got bigger for adaptive_plateau_kmers kmers.
+           Whether to stop is decided in kmer order, so the same kmer is chosen however many
+           run at once. The runs of the kmers after the stopping point are killed or not started'''
         n50 = {}
         kmer_to_dir = {}
-
-        for k in self.spades_kmers:
-            tmpdir = tempfile.mkdtemp(prefix=self.outdir + '.tmp.spades.' + str(k) + '.', dir=os.getcwd())
-            kmer_to_dir[k] = tmpdir
-            ok, errs = self.run_spades_once(k, tmpdir)
-            if ok:
-                contigs_fasta = os.path.join(tmpdir, 'contigs.fasta')
-                contigs_fai = contigs_fasta + '.fai'
-                common.syscall(self.samtools.exe() + ' faidx ' + contigs_fasta, verbose=self.verbose)
-                stats = pyfastaq.tasks.stats_from_fai(contigs_fai)
-                if stats['N50'] != 0:
-                    n50[k] = stats['N50']
-
-                    if stop_at_first_success:
-                        break
+        runs, threads_per_run = self._spades_runs_and_threads()
+        stops = [threading.Event() for k in self.spades_kmers]
+        results = [None] * len(self.spades_kmers)
+        checked = 0
+        stop_reason = None
+        start_time = time.perf_counter()
+        if self.verbose:
+            print('[assemble] running', runs, 'SPAdes assemblies at once, each with', threads_per_run, 'threads', flush=True)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=runs) as pool:
+            # run in a copy of this thread's context, so that the SPAdes runs get the
+            # runner labels of this stage in the run report
+            futures = {
+                pool.submit(contextvars.copy_context().run, self._run_spades_for_sweep, k, threads_per_run, kmer_to_dir, stops[i]): i
+                for i, k in enumerate(self.spades_kmers)
+            }
+
+            for future in concurrent.futures.as_completed(futures):
+                results[futures[future]] = future.result()
+
+                while stop_reason is None and checked < len(results) and results[checked] is not None:
+                    checked += 1
+                    stop_reason = self._stop_sweep_after(results[:checked], stop_at_first_success)
+                    if stop_reason is not None:
+                        for stop in stops[checked:]:
+                            stop.set()
+
+        wall_seconds = time.perf_counter() - start_time
+
+        for i in range(checked):
+            if results[i]['status'] == 'ok' and results[i]['N50'] > 0:
+                n50[self.spades_kmers[i]] = results[i]['N50']
+
+        # anything after the stopping point is ignored, even if it finished
+        for i in range(checked, len(results)):
+            if results[i]['status'] != 'not run':
+                results[i]['status'] = 'stopped'
 
         if len(n50) > 0:
             if self.verbose:
@@ -141,6 +350,8 @@ class Assembler:
                     os.rename(directory, self.outdir)
                 else:
                     shutil.rmtree(directory)
+
+            self._write_sweep_log(results, stop_reason, wall_seconds, runs)
         else:
             raise Error('Error running SPAdes. Output directories are:\n  ' + '\n  '.join(kmer_to_dir.values()) + '\nThe reason why should be in the spades.log file in each directory.')
 
@@ -159,9 +370,9 @@ class Assembler:
     def run_canu(self):
         '''Runs canu instead of spades'''
         cmd = self._make_canu_command(self.outdir,'canu')
-        ok, errs = common.syscall(cmd, verbose=self.verbose, allow_fail=False)
+        ok, errs = common.syscall(cmd, verbose=self.verbose, allow_fail=True, name='canu')
         if not ok:
-            raise Error('Error running Canu.')
+            raise Error('Error running Canu. The end of the output was:\n' + errs)
 
         original_contigs = os.path.join(self.outdir, 'canu.contigs.fasta')
         renamed_contigs = os.path.join(self.outdir, 'contigs.fasta')
@@ -171,10 +382,52 @@ class Assembler:
         os.rename(original_gfa, renamed_gfa)
 
 
-    def run(self):
+    def _cache_key(self):
+        '''Returns key for the reassembly cache, made from the reads and everything
+           that changes the assembly made from them. Threads are not included, so the
+           cached assembly may have been made using a different number of threads'''
+        if self.assembler == 'spades':
+            options = [
+                self.assembler,
+                self.spades.version,
+                self.spades_kmers,
+                self.careful,
+                self.only_assembler,
+                self.spades_use_first_success,
+                self.spades_adaptive,
+            ]
+        else:
+            options = [self.assembler, self.canu.version, self.genomeSize, self.data_type]
+
+        h = hashlib.sha256(json.dumps(options).encode())
+        return cache.file_hash(self.reads, h)
+
+
+    def _run_assembler(self):
         if self.assembler == 'spades':
             self.run_spades(stop_at_first_success=self.spades_use_first_success)
         elif self.assembler == 'canu':
             self.run_canu()
         else:
             raise Error('Unknown assembler: "' + self.assembler + '". cannot continue')
+
+
+    def run(self):
+        if self.cache is None:
+            self._run_assembler()
+            return
+
+        made_assembly = False
+
+        def make(directory):
+            nonlocal made_assembly
+            self._run_assembler()
+            ReassemblyCache.copy_files(self.outdir, directory)
+            made_assembly = True
+
+        with self.cache.get(self._cache_key(), make, verbose=self.verbose) as directory:
+            if not made_assembly:
+                if self.verbose:
+                    print('[assemble] using cached assembly', directory, flush=True)
+                os.mkdir(self.outdir)
+                ReassemblyCache.copy_files(directory, self.outdir)
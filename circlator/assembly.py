@@ -1,5 +1,6 @@
 import os
 import pyfastaq
+import circlator
 
 class Error (Exception): pass
 
@@ -69,10 +70,8 @@ class Assembly:
 
 
     def get_contigs(self):
-        '''Returns a dictionary of contig_name -> pyfastaq.Sequences.Fasta object'''
-        contigs = {}
-        pyfastaq.tasks.file_to_dict(self.contigs_fasta, contigs)
-        return contigs
+        '''Returns a dictionary (a circlator.contig_store.ContigStore) of contig_name -> pyfastaq.Sequences.Fasta object'''
+        return circlator.contig_store.ContigStore(self.contigs_fasta)
 
 
     @classmethod
@@ -187,3 +186,34 @@ class Assembly:
             return self._circular_contigs_from_canu_gfa(self.contigs_gfa)
         else:
             return set()
+
+
+class SplicedAssembly(Assembly):
+    def __init__(self, outfile, parts, assembler):
+        '''Makes an assembly from contigs taken from other assemblies, written to the
+           fasta file outfile. parts is a list of tuples (assembly, names, prefix):
+           the contigs called names (all contigs if names is None) are taken from
+           assembly, and prefix is added to their names. Contigs that were circular
+           in their assembly are circular in this one'''
+        self.assembler = assembler
+        self.assembler_dir = None
+        self.contigs_fasta = os.path.abspath(outfile)
+        self._set_filenames()
+        self.circular = set()
+        f = pyfastaq.utils.open_file_write(self.contigs_fasta)
+
+        for assembly, names, prefix in parts:
+            circular = assembly.circular_contigs()
+            for contig in pyfastaq.sequences.file_reader(assembly.contigs_fasta):
+                if names is not None and contig.id not in names:
+                    continue
+                if contig.id in circular:
+                    self.circular.add(prefix + contig.id)
+                contig.id = prefix + contig.id
+                print(contig, file=f)
+
+        pyfastaq.utils.close(f)
+
+
+    def circular_contigs(self):
+        return set(self.circular)
@@ -1,10 +1,48 @@
 import os
+import math
+import shutil
+import tempfile
+import itertools
+import collections
+import multiprocessing
 import pysam
 import pyfastaq
-from circlator import common, mapping
+from circlator import bgzf, common, mapping
 
 class Error (Exception): pass
 
+# size in bytes of the in-memory buffers used by BamFilter when reading the BAM in
+# one pass. Anything bigger than this is spilled to a temporary file
+spool_max_size = 100000000
+
+# number of reads to write to the output file at once
+write_batch_size = 1000
+
+# when single_pass is not given, BamFilter reads the BAM in one pass if the regions
+# it wants cover at least this fraction of the reference sequences. Otherwise it
+# fetches each region, which skips the reads in the middles of long contigs.
+# With synthetic BAMs of equal length contigs, the two take about the same time
+# when the regions cover a third of the references
+single_pass_min_fraction = 0.4
+
+
+def _write_reads_shard(bam_filter, shard_plan, outfile):
+    '''Writes reads from the contigs in shard_plan to outfile, using one pysam
+       handle for all the contigs. Writes all unmapped reads if shard_plan is None.
+       Returns outfile. Used by BamFilter when running in parallel'''
+    sam_reader = pysam.Samfile(bam_filter.bam, "rb")
+    with open(outfile, 'w') as f:
+        if shard_plan is None:
+            bam_filter._get_all_unmapped_reads(f, sam_reader=sam_reader)
+        else:
+            bam_filter._write_contig_reads_using_fetch(shard_plan, f, sam_reader=sam_reader)
+    return outfile
+
+
+def reads_filename(outprefix, fastq_out=False, compress=None):
+    '''Returns name of the reads file written by BamFilter with the given options'''
+    return outprefix + ('.fastq' if fastq_out else '.fasta') + ('' if compress is None else '.gz')
+
 
 class BamFilter:
     def __init__(
@@ -19,6 +57,10 @@ class BamFilter:
              log_prefix='[bamfilter]',
              verbose=False,
              split_all_reads=False,
+             single_pass=None,
+             threads=1,
+             compress=None,
+             compress_level=6,
     ):
         self.bam = os.path.abspath(bam)
         if not os.path.exists(self.bam):
@@ -26,7 +68,11 @@ class BamFilter:
 
         self.fastq_out = fastq_out
         self.length_cutoff = length_cutoff
-        self.reads_outfile = os.path.abspath(outprefix + ('.fastq' if self.fastq_out else '.fasta'))
+        self.compress = compress
+        self.compress_level = compress_level
+        if self.compress is not None and self.compress not in bgzf.allowed_formats:
+            raise Error('Unknown compression format "' + str(self.compress) + '". Must be one of: ' + ', '.join(bgzf.allowed_formats))
+        self.reads_outfile = os.path.abspath(reads_filename(outprefix, fastq_out=self.fastq_out, compress=self.compress))
         self.log = os.path.abspath(outprefix + '.log')
         self.log_prefix = log_prefix
         self.contigs_to_use = self._get_contigs_to_use(contigs_to_use)
@@ -34,6 +80,8 @@ class BamFilter:
         self.min_read_length = min_read_length
         self.verbose = verbose
         self.split_all_reads = split_all_reads
+        self.single_pass = single_pass
+        self.threads = threads
 
 
 
@@ -70,19 +118,26 @@ class BamFilter:
         return True
 
 
-    def _all_reads_from_contig(self, contig, fout):
+    def _all_reads_from_contig(self, contig, fout, sam_reader=None):
         '''Gets all reads from contig called "contig" and writes to fout'''
-        sam_reader = pysam.Samfile(self.bam, "rb")
-        for read in sam_reader.fetch(contig):
-            print(mapping.aligned_read_to_read(read, ignore_quality=not self.fastq_out), file=fout)
+        if sam_reader is None:
+            sam_reader = pysam.Samfile(self.bam, "rb")
+        self._write_records((mapping.aligned_read_to_record(read, ignore_quality=not self.fastq_out) for read in sam_reader.fetch(contig)), fout)
 
 
-    def _get_all_unmapped_reads(self, fout):
+    def _get_all_unmapped_reads(self, fout, sam_reader=None):
         '''Writes all unmapped reads to fout'''
-        sam_reader = pysam.Samfile(self.bam, "rb")
-        for read in sam_reader.fetch(until_eof=True):
-            if read.is_unmapped:
-                print(mapping.aligned_read_to_read(read, ignore_quality=not self.fastq_out), file=fout)
+        if sam_reader is None:
+            sam_reader = pysam.Samfile(self.bam, "rb")
+
+        # If the index says that no unmapped reads are placed on a contig, then they
+        # are all at the end of the file, and we can jump straight to them
+        if sam_reader.has_index() and sum([x.unmapped for x in sam_reader.get_index_statistics()]) == 0:
+            reads = sam_reader.fetch('*')
+        else:
+            reads = sam_reader.fetch(until_eof=True)
+
+        self._write_records((mapping.aligned_read_to_record(read, ignore_quality=not self.fastq_out) for read in reads if read.is_unmapped), fout)
 
 
     def _break_reads(self, contig, position, fout, min_read_length=250):
@@ -116,42 +171,53 @@ class BamFilter:
         for read in sam_reader.fetch(contig):
             read_interval = pyfastaq.intervals.Interval(read.pos, read.reference_end - 1)
             if not read_interval.intersects(exclude_interval):
-                print(mapping.aligned_read_to_read(read, ignore_quality=not self.fastq_out), file=fout)
+                fout.write(mapping.aligned_read_to_record(read, ignore_quality=not self.fastq_out))
 
 
-    def _get_region(self, contig, start, end, fout, min_length=250):
-        '''Writes reads mapping to given region of contig, trimming part of read not in the region'''
-        sam_reader = pysam.Samfile(self.bam, "rb")
-        trimming_end = (start == 0)
-        for read in sam_reader.fetch(contig, start, end):
-            read_interval = pyfastaq.intervals.Interval(read.pos, read.reference_end - 1)
-            seq = mapping.aligned_read_to_read(read, ignore_quality=not self.fastq_out, revcomp=False)
+    def _region_read_to_record(self, read, start, end, min_length=250):
+        '''Returns FASTA/Q record (made by mapping.aligned_read_to_record) of read mapping to given
+           region of contig, with the part of the read not in the region trimmed off.
+           Returns None if what is left is shorter than min_length'''
+        if start == 0:
+            bases_off_end = max(0, read.reference_end - 1 - end)
+            seq_start = 0
+            seq_end = read.query_alignment_end - bases_off_end
+        else:
+            bases_off_start = max(0, start - read.pos + 1)
+            seq_start = bases_off_start  + read.query_alignment_start
+            seq_end = read.query_length
 
-            if trimming_end:
-                bases_off_start = 0
-                bases_off_end = max(0, read.reference_end - 1 - end)
-                #seq.seq = seq.seq[:read.query_alignment_end - bases_off_end]
-                seq = seq.subseq(0, read.query_alignment_end - bases_off_end)
-            else:
-                bases_off_start = max(0, start - read.pos + 1)
-                #seq.seq = seq.seq[bases_off_start  + read.query_alignment_start:]
-                seq = seq.subseq(bases_off_start  + read.query_alignment_start, len(seq))
+        if len(range(read.query_length)[seq_start:seq_end]) >= min_length:
+            return mapping.aligned_read_to_record(read, ignore_quality=not self.fastq_out, start=seq_start, end=seq_end)
+        else:
+            return None
 
-            if read.is_reverse:
-                seq.revcomp()
 
-            if len(seq) >= min_length:
-                print(seq, file=fout)
+    @staticmethod
+    def _write_records(records, fout):
+        '''Writes records made by mapping.aligned_read_to_record to fout, in batches.
+           Any records that are None are skipped'''
+        records = iter(records)
+        while True:
+            batch = list(itertools.islice(records, write_batch_size))
+            if len(batch) == 0:
+                break
+            fout.write(''.join([x for x in batch if x is not None]))
 
 
-    def run(self):
-        ref_lengths = self._get_ref_lengths()
-        assert len(ref_lengths) > 0
-        f_log = pyfastaq.utils.open_file_write(self.log)
-        f_fa = pyfastaq.utils.open_file_write(self.reads_outfile)
-        print(self.log_prefix, '#contig', 'length', 'reads_kept', sep='\t', file=f_log)
-        if self.verbose:
-            print('Getting reads from BAM file', self.bam, flush=True)
+    def _get_region(self, contig, start, end, fout, min_length=250, sam_reader=None):
+        '''Writes reads mapping to given region of contig, trimming part of read not in the region'''
+        if sam_reader is None:
+            sam_reader = pysam.Samfile(self.bam, "rb")
+        self._write_records((self._region_read_to_record(read, start, end, min_length=min_length) for read in sam_reader.fetch(contig, start, end)), fout)
+
+
+    def _make_contig_plan(self, ref_lengths, f_log):
+        '''Decides what to do with the reads from each contig, writing one line per contig to the log.
+           Returns an ordered dict contig name => list of regions, in the order that reads are
+           written to the output file. Each region is None (meaning all reads from the contig)
+           or a tuple (start, end). Skipped contigs are not in the returned dict'''
+        plan = collections.OrderedDict()
 
         for contig in sorted(ref_lengths):
             if len(self.contigs_to_use) > 0 and contig not in self.contigs_to_use:
@@ -160,54 +226,233 @@ class BamFilter:
                     print('Skipping contig', contig, flush=True)
                 continue
 
+            if ref_lengths[contig] <= self.length_cutoff and not self.split_all_reads:
+                #OLD version, do not split reads so that SPAdes attempts to circulrize.
+                plan[contig] = [None]
+                print(self.log_prefix, contig, ref_lengths[contig], 'all', sep='\t', file=f_log)
+                if self.verbose:
+                    print('Getting all reads that map to contig', contig, flush=True)
+                continue
+
             if ref_lengths[contig] <= self.length_cutoff:
                 #NEW version: even for small contigs, split them in two halves, and split the reads mapping through the middle point of the contig in two, so that each piece maps to only one half.
-                if self.split_all_reads:
-                    end_bases_keep = int(0.5 * ref_lengths[contig])
-                    start = end_bases_keep - 1
-                    end = end_bases_keep #max(end_bases_keep - 1, ref_lengths[contig] - end_bases_keep)
-                    self._get_region(contig, 0, start, f_fa, min_length=self.min_read_length)
-                    self._get_region(contig, end, ref_lengths[contig], f_fa, min_length=self.min_read_length)
-                    coords_string = '1-' + str(start + 1) +  ';' + str(end + 1) + '-' + str(ref_lengths[contig])
-                    print(
-                        self.log_prefix,
-                        contig,
-                        ref_lengths[contig],
-                        coords_string,
-                        sep='\t',
-                        file=f_log
-                    )
-                    if self.verbose:
-                        print('Getting all reads that map to ends of contig ', contig, '. Coords: ', coords_string, sep='', flush=True)
-                else:
-                    #OLD version, do not split reads so that SPAdes attempts to circulrize.
-                    self._all_reads_from_contig(contig, f_fa)
-                    print(self.log_prefix, contig, ref_lengths[contig], 'all', sep='\t', file=f_log)
-                    if self.verbose:
-                        print('Getting all reads that map to contig', contig, flush=True)
-                    
+                end_bases_keep = int(0.5 * ref_lengths[contig])
+                start = end_bases_keep - 1
+                end = end_bases_keep
             else:
                 end_bases_keep = int(0.5 * self.length_cutoff)
                 start = end_bases_keep - 1
                 end = max(end_bases_keep - 1, ref_lengths[contig] - end_bases_keep)
-                self._get_region(contig, 0, start, f_fa, min_length=self.min_read_length)
-                self._get_region(contig, end, ref_lengths[contig], f_fa, min_length=self.min_read_length)
-                coords_string = '1-' + str(start + 1) +  ';' + str(end + 1) + '-' + str(ref_lengths[contig])
-                print(
-                    self.log_prefix,
-                    contig,
-                    ref_lengths[contig],
-                    coords_string,
-                    sep='\t',
-                    file=f_log
-                )
-                if self.verbose:
-                    print('Getting all reads that map to ends of contig ', contig, '. Coords: ', coords_string, sep='', flush=True)
+
+            plan[contig] = [(0, start), (end, ref_lengths[contig])]
+            coords_string = '1-' + str(start + 1) +  ';' + str(end + 1) + '-' + str(ref_lengths[contig])
+            print(
+                self.log_prefix,
+                contig,
+                ref_lengths[contig],
+                coords_string,
+                sep='\t',
+                file=f_log
+            )
+            if self.verbose:
+                print('Getting all reads that map to ends of contig ', contig, '. Coords: ', coords_string, sep='', flush=True)
+
+        return plan
+
+
+    def _write_contig_reads_using_fetch(self, plan, fout, sam_reader=None):
+        '''Writes reads from the contigs in the plan made by _make_contig_plan,
+           using one indexed fetch per region'''
+        for contig, regions in plan.items():
+            for region in regions:
+                if region is None:
+                    self._all_reads_from_contig(contig, fout, sam_reader=sam_reader)
+                else:
+                    self._get_region(contig, region[0], region[1], fout, min_length=self.min_read_length, sam_reader=sam_reader)
+
+
+    def _write_reads_using_fetch(self, plan, fout):
+        '''Writes reads following the plan made by _make_contig_plan, using one
+           indexed fetch per region, then a second pass through the file for the unmapped reads'''
+        self._write_contig_reads_using_fetch(plan, fout)
+
+        if not self.discard_unmapped:
+            if self.verbose:
+                print('Getting all unmapped reads', sep='', flush=True)
+            self._get_all_unmapped_reads(fout)
+
+
+    def _write_reads_single_pass(self, plan, fout):
+        '''Writes reads following the plan made by _make_contig_plan, reading through
+           the BAM file just once. Output is identical to _write_reads_using_fetch.
+           Reads from each contig are collected and written in the order of the plan, which is
+           not necessarily the order of the contigs in the BAM file. Contigs that
+           are finished before it is their turn to be written are held in temporary files'''
+        sam_reader = pysam.Samfile(self.bam, "rb")
+        contig_order = list(plan.keys())
+        next_to_write = 0
+        held = {}
+        done = set()
+        unmapped = tempfile.SpooledTemporaryFile(max_size=spool_max_size, mode='w+')
+        current_tid = -1
+        current_contig = None
+        current_regions = []
+        current_seqs = []
+
+        def write_seqs(seqs_lists, fh):
+            for seqs in seqs_lists:
+                self._write_records(seqs, fh)
+
+        def write_finished_contigs():
+            nonlocal next_to_write
+            while next_to_write < len(contig_order) and contig_order[next_to_write] in done:
+                name = contig_order[next_to_write]
+                if name in held:
+                    held[name].seek(0)
+                    shutil.copyfileobj(held[name], fout)
+                    held.pop(name).close()
+                next_to_write += 1
+
+        def finish_current_contig():
+            if current_contig in plan:
+                if contig_order[next_to_write] == current_contig:
+                    write_seqs(current_seqs, fout)
+                else:
+                    held[current_contig] = tempfile.SpooledTemporaryFile(max_size=spool_max_size, mode='w+')
+                    write_seqs(current_seqs, held[current_contig])
+
+            done.add(current_contig)
+            write_finished_contigs()
+
+        for read in sam_reader.fetch(until_eof=True):
+            if read.reference_id != current_tid:
+                if current_tid == -1 and current_contig is not None or 0 <= read.reference_id < current_tid:
+                    raise Error('Reads not sorted by reference in BAM file ' + self.bam + '. Cannot continue')
+
+                if current_contig is not None:
+                    finish_current_contig()
+
+                # BAM is sorted, so any contigs between the previous one and
+                # this one have no reads. Unmapped reads with no contig come last
+                next_tid = read.reference_id if read.reference_id >= 0 else len(sam_reader.references)
+                done.update(sam_reader.references[current_tid + 1:next_tid])
+                write_finished_contigs()
+                current_tid = read.reference_id
+                current_contig = read.reference_name if current_tid >= 0 else ''
+                current_regions = plan.get(current_contig, [])
+                current_seqs = [[] for x in current_regions]
+
+            if read.is_unmapped:
+                if not self.discard_unmapped:
+                    record = mapping.aligned_read_to_record(read, ignore_quality=not self.fastq_out)
+                    if next_to_write == len(contig_order) and unmapped.tell() == 0:
+                        fout.write(record)
+                    else:
+                        unmapped.write(record)
+
+                # fetch(contig) also returns unmapped reads that are placed on the contig,
+                # so they get written with the mapped reads as well
+                if current_regions == [None] and read.reference_id >= 0:
+                    current_seqs[0].append(mapping.aligned_read_to_record(read, ignore_quality=not self.fastq_out))
+                continue
+
+            for i, region in enumerate(current_regions):
+                if region is None:
+                    current_seqs[i].append(mapping.aligned_read_to_record(read, ignore_quality=not self.fastq_out))
+                elif read.pos < region[1] and max(read.reference_end, read.pos + 1) > region[0]:
+                    current_seqs[i].append(self._region_read_to_record(read, region[0], region[1], min_length=self.min_read_length))
+
+        if current_contig is not None:
+            finish_current_contig()
+
+        done.update(contig_order)
+        write_finished_contigs()
+        assert next_to_write == len(contig_order)
 
         if not self.discard_unmapped:
             if self.verbose:
                 print('Getting all unmapped reads', sep='', flush=True)
-            self._get_all_unmapped_reads(f_fa)
+            unmapped.seek(0)
+            shutil.copyfileobj(unmapped, fout)
+
+        unmapped.close()
+
+
+    def _use_single_pass(self, ref_lengths, plan):
+        '''Returns True if reads should be got by reading the BAM file in one pass,
+           or False if they should be got by fetching each region in the plan.
+           Uses self.single_pass if it is not None. Otherwise, reading in one
+           pass is chosen when the regions cover at least single_pass_min_fraction
+           of the total length of the reference sequences'''
+        if self.single_pass is not None:
+            return self.single_pass
+
+        wanted_length = 0
+        for contig, regions in plan.items():
+            for region in regions:
+                wanted_length += ref_lengths[contig] if region is None else region[1] - region[0]
+        return wanted_length >= single_pass_min_fraction * sum(ref_lengths.values())
+
+
+    def _write_reads_in_parallel(self, plan, fout):
+        '''Writes reads following the plan made by _make_contig_plan, using a pool of
+           self.threads processes. The contigs are split into shards, keeping their order
+           in the plan. Each shard is written to its own temporary file, and then these are
+           concatenated in the same order, so output is identical to _write_reads_using_fetch'''
+        tmpdir = tempfile.mkdtemp(prefix=self.reads_outfile + '.tmp.', dir=os.path.dirname(self.reads_outfile))
+        contigs = list(plan.keys())
+        shard_size = max(1, math.ceil(len(contigs) / (4 * self.threads)))
+        shards = []
+
+        for i in range(0, len(contigs), shard_size):
+            shard_plan = collections.OrderedDict((x, plan[x]) for x in contigs[i:i + shard_size])
+            shards.append((self, shard_plan, os.path.join(tmpdir, 'shard.' + str(len(shards)))))
+
+        if self.verbose:
+            print('Getting reads from', len(contigs), 'contigs in', len(shards), 'shards using', self.threads, 'processes', flush=True)
+
+        with multiprocessing.Pool(self.threads) as pool:
+            # getting the unmapped reads needs a pass through the whole
+            # BAM file, so start that first
+            if not self.discard_unmapped:
+                unmapped_result = pool.apply_async(_write_reads_shard, (self, None, os.path.join(tmpdir, 'unmapped')))
+
+            for filename in pool.starmap(_write_reads_shard, shards):
+                with open(filename) as f:
+                    shutil.copyfileobj(f, fout)
+                os.unlink(filename)
+
+            if not self.discard_unmapped:
+                if self.verbose:
+                    print('Getting all unmapped reads', sep='', flush=True)
+                filename = unmapped_result.get()
+                with open(filename) as f:
+                    shutil.copyfileobj(f, fout)
+                os.unlink(filename)
+
+        os.rmdir(tmpdir)
+
+
+    def run(self):
+        ref_lengths = self._get_ref_lengths()
+        assert len(ref_lengths) > 0
+        f_log = pyfastaq.utils.open_file_write(self.log)
+        if self.compress is None:
+            f_fa = pyfastaq.utils.open_file_write(self.reads_outfile)
+        else:
+            f_fa = bgzf.Writer(self.reads_outfile, file_format=self.compress, level=self.compress_level, threads=self.threads)
+        print(self.log_prefix, '#contig', 'length', 'reads_kept', sep='\t', file=f_log)
+        if self.verbose:
+            print('Getting reads from BAM file', self.bam, flush=True)
+
+        plan = self._make_contig_plan(ref_lengths, f_log)
+
+        if self.threads > 1:
+            self._write_reads_in_parallel(plan, f_fa)
+        elif self._use_single_pass(ref_lengths, plan):
+            self._write_reads_single_pass(plan, f_fa)
+        else:
+            self._write_reads_using_fetch(plan, f_fa)
 
         pyfastaq.utils.close(f_fa)
         pyfastaq.utils.close(f_log)
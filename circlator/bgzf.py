@@ -0,0 +1,121 @@
+import collections
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+class Error (Exception): pass
+
+allowed_formats = ['bgzip', 'gzip']
+
+# Max number of uncompressed bytes in one BGZF block. This is what bgzip uses,
+# chosen so that a block is never bigger than 64KB, even if it does not compress
+bgzf_block_size = 0xff00
+
+# BGZF files end with this empty block, so that readers can tell the file is complete
+bgzf_eof = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+# size of each gzip member when writing plain gzip
+gzip_member_size = 1048576
+
+
+def _deflate(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _bgzf_block(data, level):
+    '''Returns BGZF block (a gzip member with the block size in the extra field) of data'''
+    compressed = _deflate(data, level)
+    header = struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(compressed) + 25)
+    return header + compressed + struct.pack('<2I', zlib.crc32(data), len(data))
+
+
+def _gzip_member(data, level):
+    '''Returns gzip member containing data'''
+    header = struct.pack('<4BI2B', 31, 139, 8, 0, 0, 0, 255)
+    return header + _deflate(data, level) + struct.pack('<2I', zlib.crc32(data), len(data))
+
+
+class Writer:
+    '''Text file object for writing gzip or BGZF (bgzip) compressed files.
+       The file is made of independent blocks, so they are compressed by a
+       pool of threads (zlib does not hold the GIL while it compresses).
+       Either way the output can be read by anything that reads gzip files'''
+    def __init__(self, filename, file_format='bgzip', level=6, threads=1):
+        if file_format not in allowed_formats:
+            raise Error('Unknown compression format "' + str(file_format) + '". Must be one of: ' + ', '.join(allowed_formats))
+        if not 0 <= level <= 9:
+            raise Error('Compression level must be from 0 to 9. Got: ' + str(level))
+
+        self.name = filename
+        self.level = level
+        self.threads = threads
+        if file_format == 'bgzip':
+            self._make_block = _bgzf_block
+            self._block_size = bgzf_block_size
+        else:
+            self._make_block = _gzip_member
+            self._block_size = gzip_member_size
+        self._file_format = file_format
+        self._fh = open(filename, 'wb')
+        self._buffer = []
+        self._buffer_size = 0
+        self._blocks_written = 0
+        self._pending = collections.deque()
+        self._pool = ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+        self.closed = False
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def _write_block(self, data):
+        if self._pool is None:
+            self._fh.write(self._make_block(data, self.level))
+        else:
+            self._pending.append(self._pool.submit(self._make_block, data, self.level))
+            while len(self._pending) > 2 * self.threads:
+                self._fh.write(self._pending.popleft().result())
+        self._blocks_written += 1
+
+
+    def _write_buffer(self, final=False):
+        data = b''.join(self._buffer)
+        end = len(data) if final else len(data) - len(data) % self._block_size
+        for i in range(0, end, self._block_size):
+            self._write_block(data[i:i + self._block_size])
+        self._buffer = [data[end:]] if end < len(data) else []
+        self._buffer_size = len(data) - end
+
+
+    def write(self, s):
+        data = s.encode()
+        self._buffer.append(data)
+        self._buffer_size += len(data)
+        if self._buffer_size >= self._block_size * max(1, self.threads):
+            self._write_buffer()
+        return len(s)
+
+
+    def close(self):
+        if self.closed:
+            return
+
+        self._write_buffer(final=True)
+        if self._file_format == 'gzip' and self._blocks_written == 0:
+            self._write_block(b'')
+
+        while len(self._pending):
+            self._fh.write(self._pending.popleft().result())
+
+        if self._pool is not None:
+            self._pool.shutdown()
+        if self._file_format == 'bgzip':
+            self._fh.write(bgzf_eof)
+        self._fh.close()
+        self.closed = True
@@ -0,0 +1,183 @@
+import os
+import fcntl
+import shutil
+import hashlib
+import tempfile
+import contextlib
+
+class Error (Exception): pass
+
+
+def file_hash(filename, h=None):
+    '''Returns sha256 hex digest of the contents of a file. If h is given, the file
+       contents are added to that hashlib object and its hex digest is returned'''
+    if h is None:
+        h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1048576), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class Cache:
+    '''Directory of cached results. Each result is a subdirectory, named after a
+       sha256 hex digest of whatever was used to make it. Results are locked (with
+       flock) while they are made and used, so more than one circlator can share
+       the directory. When the total size is more than max_size_gb, the least
+       recently used results are deleted'''
+    def __init__(self, directory, max_size_gb):
+        self.directory = os.path.abspath(directory)
+        self.max_size = int(max_size_gb * 1024 ** 3)
+        os.makedirs(self.directory, exist_ok=True)
+
+
+    @staticmethod
+    def _dir_size(path):
+        size = 0
+        for root, dirs, files in os.walk(path):
+            size += sum(os.path.getsize(os.path.join(root, x)) for x in files)
+        return size
+
+
+    def _entries(self):
+        '''Returns list of (last used time, size in bytes, key) of all the results in the cache'''
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if len(name) != 64 or not os.path.isdir(path):
+                continue
+            try:
+                entries.append((os.path.getmtime(path), self._dir_size(path), name))
+            except FileNotFoundError:
+                pass
+        return entries
+
+
+    def _lock_filename(self, key):
+        return os.path.join(self.directory, key + '.lock')
+
+
+    def _lock(self, key, operation):
+        '''Returns the lock file of the result called key, opened and locked with
+           flock operation. Lock files of results that are not in the cache are
+           deleted by _evict, so this checks that the file that was locked was not
+           deleted first. Raises BlockingIOError if operation is non-blocking and
+           the file is locked by another process'''
+        while True:
+            lock = open(self._lock_filename(key), 'a')
+            try:
+                fcntl.flock(lock, operation)
+            except:
+                lock.close()
+                raise
+            if self._lock_is_current(lock, key):
+                return lock
+            lock.close()
+
+
+    def _lock_is_current(self, lock, key):
+        '''Returns True iff the open file lock is the lock file of key, not one that was deleted'''
+        try:
+            current = os.stat(self._lock_filename(key))
+        except FileNotFoundError:
+            return False
+        opened = os.fstat(lock.fileno())
+        return (opened.st_dev, opened.st_ino) == (current.st_dev, current.st_ino)
+
+
+    def _remove_stale_files(self):
+        '''Deletes temporary directories left by make() calls that did not finish
+           (eg because the process was killed), and the lock files of results that
+           are not in the cache. Skips any that are locked by another process'''
+        names = os.listdir(self.directory)
+        tmp_dirs = {}
+        for name in names:
+            if len(name) > 69 and name[64:69] == '.tmp.':
+                tmp_dirs.setdefault(name[:64], []).append(name)
+        lock_keys = {x[:64] for x in names if len(x) == 69 and x.endswith('.lock')}
+
+        for key in sorted(lock_keys.union(tmp_dirs)):
+            if key in lock_keys and os.path.exists(os.path.join(self.directory, key)) and key not in tmp_dirs:
+                continue
+            try:
+                lock = self._lock(key, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            with lock:
+                for name in tmp_dirs.get(key, []):
+                    shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+                if not os.path.exists(os.path.join(self.directory, key)):
+                    os.unlink(self._lock_filename(key))
+
+
+    def _evict(self, keep):
+        '''Deletes least recently used results (except the one called keep, and any in
+           use by other processes) until the cache is not bigger than self.max_size.
+           Also deletes stale files (see _remove_stale_files)'''
+        with open(os.path.join(self.directory, 'evict.lock'), 'a') as evict_lock:
+            fcntl.flock(evict_lock, fcntl.LOCK_EX)
+            self._remove_stale_files()
+            entries = sorted(self._entries())
+            total_size = sum(x[1] for x in entries)
+
+            for last_used, size, name in entries:
+                if total_size <= self.max_size:
+                    break
+                if name == keep:
+                    continue
+
+                try:
+                    lock = self._lock(name, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                with lock:
+                    shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+                    os.unlink(self._lock_filename(name))
+                    total_size -= size
+
+
+    @contextlib.contextmanager
+    def get(self, key, make, verbose=False):
+        '''Context manager that gives the directory of the result called key. If it is
+           not already in the cache, it is made by calling make(directory), which must
+           make the result in the given (empty, temporary) directory. The result will not
+           be deleted by another process until the context is exited'''
+        if len(key) != 64:
+            raise Error('Cache key must be a sha256 hex digest. Got: ' + key)
+
+        result_dir = os.path.join(self.directory, key)
+
+        while True:
+            lock = self._lock(key, fcntl.LOCK_EX)
+            try:
+                if os.path.exists(result_dir):
+                    if verbose:
+                        print('Using cached result', result_dir, flush=True)
+                else:
+                    tmp_dir = tempfile.mkdtemp(prefix=key + '.tmp.', dir=self.directory)
+                    try:
+                        make(tmp_dir)
+                        os.rename(tmp_dir, result_dir)
+                    finally:
+                        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+                os.utime(result_dir)
+                # Other processes can use the result, but not delete it, while we
+                # have a shared lock. Changing the lock type is not atomic, so check
+                # that the result (and its lock file) was not deleted while it happened
+                fcntl.flock(lock, fcntl.LOCK_SH)
+            except:
+                lock.close()
+                raise
+            if os.path.exists(result_dir) and self._lock_is_current(lock, key):
+                break
+            lock.close()
+
+        with lock:
+            self._evict(key)
+            yield result_dir
+
+
+    def contains(self, key):
+        '''Returns True iff the result called key is in the cache'''
+        return os.path.exists(os.path.join(self.directory, key))
@@ -1,8 +1,10 @@
 import os
 import shutil
+import itertools
 import tempfile
 import pymummer
 import pyfastaq
+from circlator import hits, runner
 
 class Error (Exception): pass
 
@@ -76,7 +78,13 @@ class Cleaner:
             simplify=False,
             verbose=self.verbose
         )
-        n.run()
+        with runner.timed('nucmer'):
+            n.run()
+
+
+    def _load_hit_table(self, infile):
+        '''Returns a hits.HitTable of the nucmer hits in infile, ignoring self matches'''
+        return hits.HitTable.from_coords_file(infile, skip_self_hits=True)
 
 
     def _load_nucmer_hits(self, infile):
@@ -84,18 +92,8 @@ class Cleaner:
            1) name=>contig length.
            2) Second is dictionary of nucmer hits (ignoring self matches).
               contig name => list of hits'''
-        hits = {}
-        lengths = {}
-        file_reader = pymummer.coords_file.reader(infile)
-        for al in file_reader:
-            if al.qry_name == al.ref_name:
-                continue
-            elif al.qry_name not in hits:
-                hits[al.qry_name] = []
-            hits[al.qry_name].append(al)
-            lengths[al.qry_name] = al.qry_length
-            lengths[al.ref_name] = al.ref_length
-        return lengths, hits
+        hit_table = self._load_hit_table(infile)
+        return hit_table.lengths(), hit_table.group_by('qry_name')
 
 
     def _contains(self, hit):
@@ -115,6 +113,31 @@ class Cleaner:
         return {hit.ref_name for hit in hits if self._contains(hit)}
 
 
+    def _contains_mask(self, hit_table):
+        '''Same as self._contains(), but for every hit in a hits.HitTable at once.
+           Returns a mask of the hits in the table'''
+        return bytearray(
+            w & x & y & z
+            for w, x, y, z in zip(
+                hit_table.qry_not_in(self.contigs_to_keep),
+                hit_table.different_names(),
+                hit_table.min_qry_percent(self.min_contig_percent_match),
+                hit_table.min_percent_identity(self.nucmer_min_id),
+            )
+        )
+
+
+    def _get_containing_contigs_from_table(self, hit_table):
+        '''Same as self._get_containing_contigs(), but using a hits.HitTable
+           (made by self._load_hit_table()) instead of a dictionary of hits'''
+        containing = {}
+        names = hit_table.names
+        mask = self._contains_mask(hit_table)
+        for qry_id, ref_id in itertools.compress(zip(hit_table.qry_id, hit_table.ref_id), mask):
+            containing.setdefault(names[qry_id], set()).add(names[ref_id])
+        return containing
+
+
     def _get_containing_contigs(self, hits_dict):
         '''Given dictionary of nucmer hits (made by self._load_nucmer_hits()), returns a dictionary.
            key=contig name. Value = set of contigs that contain the key.'''
@@ -128,58 +151,127 @@ class Cleaner:
         return containing
 
 
-    def _get_all_containing(self, containing_contigs, name, exclude=None, max_depth=10):
+    @staticmethod
+    def _strongly_connected_components(graph):
+        '''graph is a dict: node => set of nodes it has an edge to. Returns list of
+           the strongly connected components (each one a list of nodes), using
+           Tarjan's algorithm. A component comes after all the components that
+           it has a path to'''
+        index = {}
+        lowlink = {}
+        stack = []
+        on_stack = set()
+        components = []
+
+        for start in graph:
+            if start in index:
+                continue
+
+            # iterative depth first search, so that long chains of contigs
+            # do not hit python's recursion limit
+            index[start] = lowlink[start] = len(index)
+            stack.append(start)
+            on_stack.add(start)
+            to_visit = [(start, iter(graph.get(start, ())))]
+
+            while len(to_visit):
+                node, children = to_visit[-1]
+                for child in children:
+                    if child not in index:
+                        index[child] = lowlink[child] = len(index)
+                        stack.append(child)
+                        on_stack.add(child)
+                        to_visit.append((child, iter(graph.get(child, ()))))
+                        break
+                    elif child in on_stack:
+                        lowlink[node] = min(lowlink[node], index[child])
+                else:
+                    to_visit.pop()
+                    if len(to_visit):
+                        parent = to_visit[-1][0]
+                        lowlink[parent] = min(lowlink[parent], lowlink[node])
+
+                    if lowlink[node] == index[node]:
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            on_stack.remove(member)
+                            component.append(member)
+                            if member == node:
+                                break
+                        components.append(component)
+
+        return components
+
+
+    def _get_all_containing(self, containing_contigs):
         '''containing_contigs is a dict:
              key=contig name. Value = set of contigs that contain the key.
-           Returns alls contigs called "name" that contain that contig'''
-        contains_name = set()
-		
-        # failsafe to prevent infinite recursion
-        if max_depth < 0:
-            return contains_name
-		
-        if name in containing_contigs:
-            for containing_contig in containing_contigs[name]:
-                # if we have a contains b and b contains a, then this stops infinite recursion
-                if containing_contig==exclude:
-                    continue
-                contains_name.add(containing_contig)
-                new_names = self._get_all_containing(containing_contigs, containing_contig, exclude=name,max_depth=max_depth-1)
-                new_names.discard(name)
-                contains_name.update(new_names)
-        return contains_name
+           Returns a dict with the same keys. Value = set of all contigs that
+           contain the key, directly or via any number of other contigs.
+           The key is only in its own set if it directly contains itself'''
+        # Contigs that contain each other (a cycle in the graph) all have
+        # the same containing contigs, so work out one set for each strongly
+        # connected component. Components come after the ones they point to,
+        # so each one can use the sets already made for them.
+        reachable = {}
+        for component in self._strongly_connected_components(containing_contigs):
+            members = set(component)
+            nodes = set(component) if len(component) > 1 else set()
+            for node in component:
+                for child in containing_contigs.get(node, ()):
+                    if child not in members and child not in nodes:
+                        nodes.add(child)
+                        nodes.update(reachable[child])
+            for node in component:
+                reachable[node] = nodes
+
+        return {name: reachable[name] - {name} | (containing_contigs[name] & {name}) for name in containing_contigs}
 
 
     def _expand_containing_using_transitivity(self, containing_contigs):
         '''This uses a contined in b, and b contained in c to force a contained in c.
            Just in case a contained in c wasn't already found by nucmer'''
+        all_containing = self._get_all_containing(containing_contigs)
         for name in containing_contigs:
-            containing_contigs[name] = self._get_all_containing(containing_contigs, name)
+            containing_contigs[name] = all_containing[name]
         return containing_contigs
 
 
     def _collapse_list_of_sets(self, sets):
-        '''Input is a list of sets. Merges any intersecting sets in the list'''
-        found = True
-        while found:
-            found = False
-            to_intersect = None
-            for i in range(len(sets)):
-                for j in range(len(sets)):
-                    if i == j:
-                        continue
-                    elif sets[i].intersection(sets[j]):
-                        to_intersect = i, j
-                        break
-
-                if to_intersect is not None:
-                    break
-
-            if to_intersect is not None:
-                found = True
-                sets[i].update(sets[j])
-                sets.pop(j)
+        '''Input is a list of sets. Merges any intersecting sets in the list.
+           Each group of merged sets ends up in the first set of the group,
+           and the groups stay in the same order as their first sets'''
+        # disjoint-set forest of the indexes of the sets, where the root of each
+        # tree is the smallest index in it
+        parent = list(range(len(sets)))
+
+        def find(i):
+            root = i
+            while parent[root] != root:
+                root = parent[root]
+            while parent[i] != root:
+                parent[i], i = root, parent[i]
+            return root
+
+        first_set_with_element = {}
+        for i, s in enumerate(sets):
+            for element in s:
+                j = first_set_with_element.setdefault(element, i)
+                if j != i:
+                    root_i, root_j = find(i), find(j)
+                    if root_i != root_j:
+                        parent[max(root_i, root_j)] = min(root_i, root_j)
+
+        roots = []
+        for i in range(len(sets)):
+            root = find(i)
+            if root == i:
+                roots.append(i)
+            else:
+                sets[root].update(sets[i])
 
+        sets[:] = [sets[i] for i in roots]
         return sets
 
 
@@ -198,9 +290,8 @@ class Cleaner:
 
             if len(equivalent):
                 equivalent_contigs.append(equivalent)
-                equivalent_contigs = self._collapse_list_of_sets(equivalent_contigs)
 
-        return equivalent_contigs
+        return self._collapse_list_of_sets(equivalent_contigs)
 
 
     def _longest_contig(self, contig_set, contig_lengths):
@@ -289,8 +380,10 @@ class Cleaner:
         names_all, names_small = self._remove_small_contigs(self.infile, removed_small_file, keep=self.contigs_to_keep)
         nucmer_coords_file = self.outprefix + '.coords'
         self._run_nucmer(removed_small_file, nucmer_coords_file)
-        contig_lengths, nucmer_hits = self._load_nucmer_hits(nucmer_coords_file)
-        containing_contigs = self._get_containing_contigs(nucmer_hits)
+        hit_table = self._load_hit_table(nucmer_coords_file)
+        contig_lengths = hit_table.lengths()
+        containing_contigs = self._get_containing_contigs_from_table(hit_table)
+        del hit_table
         if self.verbose and len(containing_contigs) > 0:
             print('\nContig\tContained in')
             for x in containing_contigs:
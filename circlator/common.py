@@ -1,29 +1,30 @@
 import sys
 import os
+import shlex
 import subprocess
+from circlator import runner
 
 class Error (Exception): pass
 
 allowed_assemblers = ['canu', 'spades'] 
 allowed_data_types = ['pacbio-raw', 'pacbio-corrected', 'nanopore-raw', 'nanopore-corrected']
 
-def syscall(cmd, allow_fail=False, verbose=False):
-    if verbose:
-        print('syscall:', cmd, flush=True)
-    try:
-        subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError as error:
-        errors = error.output.decode()
-        if allow_fail:
-            return False, errors
-        else:
-            print('The following command failed with exit code', error.returncode, file=sys.stderr)
-            print(cmd, file=sys.stderr)
-            print('\nThe output was:\n', file=sys.stderr)
-            print(errors, file=sys.stderr, flush=True)
-            sys.exit(1)
-
-    return True, None
+def syscall(cmd, allow_fail=False, verbose=False, name=None):
+    '''Runs cmd using runner.run. Returns (True, None) if it worked. Otherwise
+       returns (False, end of the output) if allow_fail is True, or exits'''
+    metrics = runner.run(cmd, name=name, allow_fail=True, verbose=verbose)
+    if metrics['status'] == 'ok':
+        return True, None
+    elif allow_fail:
+        return False, metrics['output']
+    else:
+        print('The following command failed (' + metrics['status'] + ') with exit code', metrics['returncode'], file=sys.stderr)
+        print(cmd, file=sys.stderr)
+        if metrics['log_file'] is not None:
+            print('\nThe output is in the file', metrics['log_file'], file=sys.stderr)
+        print('\nThe end of the output was:\n', file=sys.stderr)
+        print(metrics['output'], file=sys.stderr, flush=True)
+        sys.exit(1)
 
 
 def syscall_get_stdout(cmd):
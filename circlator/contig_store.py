@@ -0,0 +1,200 @@
+import io
+import os
+import mmap
+import collections.abc
+import pyfastaq
+
+class Error (Exception): pass
+
+# the bytes that can be in a sequence that is indexed. Other sequences (eg with
+# spaces, windows line endings or unicode) are read into memory instead
+_indexable_bytes = bytes(range(ord('!'), ord('~') + 1)) + b'\n'
+
+# number of lines of a sequence checked at once when it is indexed
+_lines_per_chunk = 65536
+
+
+def _sequence_layout(mm, start, end):
+    '''Returns tuple (length, line_bases, line_width) of the sequence in mm[start:end],
+       which must not end with a newline, like the columns of a samtools faidx index.
+       Returns None if the sequence cannot be indexed, because its lines are not all
+       the same length or it has characters that pyfastaq would change'''
+    first_newline = mm.find(b'\n', start, end)
+    line_bases = end - start if first_newline == -1 else first_newline - start
+    if line_bases == 0:
+        return None
+
+    line_width = line_bases + 1
+    chunk_size = line_width * _lines_per_chunk
+    for chunk_start in range(start, end, chunk_size):
+        chunk = mm[chunk_start:min(end, chunk_start + chunk_size)]
+        if len(chunk.translate(None, _indexable_bytes)):
+            return None
+        line_ends = chunk[line_width - 1::line_width]
+        if line_ends.count(b'\n') != len(line_ends) or chunk.count(b'\n') != len(line_ends):
+            return None
+
+    return end - start - (end - start) // line_width, line_bases, line_width
+
+
+class Contig(pyfastaq.sequences.Fasta):
+    '''A sequence in a ContigStore. Behaves like pyfastaq.sequences.Fasta, but the
+       bases are only read from the file when they are used. Slicing only
+       reads the bases in the slice. Changing the sequence (eg with revcomp)
+       keeps the new sequence in memory, and the file is not changed'''
+    def __init__(self, store, name, length, offset, line_bases, line_width):
+        self.id = name
+        self._store = store
+        self._length = length
+        self._offset = offset
+        self._line_bases = line_bases
+        self._line_width = line_width
+        self._seq = None
+
+
+    @property
+    def seq(self):
+        if self._seq is None:
+            return self._read(0, self._length)
+        return self._seq
+
+
+    @seq.setter
+    def seq(self, value):
+        self._seq = value
+
+
+    def _file_position(self, position):
+        return self._offset + (position // self._line_bases) * self._line_width + position % self._line_bases
+
+
+    def _read(self, start, end):
+        '''Returns the bases from start to end (zero-based, end not included) from the file'''
+        if end <= start:
+            return ''
+        data = self._store._mmap[self._file_position(start):self._file_position(end - 1) + 1]
+        if len(data) != end - start:
+            data = data.replace(b'\n', b'')
+        return data.decode('ascii')
+
+
+    def __eq__(self, other):
+        return isinstance(other, pyfastaq.sequences.Fasta) \
+           and not isinstance(other, pyfastaq.sequences.Fastq) \
+           and self.id == other.id \
+           and self.seq == other.seq
+
+
+    def __len__(self):
+        if self._seq is None:
+            return self._length
+        return len(self._seq)
+
+
+    def __getitem__(self, index):
+        if self._seq is not None:
+            return self._seq[index]
+        elif isinstance(index, slice):
+            start, end, step = index.indices(self._length)
+            if step != 1:
+                return self.seq[index]
+            return self._read(start, end)
+        else:
+            if index < 0:
+                index += self._length
+            if not 0 <= index < self._length:
+                raise IndexError('string index out of range')
+            return self._read(index, index + 1)
+
+
+    def subseq(self, start, end):
+        return pyfastaq.sequences.Fasta(self.id, self[start:end])
+
+
+    def __str__(self):
+        return str(pyfastaq.sequences.Fasta(self.id, self.seq))
+
+
+class ContigStore(collections.abc.MutableMapping):
+    '''Dictionary of contig name -> sequence, the same as pyfastaq.tasks.file_to_dict
+       makes, but the FASTA file is memory-mapped and indexed like samtools faidx
+       instead of loaded into memory. The values are Contigs, which only read
+       their bases when they are used. Adding or changing contigs only changes
+       the dictionary, never the file, so the file must not be changed
+       while the store is in use'''
+    def __init__(self, filename):
+        if not os.path.exists(filename):
+            raise Error('File not found: ' + filename)
+        self.filename = os.path.abspath(filename)
+        self._contigs = {}
+        self._mmap = self._open_mmap()
+        if self._mmap is None:
+            return
+
+        if self._mmap[:1] != b'>':
+            # compressed, or not FASTA, so let pyfastaq deal with it
+            pyfastaq.tasks.file_to_dict(self.filename, self._contigs)
+            return
+
+        header_start = 0
+        while header_start != -1:
+            header_end = self._mmap.find(b'\n', header_start)
+            if header_end == -1:
+                header_end = len(self._mmap)
+            next_header = self._mmap.find(b'\n>', header_end)
+            seq_end = len(self._mmap) if next_header == -1 else next_header
+            while seq_end > header_end and self._mmap[seq_end - 1] == 10:
+                seq_end -= 1
+
+            name = self._mmap[header_start + 1:header_end].decode().rstrip()
+            seq_start = min(header_end + 1, seq_end)
+            layout = _sequence_layout(self._mmap, seq_start, seq_end)
+            if layout is None:
+                lines = io.StringIO(self._mmap[seq_start:seq_end].decode(), newline=None)
+                self._contigs[name] = pyfastaq.sequences.Fasta(name, ''.join(x.rstrip() for x in lines))
+            else:
+                self._contigs[name] = Contig(self, name, layout[0], seq_start, layout[1], layout[2])
+
+            header_start = next_header if next_header == -1 else next_header + 1
+
+
+    def _open_mmap(self):
+        if os.path.getsize(self.filename) == 0:
+            return None
+        with open(self.filename, 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_mmap']
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._mmap = self._open_mmap()
+
+
+    def __getitem__(self, name):
+        return self._contigs[name]
+
+
+    def __setitem__(self, name, contig):
+        self._contigs[name] = contig
+
+
+    def __delitem__(self, name):
+        del self._contigs[name]
+
+
+    def __contains__(self, name):
+        return name in self._contigs
+
+
+    def __iter__(self):
+        return iter(self._contigs)
+
+
+    def __len__(self):
+        return len(self._contigs)
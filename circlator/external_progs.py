@@ -1,9 +1,7 @@
 import re
 import sys
 from circlator import program, common
-from circlator import __version__ as circlator_version
 import shutil
-import pyfastaq
 
 class Error (Exception): pass
 
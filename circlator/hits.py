@@ -0,0 +1,419 @@
+import array
+import itertools
+import re
+import pyfastaq
+
+class Error (Exception): pass
+
+
+# the numeric fields of a hit, in the order of the columns of show-coords -dTlro
+int_columns = [
+    'ref_start',
+    'ref_end',
+    'qry_start',
+    'qry_end',
+    'hit_length_ref',
+    'hit_length_qry',
+    'ref_length',
+    'qry_length',
+    'frame',
+]
+
+columns = int_columns[:6] + ['percent_identity'] + int_columns[6:] + ['ref_name', 'qry_name']
+
+# matches the optional tags at the end of a line of show-coords, eg [IDENTITY]
+_tags_regex = re.compile(r'\t\[[^\t\n]*\]')
+
+
+def _parse_line(line):
+    '''Returns tuple of the values of the columns from a line of show-coords -dTlro
+       (nucmer or promer). Coordinates are zero-based, as in pymummer'''
+    fields = line.rstrip().split('\t')
+    try:
+        if len(fields) >= 15:  # promer has extra columns
+            lengths = fields[9:12]
+            names = fields[13:15]
+        else:
+            lengths = fields[7:10]
+            names = fields[11:13]
+
+        return (
+            int(fields[0]) - 1,
+            int(fields[1]) - 1,
+            int(fields[2]) - 1,
+            int(fields[3]) - 1,
+            int(fields[4]),
+            int(fields[5]),
+            float(fields[6]),
+            int(lengths[0]),
+            int(lengths[1]),
+            int(lengths[2]),
+            names[0],
+            names[1],
+        )
+    except (IndexError, ValueError):
+        raise Error('Error reading this nucmer line:\n' + line)
+
+
+def _coords_lines(filename):
+    '''Yields the lines of a coords file that are hits, skipping any header lines'''
+    f = pyfastaq.utils.open_file_read(filename)
+    for line in f:
+        if line.startswith('[') or '\t' not in line:
+            continue
+        yield line
+    pyfastaq.utils.close(f)
+
+
+class Hit:
+    '''One nucmer/promer hit. Has the same attributes and methods as
+       pymummer.alignment.Alignment that circlator uses, but uses __slots__
+       so that it is much smaller'''
+    __slots__ = columns
+
+    def __init__(self, ref_start, ref_end, qry_start, qry_end, hit_length_ref, hit_length_qry, percent_identity, ref_length, qry_length, frame, ref_name, qry_name):
+        self.ref_start = ref_start
+        self.ref_end = ref_end
+        self.qry_start = qry_start
+        self.qry_end = qry_end
+        self.hit_length_ref = hit_length_ref
+        self.hit_length_qry = hit_length_qry
+        self.percent_identity = percent_identity
+        self.ref_length = ref_length
+        self.qry_length = qry_length
+        self.frame = frame
+        self.ref_name = ref_name
+        self.qry_name = qry_name
+
+
+    @classmethod
+    def from_coords_line(cls, line):
+        return cls(*_parse_line(line))
+
+
+    def _values(self):
+        return tuple(getattr(self, x) for x in columns)
+
+
+    def __eq__(self, other):
+        # Compares the values, so that a Hit is equal to a pymummer Alignment
+        # of the same line
+        try:
+            return self._values() == tuple(getattr(other, x) for x in columns)
+        except AttributeError:
+            return NotImplemented
+
+
+    def __hash__(self):
+        # same as pymummer.alignment.Alignment
+        return hash(self._values())
+
+
+    def __str__(self):
+        return '\t'.join([
+            str(self.ref_start + 1),
+            str(self.ref_end + 1),
+            str(self.qry_start + 1),
+            str(self.qry_end + 1),
+            str(self.hit_length_ref),
+            str(self.hit_length_qry),
+            '{0:.2f}'.format(self.percent_identity),
+            str(self.ref_length),
+            str(self.qry_length),
+            str(self.frame),
+            self.ref_name,
+            self.qry_name,
+        ])
+
+
+    def __repr__(self):
+        return 'Hit(' + ', '.join(repr(x) for x in self._values()) + ')'
+
+
+    def ref_coords(self):
+        return pyfastaq.intervals.Interval(min(self.ref_start, self.ref_end), max(self.ref_start, self.ref_end))
+
+
+    def qry_coords(self):
+        return pyfastaq.intervals.Interval(min(self.qry_start, self.qry_end), max(self.qry_start, self.qry_end))
+
+
+    def on_same_strand(self):
+        return (self.ref_start < self.ref_end) == (self.qry_start < self.qry_end)
+
+
+def reader(filename):
+    '''Yields a Hit for each line of a coords file. Same as pymummer.coords_file.reader,
+       but gives Hits instead of pymummer Alignments'''
+    for line in _coords_lines(filename):
+        yield Hit.from_coords_line(line)
+
+
+class HitTable:
+    '''Table of nucmer/promer hits, stored in columns (one array per field).
+       Each contig name is only stored once. Uses much less memory than a list
+       of pymummer Alignments, and the filters (the methods that return a mask)
+       work on whole columns at once. A mask is a bytearray with a 1 for each
+       hit that passes the filter'''
+    def __init__(self):
+        self.names = []
+        self.name_ids = {}
+        for column in int_columns:
+            setattr(self, column, array.array('q'))
+        self.percent_identity = array.array('d')
+        self.ref_id = array.array('l')
+        self.qry_id = array.array('l')
+
+
+    @classmethod
+    def from_coords_file(cls, filename, skip_self_hits=False, chunk_size=10000):
+        '''Loads a coords file, chunk_size lines at a time. If skip_self_hits is True,
+           hits of a contig to itself are not loaded'''
+        return cls.from_coords_lines(_coords_lines(filename), skip_self_hits=skip_self_hits, chunk_size=chunk_size)
+
+
+    @classmethod
+    def from_coords_lines(cls, lines, skip_self_hits=False, chunk_size=10000):
+        '''Same as from_coords_file, but from an iterable of the hit lines of a
+           coords file (each ending with a newline), without any header lines'''
+        table = cls()
+        lines = iter(lines)
+        while True:
+            chunk = list(itertools.islice(lines, chunk_size))
+            if len(chunk) == 0:
+                break
+            table._extend_from_lines(chunk, skip_self_hits=skip_self_hits)
+        return table
+
+
+    def _extend_from_lines(self, lines, skip_self_hits=False):
+        '''Adds the hits in a list of lines of a coords file'''
+        # Parse whole columns at once, which is faster than one line at a time:
+        # without the tags at the end of the lines, nucmer lines have 13 fields,
+        # so field i of every line is fields[i::13]. Anything else (eg promer, or
+        # a bad line) is done one line at a time
+        text = ''.join(lines)
+        if '[' in text:
+            text = _tags_regex.sub('', text)
+        fields = text.split()
+        try:
+            if len(fields) != 13 * len(lines):
+                raise ValueError
+            new_columns = [list(map(int, fields[i::13])) for i in (0, 1, 2, 3, 4, 5, 7, 8, 9)]
+            new_columns.insert(6, list(map(float, fields[6::13])))
+        except ValueError:
+            for line in lines:
+                values = _parse_line(line)
+                if not (skip_self_hits and values[10] == values[11]):
+                    self.append(values)
+            return
+
+        new_columns += [fields[11::13], fields[12::13]]
+        if skip_self_hits:
+            keep = [x != y for x, y in zip(new_columns[10], new_columns[11])]
+            new_columns = [list(itertools.compress(x, keep)) for x in new_columns]
+
+        for column, values in zip(columns[:10], new_columns):
+            if column in {'ref_start', 'ref_end', 'qry_start', 'qry_end'}:
+                values = map((-1).__add__, values)
+            getattr(self, column).extend(values)
+
+        name_ids = self.name_ids
+        self.ref_id.extend([name_ids.setdefault(x, len(name_ids)) for x in new_columns[10]])
+        self.qry_id.extend([name_ids.setdefault(x, len(name_ids)) for x in new_columns[11]])
+        self.names.extend(list(name_ids)[len(self.names):])
+
+
+    def __len__(self):
+        return len(self.ref_id)
+
+
+    def __getitem__(self, i):
+        return Hit(
+            self.ref_start[i],
+            self.ref_end[i],
+            self.qry_start[i],
+            self.qry_end[i],
+            self.hit_length_ref[i],
+            self.hit_length_qry[i],
+            self.percent_identity[i],
+            self.ref_length[i],
+            self.qry_length[i],
+            self.frame[i],
+            self.names[self.ref_id[i]],
+            self.names[self.qry_id[i]],
+        )
+
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+    def _name_id(self, name):
+        name_id = self.name_ids.get(name)
+        if name_id is None:
+            name_id = self.name_ids[name] = len(self.names)
+            self.names.append(name)
+        return name_id
+
+
+    def append(self, values):
+        '''Adds a hit. values is a Hit, or a tuple of the values in the same order as columns'''
+        if isinstance(values, Hit):
+            values = values._values()
+        self.ref_start.append(values[0])
+        self.ref_end.append(values[1])
+        self.qry_start.append(values[2])
+        self.qry_end.append(values[3])
+        self.hit_length_ref.append(values[4])
+        self.hit_length_qry.append(values[5])
+        self.percent_identity.append(values[6])
+        self.ref_length.append(values[7])
+        self.qry_length.append(values[8])
+        self.frame.append(values[9])
+        self.ref_id.append(self._name_id(values[10]))
+        self.qry_id.append(self._name_id(values[11]))
+
+
+    def lengths(self):
+        '''Returns dict of contig name => length, of all the contigs in the hits'''
+        lengths = {}
+        for i in range(len(self)):
+            lengths[self.names[self.qry_id[i]]] = self.qry_length[i]
+            lengths[self.names[self.ref_id[i]]] = self.ref_length[i]
+        return lengths
+
+
+    def indexes(self, *masks):
+        '''Returns list of the indexes of the hits that pass all of the masks (all hits if no masks are given)'''
+        if len(masks) == 0:
+            return list(range(len(self)))
+        mask = masks[0]
+        for other in masks[1:]:
+            mask = bytearray(x & y for x, y in zip(mask, other))
+        return list(itertools.compress(range(len(self)), mask))
+
+
+    def _value_columns(self):
+        '''Returns list of iterables of the values of every column, in the same order as columns'''
+        return [getattr(self, x) for x in columns[:10]] + [map(self.names.__getitem__, x) for x in (self.ref_id, self.qry_id)]
+
+
+    def hits(self, indexes=None):
+        '''Returns list of Hits at the given indexes (default all of them)'''
+        if indexes is None:
+            return list(map(Hit, *self._value_columns()))
+        return [self[i] for i in indexes]
+
+
+    def group_by(self, name_column, indexes=None):
+        '''name_column must be 'ref_name' or 'qry_name'. Returns dict of name => list of Hits
+           with that name, in the order they are in the table. Only uses the hits
+           at the given indexes, if given'''
+        if name_column not in {'ref_name', 'qry_name'}:
+            raise Error('Cannot group hits by ' + name_column)
+        ids = self.ref_id if name_column == 'ref_name' else self.qry_id
+        if indexes is None:
+            ids_and_hits = zip(ids, map(Hit, *self._value_columns()))
+        else:
+            ids_and_hits = ((ids[i], self[i]) for i in indexes)
+
+        groups = {}
+        for name_id, hit in ids_and_hits:
+            groups.setdefault(name_id, []).append(hit)
+        return {self.names[x]: y for x, y in groups.items()}
+
+
+    def at_ref_start(self, tolerance):
+        '''Mask of hits that start less than tolerance bases from the start of the reference'''
+        return bytearray(min(x, y) < tolerance for x, y in zip(self.ref_start, self.ref_end))
+
+
+    def at_ref_end(self, tolerance):
+        '''Mask of hits that end within tolerance bases of the end of the reference'''
+        return bytearray(max(x, y) >= length - tolerance for x, y, length in zip(self.ref_start, self.ref_end, self.ref_length))
+
+
+    def at_qry_start(self, tolerance):
+        '''Mask of hits that start less than tolerance bases from the start of the query'''
+        return bytearray(min(x, y) < tolerance for x, y in zip(self.qry_start, self.qry_end))
+
+
+    def at_qry_end(self, tolerance):
+        '''Mask of hits that end within tolerance bases of the end of the query'''
+        return bytearray(max(x, y) >= length - tolerance for x, y, length in zip(self.qry_start, self.qry_end, self.qry_length))
+
+
+    def min_qry_hit_length(self, min_length):
+        '''Mask of hits at least min_length long in the query'''
+        return bytearray(x >= min_length for x in self.hit_length_qry)
+
+
+    def min_qry_percent(self, min_percent):
+        '''Mask of hits that cover at least min_percent of the query'''
+        return bytearray(100 * x / length >= min_percent for x, length in zip(self.hit_length_qry, self.qry_length))
+
+
+    def min_percent_identity(self, min_identity):
+        '''Mask of hits with at least min_identity percent identity'''
+        return bytearray(x >= min_identity for x in self.percent_identity)
+
+
+    def different_names(self):
+        '''Mask of hits whose reference and query are different contigs'''
+        return bytearray(x != y for x, y in zip(self.ref_id, self.qry_id))
+
+
+    def qry_not_in(self, names):
+        '''Mask of hits whose query is not in the set of contig names'''
+        ids = {self.name_ids[x] for x in names if x in self.name_ids}
+        return bytearray(x not in ids for x in self.qry_id)
+
+
+class HitIndex:
+    '''Index of a list of hits, so that the longest hits of each class (eg the hits
+       at the start of the reference) can be found without looking at every hit.
+       classes is a dict of class name => function that returns True iff a hit is
+       in that class. The hits of a class are found and sorted the first time that
+       the class is used, so each function is called at most once per hit'''
+    def __init__(self, hits, classes):
+        self.hits = list(hits)
+        self.class_functions = classes
+        self.classes = {}
+        self.by_qry_length = None
+
+
+    def __len__(self):
+        return len(self.hits)
+
+
+    def _get_class(self, class_name):
+        '''Returns list of the hits in the class, longest on the reference first'''
+        if class_name not in self.classes:
+            # sorted is stable, so hits of the same length stay in the order they were given
+            function = self.class_functions[class_name]
+            self.classes[class_name] = sorted([x for x in self.hits if function(x)], key=lambda x: -x.hit_length_ref)
+        return self.classes[class_name]
+
+
+    def longest(self, class_name, exclude=None):
+        '''Returns the longest hit of the class (longest on the reference, and first
+           in the list of hits if there is a tie) that is not in the set exclude.
+           Returns None if there is no such hit'''
+        for hit in self._get_class(class_name):
+            if exclude is None or hit not in exclude:
+                return hit
+        return None
+
+
+    def has_qry_hit_longer_than(self, min_length, exclude=None):
+        '''Returns True iff there is a hit longer than min_length in the query that is not in the set exclude'''
+        if self.by_qry_length is None:
+            self.by_qry_length = sorted(self.hits, key=lambda x: -x.hit_length_qry)
+
+        for hit in self.by_qry_length:
+            if hit.hit_length_qry <= min_length:
+                return False
+            elif exclude is None or hit not in exclude:
+                return True
+        return False
@@ -1,7 +1,10 @@
 import os
+import time
+import contextlib
+import collections
 import pysam
 import pyfastaq
-from circlator import common, external_progs
+from circlator import cache, common, external_progs, runner
 
 class Error (Exception): pass
 
@@ -14,6 +17,11 @@ index_extensions = [
         'sa'
 ]
 
+# environment variables that set the directory and maximum size in GB of the bwa index cache
+index_cache_env = 'CIRCLATOR_BWA_INDEX_CACHE'
+index_cache_size_env = 'CIRCLATOR_BWA_INDEX_CACHE_SIZE'
+default_index_cache_size_gb = 20
+
 
 def bwa_index(infile, outprefix=None, bwa=None, verbose=False):
     if bwa is None:
@@ -31,7 +39,7 @@ def bwa_index(infile, outprefix=None, bwa=None, verbose=False):
         '-p', outprefix,
         infile
     ])
-    common.syscall(cmd, verbose=verbose)
+    runner.run(cmd, name='bwa index', verbose=verbose)
 
 
 def bwa_index_clean(prefix):
@@ -42,6 +50,58 @@ def bwa_index_clean(prefix):
             pass
 
 
+class BwaIndexCache(cache.Cache):
+    '''Cache of bwa indexes (see cache.Cache), so that the same assembly is only
+       indexed once. Indexes are keyed by the sha256 of the FASTA file'''
+    def __init__(self, directory, max_size_gb=None):
+        if max_size_gb is None:
+            max_size_gb = float(os.environ.get(index_cache_size_env, default_index_cache_size_gb))
+        super().__init__(directory, max_size_gb)
+
+
+    @contextlib.contextmanager
+    def index(self, fasta, bwa=None, verbose=False):
+        '''Context manager that gives the prefix of the bwa index of fasta, making
+           it if it is not already in the cache. The index will not be deleted by
+           another process until the context is exited'''
+        make = lambda directory: bwa_index(fasta, outprefix=os.path.join(directory, 'index'), bwa=bwa, verbose=verbose)
+        with self.get(cache.file_hash(fasta), make, verbose=verbose) as directory:
+            yield os.path.join(directory, 'index')
+
+
+@contextlib.contextmanager
+def _bwa_index_for_mapping(ref, outfile, bwa, index_cache, timings, verbose=False):
+    '''Context manager that gives the prefix of a bwa index of ref. Uses the
+       BwaIndexCache index_cache if it is not None, otherwise makes a temporary
+       index that is deleted afterwards'''
+    start_time = time.perf_counter()
+    if index_cache is None:
+        tmp_index = outfile + '.tmp.bwa_index'
+        bwa_index(ref, outprefix=tmp_index, verbose=verbose, bwa=bwa)
+        index_context = contextlib.nullcontext(tmp_index)
+    else:
+        tmp_index = None
+        index_context = index_cache.index(ref, bwa=bwa, verbose=verbose)
+
+    with index_context as prefix:
+        timings['bwa index'] = time.perf_counter() - start_time
+        if verbose:
+            print('[mapping]', 'bwa index', 'time (s):', round(timings['bwa index'], 2), sep='\t', flush=True)
+        try:
+            yield prefix
+        finally:
+            if tmp_index is not None:
+                bwa_index_clean(tmp_index)
+
+
+def _run_timed(cmd, stage, timings, verbose=False):
+    '''Runs cmd, adding the time it took to the dict of timings, with key stage.
+       cmd fails if any of the commands in it fails, eg bwa at the start of a pipe'''
+    timings[stage] = runner.run(cmd, name=stage, verbose=verbose, pipefail=True)['wall_seconds']
+    if verbose:
+        print('[mapping]', stage, 'time (s):', round(timings[stage], 2), sep='\t', flush=True)
+
+
 def bwa_mem(
       ref,
       reads,
@@ -49,61 +109,90 @@ def bwa_mem(
       threads=1,
       bwa_options = '-x pacbio',
       verbose=False,
-      index=None
+      index=None,
+      sort_threads=None,
+      sort_mem=None,
+      stream=True,
+      index_cache=None,
+      index_cache_size_gb=None,
     ):
-
+    '''Maps reads to ref using bwa mem, making a sorted indexed BAM file called outfile.
+       sort_threads and sort_mem (megabytes per thread) are used by samtools sort. If stream is True,
+       the output of bwa is sorted as it is made, instead of writing an unsorted BAM file first
+       (needs samtools >= 1.3). index_cache is the directory of a BwaIndexCache to use, instead of
+       making a temporary index (default is the environment variable CIRCLATOR_BWA_INDEX_CACHE).
+       Returns dict of stage name => time taken in seconds'''
     samtools = external_progs.make_and_check_prog('samtools', verbose=verbose)
     bwa = external_progs.make_and_check_prog('bwa', verbose=verbose)
     unsorted_bam = outfile + '.tmp.unsorted.bam'
-    tmp_index = outfile + '.tmp.bwa_index'
-    bwa_index(ref, outprefix=tmp_index, verbose=verbose, bwa=bwa)
-
-    cmd = ' '.join([
-        bwa.exe(), 'mem',
-        bwa_options,
-        '-t', str(threads),
-        tmp_index,
-        reads,
-        '|',
-        samtools.exe(), 'view',
-        '-F 0x0800',
-        '-T', ref,
-        '-b',
-        '-o', unsorted_bam,
-        '-',
-    ])
+    timings = collections.OrderedDict()
+    if index_cache is None:
+        index_cache = os.environ.get(index_cache_env)
+    if index_cache is not None:
+        index_cache = BwaIndexCache(index_cache, max_size_gb=index_cache_size_gb)
 
-    common.syscall(cmd, verbose=verbose)
-    bwa_index_clean(tmp_index)
-    threads = min(4, threads)
-    thread_mem = int(500 / threads)
+    if sort_threads is None:
+        sort_threads = min(4, threads)
+    if sort_mem is None:
+        sort_mem = int(500 / sort_threads)
 
     # here we have to check for the version of samtools, starting from 1.3 the
     # -o flag is used for specifying the samtools sort output-file.
     # Starting from 1.2 you can use the -o flag, but can't have
     # -o out.bam at the end of the call, so use new style from 1.3 onwards.
-
-    outparam = ''
+    # Sorting from stdin also needs the new style.
 
     if samtools.version_at_least('1.3'):
         outparam = '-o'
         samout = outfile
     else:
+        outparam = ''
         samout = outfile[:-4]
+        stream = False
 
-    cmd = ' '.join([
+    sort_cmd = ' '.join([
         samtools.exe(), 'sort',
-        '-@', str(threads),
-        '-m', str(thread_mem) + 'M',
-        unsorted_bam,
-        outparam,samout
+        '-@', str(sort_threads),
+        '-m', str(sort_mem) + 'M',
     ])
 
-    common.syscall(cmd, verbose=verbose)
-    os.unlink(unsorted_bam)
+    with _bwa_index_for_mapping(ref, outfile, bwa, index_cache, timings, verbose=verbose) as index_prefix:
+        bwa_cmd = ' '.join([
+            bwa.exe(), 'mem',
+            bwa_options,
+            '-t', str(threads),
+            index_prefix,
+            reads,
+            '|',
+            samtools.exe(), 'view',
+            '-F 0x0800',
+            '-T', ref,
+        ])
+
+        if stream:
+            cmd = ' '.join([
+                bwa_cmd,
+                '-u',
+                '-',
+                '|',
+                sort_cmd,
+                '-T', outfile + '.tmp.sort',
+                outparam, samout,
+                '-',
+            ])
+            _run_timed(cmd, 'bwa mem and samtools sort', timings, verbose=verbose)
+        else:
+            cmd = ' '.join([bwa_cmd, '-b', '-o', unsorted_bam, '-'])
+            _run_timed(cmd, 'bwa mem', timings, verbose=verbose)
+
+    if not stream:
+        cmd = ' '.join([sort_cmd, unsorted_bam, outparam, samout])
+        _run_timed(cmd, 'samtools sort', timings, verbose=verbose)
+        os.unlink(unsorted_bam)
 
     cmd = samtools.exe() + ' index ' + outfile
-    common.syscall(cmd, verbose=verbose)
+    _run_timed(cmd, 'samtools index', timings, verbose=verbose)
+    return timings
 
 
 def aligned_read_to_read(read, revcomp=True, qual=None, ignore_quality=False):
@@ -123,3 +212,35 @@ def aligned_read_to_read(read, revcomp=True, qual=None, ignore_quality=False):
         seq.revcomp()
 
     return seq
+
+
+revcomp_table = str.maketrans('ATCGatcg', 'TAGCtagc')
+
+
+def _wrap(seq, line_length):
+    '''Returns seq with a newline after every line_length characters, except at the
+       end, the same as pyfastaq does when printing a Fasta'''
+    if line_length == 0:
+        return seq
+    return '\n'.join(seq[i:i + line_length] for i in range(0, len(seq), line_length))
+
+
+def aligned_read_to_record(read, revcomp=True, ignore_quality=False, start=None, end=None):
+    '''Returns FASTA or FASTQ record of pysam aligned read, as a string ending with a newline.
+       Gives the same as print(aligned_read_to_read(read, revcomp, ignore_quality=ignore_quality)),
+       but much faster because it does not make a pyfastaq sequence object.
+       The sequence is sliced [start:end] before any reverse complementing'''
+    seq = read.query_sequence[start:end]
+    qual = None if ignore_quality else read.qual
+    reverse = read.is_reverse and revcomp
+
+    if reverse:
+        seq = seq.translate(revcomp_table)[::-1]
+
+    if qual is None:
+        return '>' + read.query_name + '\n' + _wrap(seq, pyfastaq.sequences.Fasta.line_length) + '\n'
+
+    qual = qual[start:end]
+    if reverse:
+        qual = qual[::-1]
+    return '@' + read.query_name + '\n' + seq + '\n+\n' + qual + '\n'
@@ -2,13 +2,215 @@ import os
 import sys
 import copy
 import shutil
+import hashlib
+import tempfile
 import collections
+import multiprocessing
+import io
 import pymummer
 import pyfastaq
 import circlator
 
 class Error (Exception): pass
 
+# Merger._circularise_contigs only uses a pool of processes if there are at least
+# this many contigs. Each contig is quick, so for fewer the pool is slower
+min_contigs_for_circularise_pool = 100
+
+
+def index_fasta(infile, verbose=False):
+    '''Makes samtools faidx index of infile, unless it already exists'''
+    fai = infile + '.fai'
+    if not os.path.exists(fai):
+        samtools = circlator.external_progs.make_and_check_prog('samtools')
+        circlator.common.syscall(samtools.exe() + ' faidx ' + infile, verbose=verbose, name='samtools faidx')
+
+
+def write_act_files(ref_fasta, qry_fasta, coords_file, outprefix, verbose=False):
+    '''Writes crunch file and shell script to start up ACT, showing comparison of ref and qry'''
+    if verbose:
+        print('Making ACT files from', ref_fasta, qry_fasta, coords_file)
+    ref_fasta = os.path.relpath(ref_fasta)
+    qry_fasta = os.path.relpath(qry_fasta)
+    coords_file = os.path.relpath(coords_file)
+    outprefix = os.path.relpath(outprefix)
+    index_fasta(ref_fasta, verbose=verbose)
+    index_fasta(qry_fasta, verbose=verbose)
+    crunch_file = outprefix + '.crunch'
+    pymummer.coords_file.convert_to_msp_crunch(
+        coords_file,
+        crunch_file,
+        ref_fai=ref_fasta + '.fai',
+        qry_fai=qry_fasta + '.fai'
+    )
+
+    bash_script = outprefix + '.start_act.sh'
+    with open(bash_script, 'w') as f:
+        print('#!/usr/bin/env bash', file=f)
+        print('act', ref_fasta, crunch_file, qry_fasta, file=f)
+
+    pyfastaq.utils.syscall('chmod +x ' + bash_script)
+
+
+def write_act_files_from_list(infile, verbose=False):
+    '''Writes the ACT files listed in infile, which is made by a Merger with
+       act_files_list=infile. Each line is either the arguments to write_act_files,
+       or the target and name of a symlink to an ACT script'''
+    with open(infile) as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) == 2:
+                os.symlink(*fields)
+            else:
+                write_act_files(*fields, verbose=verbose)
+
+
+def act_files_from_list(infile):
+    '''Returns sorted list of the files that write_act_files_from_list(infile) makes,
+       including the FASTA indexes. Returns an empty list if infile does not exist'''
+    if not os.path.exists(infile):
+        return []
+
+    files = set()
+    with open(infile) as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) == 2:
+                files.add(fields[1])
+            else:
+                ref_fasta, qry_fasta, coords_file, outprefix = fields
+                outprefix = os.path.relpath(outprefix)
+                files.update([
+                    os.path.relpath(ref_fasta) + '.fai',
+                    os.path.relpath(qry_fasta) + '.fai',
+                    outprefix + '.crunch',
+                    outprefix + '.start_act.sh',
+                ])
+    return sorted(files)
+
+
+def _init_circularise_worker(merger, nucmer_hits, called_as_circular_by_spades, to_circularise_with_nucmer, log_outprefix):
+    '''Sets the data used by _try_circularise_contig_in_worker. When the pool
+       processes are forked, they share it with the parent without copying'''
+    global _circularise_worker_args
+    _circularise_worker_args = (merger, nucmer_hits, called_as_circular_by_spades, to_circularise_with_nucmer, log_outprefix)
+
+
+def _try_circularise_contig_in_worker(ref_name):
+    '''Runs Merger._try_circularise_contig in a process of the pool made by Merger._circularise_contigs.
+       A contig made from a circular reassembly contig is not returned, because it is the
+       same sequence as the reassembly contig, which the parent process already has'''
+    merger, *args = _circularise_worker_args
+    log_lines, new_contig, spades_contig = merger._try_circularise_contig(ref_name, *args)
+    if spades_contig is not None:
+        new_contig = None
+    return log_lines, new_contig, spades_contig
+
+
+class NucmerHitCache:
+    '''Remembers the nucmer hits between each pair of reference and query
+       sequences, keyed by the sha256 of the two sequences. Running again on
+       files that share sequences with earlier runs only aligns the new
+       sequences, and reuses the hits of the pairs already aligned (renamed to
+       the names in the new files). This is only correct when the hits between
+       two sequences do not depend on the other sequences in the files, which
+       is the case for nucmer --maxmatch'''
+    def __init__(self, run_nucmer):
+        '''run_nucmer is a function(ref_fasta, qry_fasta, outfile) that runs
+           nucmer and makes a coords file'''
+        self.run_nucmer = run_nucmer
+        # ref sha256 => qry sha256 => list of hits. Each hit is the fields of its
+        # line in the coords file, without the two names
+        self.hits = {}
+        self.reused_pairs = 0
+        self.aligned_pairs = 0
+
+
+    @staticmethod
+    def _load_fasta(filename):
+        '''Returns list of tuples (name, sha256 of sequence) in the same order
+           as the file, and dict of sha256 => sequence'''
+        names = []
+        seqs = {}
+        for seq in pyfastaq.sequences.file_reader(filename):
+            key = hashlib.sha256(seq.seq.encode()).hexdigest()
+            names.append((seq.id.split()[0], key))
+            seqs[key] = seq.seq
+        return names, seqs
+
+
+    def _align(self, ref_seqs, qry_seqs, tmpdir):
+        '''Runs nucmer of ref_seqs vs qry_seqs (dicts of sha256 => sequence), and
+           adds the hits to the cache. The sequences are named by their sha256'''
+        if len(ref_seqs) == 0 or len(qry_seqs) == 0:
+            return
+
+        ref_fasta = os.path.join(tmpdir, 'ref.fa')
+        qry_fasta = os.path.join(tmpdir, 'qry.fa')
+        coords_file = os.path.join(tmpdir, 'coords')
+        for filename, seqs in ((ref_fasta, ref_seqs), (qry_fasta, qry_seqs)):
+            with open(filename, 'w') as f:
+                for key, seq in seqs.items():
+                    print('>' + key, seq, sep='\n', file=f)
+
+        self.run_nucmer(ref_fasta, qry_fasta, coords_file)
+
+        for ref_key in ref_seqs:
+            qry_hits = self.hits.setdefault(ref_key, {})
+            for qry_key in qry_seqs:
+                qry_hits[qry_key] = []
+
+        with open(coords_file) as f:
+            for line in f:
+                if line.startswith('[') or '\t' not in line:
+                    continue
+                fields = line.rstrip('\n').split('\t')
+                self.hits[fields[11]][fields[12]].append(fields[:11] + fields[13:])
+
+        self.aligned_pairs += len(ref_seqs) * len(qry_seqs)
+
+
+    def run(self, ref_fasta, qry_fasta, outfile):
+        '''Writes coords file outfile of the hits of ref_fasta vs qry_fasta, only
+           running nucmer on the sequences that have pairs not in the cache. The
+           hits are sorted by reference name and coordinates, like show-coords -r.
+           Returns a circlator.hits.HitTable of the hits'''
+        self.reused_pairs = 0
+        self.aligned_pairs = 0
+        refs, ref_seqs = self._load_fasta(ref_fasta)
+        qrys, qry_seqs = self._load_fasta(qry_fasta)
+        new_refs = {x: ref_seqs[x] for x in ref_seqs if x not in self.hits}
+        old_refs = {x: ref_seqs[x] for x in ref_seqs if x in self.hits}
+        new_qrys = {x: qry_seqs[x] for x in qry_seqs if any(x not in self.hits[y] for y in old_refs)}
+        self.reused_pairs = len(old_refs) * (len(qry_seqs) - len(new_qrys))
+
+        tmpdir = tempfile.mkdtemp(prefix='tmp.nucmer_hit_cache.', dir=os.path.dirname(os.path.abspath(outfile)))
+        try:
+            self._align(new_refs, qry_seqs, tmpdir)
+            self._align(old_refs, new_qrys, tmpdir)
+        finally:
+            shutil.rmtree(tmpdir)
+
+        lines = []
+        for ref_name, ref_key in refs:
+            qry_hits = self.hits[ref_key]
+            for qry_name, qry_key in qrys:
+                for fields in qry_hits[qry_key]:
+                    lines.append(fields[:11] + [ref_name, qry_name] + fields[11:])
+
+        lines.sort(key=lambda x: (x[11], int(x[0]), int(x[1]), x[12], int(x[2]), int(x[3])))
+        lines = ['\t'.join(x) + '\n' for x in lines]
+
+        with open(outfile, 'w') as f:
+            print(os.path.abspath(ref_fasta), os.path.abspath(qry_fasta), file=f)
+            print('NUCMER', file=f)
+            print(file=f)
+            print('[S1]', '[E1]', '[S2]', '[E2]', '[LEN 1]', '[LEN 2]', '[% IDY]', '[LEN R]', '[LEN Q]', '[FRM]', '[TAGS]', sep='\t', file=f)
+            f.writelines(lines)
+
+        return circlator.hits.HitTable.from_coords_lines(lines)
+
+
 class Merger:
     def __init__(
           self,
@@ -24,6 +226,10 @@ class Merger:
           min_spades_circular_percent=95,
           spades_kmers=None,
           spades_use_first_success=False,
+          spades_concurrent_runs=None,
+          spades_adaptive=False,
+          reassembly_cache_dir=None,
+          reassembly_cache_size_gb=None,
           spades_careful=True,
           spades_only_assembler=True,
           assembler='spades',
@@ -34,8 +240,24 @@ class Merger:
           qry_end_tolerance=1000,
           verbose=False,
           threads=1,
+          compress_reads=None,
+          compress_level=6,
+          sort_threads=None,
+          sort_mem=None,
+          bwa_index_cache=None,
+          bwa_index_cache_size_gb=None,
+          act_files_list=None,
+          incremental_nucmer=False,
+          local_reassembly=False,
           log_prefix='merge',
     ):
+        '''If act_files_list is given, the ACT files are not written. Instead, what
+           would have been written is listed in the file act_files_list, so that the
+           ACT files can be written later with write_act_files_from_list.
+           If incremental_nucmer is True, each round of iterative merging only runs
+           nucmer on the contigs that were not in an earlier round (see NucmerHitCache).
+           If local_reassembly is True, remaps after the first one only remap and
+           reassemble the reads around the new joins (see _local_remap_and_reassemble)'''
         if not os.path.exists(original_assembly):
             raise Error('File not found:' + original_assembly)
 
@@ -52,6 +274,10 @@ class Merger:
         self.min_spades_circular_percent = min_spades_circular_percent
         self.spades_kmers = spades_kmers
         self.spades_use_first_success = spades_use_first_success
+        self.spades_concurrent_runs = spades_concurrent_runs
+        self.spades_adaptive = spades_adaptive
+        self.reassembly_cache_dir = reassembly_cache_dir
+        self.reassembly_cache_size_gb = reassembly_cache_size_gb
         self.spades_careful = spades_careful
         self.spades_only_assembler = spades_only_assembler
         self.length_cutoff=length_cutoff
@@ -61,11 +287,21 @@ class Merger:
         self.qry_end_tolerance = qry_end_tolerance
         self.verbose = verbose
         self.threads = threads
+        self.compress_reads = compress_reads
+        self.compress_level = compress_level
+        self.sort_threads = sort_threads
+        self.sort_mem = sort_mem
+        self.bwa_index_cache = bwa_index_cache
+        self.bwa_index_cache_size_gb = bwa_index_cache_size_gb
+        self.act_files_list = act_files_list
+        self.deferred_act_files = []
+        self.nucmer_hit_cache = NucmerHitCache(self._run_nucmer) if incremental_nucmer else None
+        self.local_reassembly = local_reassembly
+        self.contig_bams = {}
         self.log_prefix = log_prefix
         self.merges = []
-        self.original_contigs = {}
+        self.original_contigs = circlator.contig_store.ContigStore(self.original_fasta)
         self.reassembly_contigs = self.reassembly.get_contigs()
-        pyfastaq.tasks.file_to_dict(self.original_fasta, self.original_contigs)
 
 
     def _run_nucmer(self, ref, qry, outfile):
@@ -82,18 +318,13 @@ class Merger:
             simplify=True,
             verbose=self.verbose
         )
-        n.run()
+        with circlator.runner.timed('nucmer'):
+            n.run()
 
 
     def _load_nucmer_hits(self, infile):
         '''Returns dict ref name => list of nucmer hits from infile'''
-        hits = {}
-        file_reader = pymummer.coords_file.reader(infile)
-        for al in file_reader:
-            if al.ref_name not in hits:
-                hits[al.ref_name] = []
-            hits[al.ref_name].append(al)
-        return hits
+        return circlator.hits.HitTable.from_coords_file(infile).group_by('ref_name')
 
 
     def _hits_hashed_by_query(self, hits):
@@ -124,26 +355,22 @@ class Merger:
 
     def _is_at_ref_start(self, nucmer_hit):
         '''Returns True iff the hit is "close enough" to the start of the reference sequence'''
-        hit_coords = nucmer_hit.ref_coords()
-        return hit_coords.start < self.ref_end_tolerance
+        return min(nucmer_hit.ref_start, nucmer_hit.ref_end) < self.ref_end_tolerance
 
 
     def _is_at_ref_end(self, nucmer_hit):
         '''Returns True iff the hit is "close enough" to the end of the reference sequence'''
-        hit_coords = nucmer_hit.ref_coords()
-        return hit_coords.end >= nucmer_hit.ref_length - self.ref_end_tolerance
+        return max(nucmer_hit.ref_start, nucmer_hit.ref_end) >= nucmer_hit.ref_length - self.ref_end_tolerance
 
 
     def _is_at_qry_start(self, nucmer_hit):
         '''Returns True iff the hit is "close enough" to the start of the query sequence'''
-        hit_coords = nucmer_hit.qry_coords()
-        return hit_coords.start < self.qry_end_tolerance
+        return min(nucmer_hit.qry_start, nucmer_hit.qry_end) < self.qry_end_tolerance
 
 
     def _is_at_qry_end(self, nucmer_hit):
         '''Returns True iff the hit is "close enough" to the end of the query sequence'''
-        hit_coords = nucmer_hit.qry_coords()
-        return hit_coords.end >= nucmer_hit.qry_length - self.qry_end_tolerance
+        return max(nucmer_hit.qry_start, nucmer_hit.qry_end) >= nucmer_hit.qry_length - self.qry_end_tolerance
 
 
     def _get_hit_nearest_ref_start(self, hits):
@@ -164,32 +391,46 @@ class Merger:
         return nearest_to_end
 
 
+    def _hit_index(self, nucmer_hits):
+        '''Returns a hits.HitIndex of a list of nucmer hits, which knows which hits are at
+           the start and end of the reference and query. If nucmer_hits is already a
+           HitIndex, it is returned unchanged'''
+        if isinstance(nucmer_hits, circlator.hits.HitIndex):
+            return nucmer_hits
+
+        return circlator.hits.HitIndex(nucmer_hits, {
+            'ref_start': self._is_at_ref_start,
+            'ref_end': self._is_at_ref_end,
+            'qry_start': self._is_at_qry_start,
+            'qry_end': self._is_at_qry_end,
+        })
+
+
+    def _get_longest_hit_at(self, position, nucmer_hits, hits_to_exclude=None):
+        '''position is one of ref_start, ref_end, qry_start, qry_end. Returns the longest hit
+           (taking hit length on the reference) at that position, or None if there is no such hit'''
+        hit = self._hit_index(nucmer_hits).longest(position, exclude=hits_to_exclude)
+        return None if hit is None else copy.copy(hit)
+
+
     def _get_longest_hit_at_ref_start(self, nucmer_hits, hits_to_exclude=None):
-        '''Input: list of nucmer hits to the same reference. Returns the longest hit to the start of the reference, or None if there is no such hit'''
-        if hits_to_exclude is None:
-            hits_to_exclude = set()
-        hits_at_start = [hit for hit in nucmer_hits if self._is_at_ref_start(hit) and hit not in hits_to_exclude]
-        return self._get_longest_hit_by_ref_length(hits_at_start)
+        '''Input: list of nucmer hits to the same reference (or a HitIndex made by _hit_index). Returns the longest hit to the start of the reference, or None if there is no such hit'''
+        return self._get_longest_hit_at('ref_start', nucmer_hits, hits_to_exclude=hits_to_exclude)
 
 
     def _get_longest_hit_at_ref_end(self, nucmer_hits, hits_to_exclude=None):
-        '''Input: list of nucmer hits to the same reference. Returns the longest hit to the end of the reference, or None if there is no such hit'''
-        if hits_to_exclude is None:
-            hits_to_exclude = set()
-        hits_at_end = [hit for hit in nucmer_hits if self._is_at_ref_end(hit) and hit not in hits_to_exclude]
-        return self._get_longest_hit_by_ref_length(hits_at_end)
+        '''Input: list of nucmer hits to the same reference (or a HitIndex made by _hit_index). Returns the longest hit to the end of the reference, or None if there is no such hit'''
+        return self._get_longest_hit_at('ref_end', nucmer_hits, hits_to_exclude=hits_to_exclude)
 
 
     def _get_longest_hit_at_qry_start(self, nucmer_hits):
-        '''Input: list of nucmer hits to the same query. Returns the longest hit to the start of the query, or None if there is no such hit'''
-        hits_at_start = [hit for hit in nucmer_hits if self._is_at_qry_start(hit)]
-        return self._get_longest_hit_by_ref_length(hits_at_start)
+        '''Input: list of nucmer hits to the same query (or a HitIndex made by _hit_index). Returns the longest hit to the start of the query, or None if there is no such hit'''
+        return self._get_longest_hit_at('qry_start', nucmer_hits)
 
 
     def _get_longest_hit_at_qry_end(self, nucmer_hits):
-        '''Input: list of nucmer hits to the same query. Returns the longest hit to the end of the query, or None if there is no such hit'''
-        hits_at_end = [hit for hit in nucmer_hits if self._is_at_qry_end(hit)]
-        return self._get_longest_hit_by_ref_length(hits_at_end)
+        '''Input: list of nucmer hits to the same query (or a HitIndex made by _hit_index). Returns the longest hit to the end of the query, or None if there is no such hit'''
+        return self._get_longest_hit_at('qry_end', nucmer_hits)
 
 
     def _hits_have_same_query(self, nucmer_hit1, nucmer_hit2):
@@ -208,13 +449,8 @@ class Merger:
 
 
     def _has_qry_hit_longer_than(self, nucmer_hits, min_length, hits_to_exclude=None):
-        '''Returns True iff list of nucmer_hits has a hit longer than min_length, not counting the hits in hits_to_exclude'''
-        if hits_to_exclude is None:
-            to_exclude = set()
-        else:
-            to_exclude = hits_to_exclude
-        long_hits = [hit.hit_length_qry for hit in nucmer_hits if hit not in to_exclude and hit.hit_length_qry > min_length]
-        return len(long_hits) > 0
+        '''Returns True iff list of nucmer_hits (or a HitIndex made by _hit_index) has a hit longer than min_length, not counting the hits in hits_to_exclude'''
+        return self._hit_index(nucmer_hits).has_qry_hit_longer_than(min_length, exclude=hits_to_exclude)
 
 
     def _can_circularise(self, start_hit, end_hit):
@@ -245,16 +481,18 @@ class Merger:
         for l in nucmer_hits.values():
             all_nucmer_hits.extend(l)
         nucmer_hits_by_qry = self._hits_hashed_by_query(all_nucmer_hits)
+        qry_indexes = {}
 
         for ref_name, list_of_hits in nucmer_hits.items():
             if writing_log_file:
                 print(log_outprefix, ref_name, 'Checking ' + str(len(list_of_hits)) + ' nucmer hits', sep='\t', file=log_fh)
 
-            longest_start_hit = self._get_longest_hit_at_ref_start(list_of_hits)
-            longest_end_hit = self._get_longest_hit_at_ref_end(list_of_hits)
+            ref_index = self._hit_index(list_of_hits)
+            longest_start_hit = self._get_longest_hit_at_ref_start(ref_index)
+            longest_end_hit = self._get_longest_hit_at_ref_end(ref_index)
             if longest_start_hit == longest_end_hit:
-                second_longest_start_hit = self._get_longest_hit_at_ref_start(list_of_hits, hits_to_exclude={longest_start_hit})
-                second_longest_end_hit = self._get_longest_hit_at_ref_end(list_of_hits, hits_to_exclude={longest_end_hit})
+                second_longest_start_hit = self._get_longest_hit_at_ref_start(ref_index, hits_to_exclude={longest_start_hit})
+                second_longest_end_hit = self._get_longest_hit_at_ref_end(ref_index, hits_to_exclude={longest_end_hit})
                 if second_longest_start_hit is not None:
                     longest_start_hit = self._get_hit_nearest_ref_start([longest_start_hit, second_longest_start_hit])
                 if second_longest_end_hit is not None:
@@ -272,8 +510,11 @@ class Merger:
                     print(log_outprefix, ref_name, '', longest_end_hit, sep='\t', file=log_fh)
 
                 shortest_hit_length = self._min_qry_hit_length([longest_start_hit, longest_end_hit])
+                qry_name = longest_start_hit.qry_name
+                if qry_name not in qry_indexes:
+                    qry_indexes[qry_name] = self._hit_index(nucmer_hits_by_qry[qry_name])
                 has_longer_hit = self._has_qry_hit_longer_than(
-                    nucmer_hits_by_qry[longest_start_hit.qry_name],
+                    qry_indexes[qry_name],
                     shortest_hit_length,
                     hits_to_exclude={longest_start_hit, longest_end_hit}
                 )
@@ -338,6 +579,41 @@ class Merger:
             return pyfastaq.sequences.Fasta(ref_name, self.original_contigs[ref_name][ref_start_coords.end+1:ref_end_coords.start] + tmp_seq.seq)
 
 
+    def _try_circularise_contig(self, ref_name, nucmer_hits, called_as_circular_by_spades, to_circularise_with_nucmer, log_outprefix):
+        '''Tries to circularise one contig, first using circular reassembly contigs, then using
+           nucmer matches. Does not change self, so that contigs can be done in parallel.
+           Returns tuple (lines for the details log, new contig or None, name of the
+           circular reassembly contig used or None)'''
+        log_fh = io.StringIO()
+        print(log_outprefix, sep='\t', file=log_fh)
+        spades_contig = None
+
+        if ref_name in nucmer_hits:
+            print(log_outprefix, ref_name, 'Trying to circularize. Has nucmer hits to check...', sep='\t', file=log_fh)
+            new_contig, spades_contig = self._make_new_contig_from_nucmer_and_spades(ref_name, nucmer_hits[ref_name], called_as_circular_by_spades, log_fh=log_fh, log_outprefix=log_outprefix)
+
+            if new_contig is None:
+                print(log_outprefix, ref_name, 'Could not circularize using matches to ' + self.assembler + ' circular contigs', sep='\t', file=log_fh)
+
+                if ref_name in to_circularise_with_nucmer:
+                    start_hit, end_hit = to_circularise_with_nucmer[ref_name]
+                    assert start_hit.ref_name == end_hit.ref_name == ref_name
+                    print(log_outprefix, ref_name, 'Circularizing using this pair of nucmer matches to ' + self.assembler + ' contig:', sep='\t', file=log_fh)
+                    print(log_outprefix, '\t', ref_name, '\t\t', start_hit, sep='', file=log_fh)
+                    print(log_outprefix, '\t', ref_name, '\t\t', end_hit, sep='', file=log_fh)
+                    new_contig = self._make_circularised_contig(start_hit, end_hit)
+                else:
+                    print(log_outprefix, ref_name, 'Cannot circularize: no suitable nucmer hits', sep='\t', file=log_fh)
+            else:
+                assert new_contig.id == ref_name
+                assert spades_contig is not None
+        else:
+            print(log_outprefix, ref_name, 'Cannot circularize: no nucmer hits', sep='\t', file=log_fh)
+            new_contig = None
+
+        return log_fh.getvalue(), new_contig, spades_contig
+
+
     def _circularise_contigs(self, nucmer_hits):
         log_fh = pyfastaq.utils.open_file_write(self.outprefix + '.circularise_details.log')
         log_outprefix = '[merge circularise_details]'
@@ -365,41 +641,29 @@ class Merger:
             ]
         }
 
-        for ref_name in self.original_contigs:
-            print(log_outprefix, sep='\t', file=log_fh)
+        if self.threads > 1 and len(self.original_contigs) >= min_contigs_for_circularise_pool:
+            with multiprocessing.Pool(self.threads, initializer=_init_circularise_worker, initargs=(self, nucmer_hits, called_as_circular_by_spades, to_circularise_with_nucmer, log_outprefix)) as pool:
+                results = pool.map(_try_circularise_contig_in_worker, self.original_contigs, chunksize=max(1, len(self.original_contigs) // (4 * self.threads)))
+        else:
+            results = [self._try_circularise_contig(x, nucmer_hits, called_as_circular_by_spades, to_circularise_with_nucmer, log_outprefix) for x in self.original_contigs]
 
-            if ref_name in nucmer_hits:
-                print(log_outprefix, ref_name, 'Trying to circularize. Has nucmer hits to check...', sep='\t', file=log_fh)
-                new_contig, spades_contig = self._make_new_contig_from_nucmer_and_spades(ref_name, nucmer_hits[ref_name], called_as_circular_by_spades, log_fh=log_fh, log_outprefix=log_outprefix)
+        # Whether a contig circularised with a SPAdes contig is kept depends on
+        # the contigs before it, so this part is done in order
+        for ref_name, (log_lines, new_contig, spades_contig) in zip(list(self.original_contigs), results):
+            log_fh.write(log_lines)
 
+            if spades_contig is not None:
                 if new_contig is None:
-                    print(log_outprefix, ref_name, 'Could not circularize using matches to ' + self.assembler + ' circular contigs', sep='\t', file=log_fh)
-
-                    if ref_name in to_circularise_with_nucmer:
-                        start_hit, end_hit = to_circularise_with_nucmer[ref_name]
-                        assert start_hit.ref_name == end_hit.ref_name == ref_name
-                        print(log_outprefix, ref_name, 'Circularizing using this pair of nucmer matches to ' + self.assembler + ' contig:', sep='\t', file=log_fh)
-                        print(log_outprefix, '\t', ref_name, '\t\t', start_hit, sep='', file=log_fh)
-                        print(log_outprefix, '\t', ref_name, '\t\t', end_hit, sep='', file=log_fh)
-                        new_contig = self._make_circularised_contig(start_hit, end_hit)
-                        fate_of_contigs['circl_using_nucmer'].add(ref_name)
-                    else:
-                        print(log_outprefix, ref_name, 'Cannot circularize: no suitable nucmer hits', sep='\t', file=log_fh)
+                    new_contig = pyfastaq.sequences.Fasta(ref_name, self.reassembly_contigs[spades_contig].seq)
+                if spades_contig in used_spades_contigs:
+                    print(log_outprefix, ref_name, 'Is circular, but duplicate sequence, so deleting it', sep='\t', file=log_fh)
+                    fate_of_contigs['repetitive_deleted'].add(ref_name)
                 else:
-                    assert new_contig.id == ref_name
-                    assert spades_contig is not None
-                    if spades_contig in used_spades_contigs:
-                        print(log_outprefix, ref_name, 'Is circular, but duplicate sequence, so deleting it', sep='\t', file=log_fh)
-                        fate_of_contigs['repetitive_deleted'].add(ref_name)
-                    else:
-                        self.original_contigs[new_contig.id] = new_contig
-                        fate_of_contigs['circl_using_spades'].add(ref_name)
-                        print(log_outprefix, ref_name, 'Circularized using matches to ' + self.assembler + ' circular contigs', sep='\t', file=log_fh)
-                        used_spades_contigs.add(spades_contig)
-            else:
-                print(log_outprefix, ref_name, 'Cannot circularize: no nucmer hits', sep='\t', file=log_fh)
-                new_contig = None
-
+                    fate_of_contigs['circl_using_spades'].add(ref_name)
+                    print(log_outprefix, ref_name, 'Circularized using matches to ' + self.assembler + ' circular contigs', sep='\t', file=log_fh)
+                    used_spades_contigs.add(spades_contig)
+            elif new_contig is not None:
+                fate_of_contigs['circl_using_nucmer'].add(ref_name)
 
             if new_contig is None:
                 print(log_outprefix, ref_name, 'Circularized: no', sep='\t', file=log_fh)
@@ -485,8 +749,9 @@ class Merger:
             if writing_log_file:
                 print(log_outprefix, '\t', qry_name, ': checking nucmer matches', sep='', file=log_fh)
 
-            longest_start_hit = self._get_longest_hit_at_qry_start(hits_to_qry)
-            longest_end_hit = self._get_longest_hit_at_qry_end(hits_to_qry)
+            qry_index = self._hit_index(hits_to_qry)
+            longest_start_hit = self._get_longest_hit_at_qry_start(qry_index)
+            longest_end_hit = self._get_longest_hit_at_qry_end(qry_index)
 
             if (
                 None in (longest_start_hit, longest_end_hit)
@@ -504,7 +769,7 @@ class Merger:
 
             shortest_hit_length = self._min_qry_hit_length([longest_start_hit, longest_end_hit])
             has_longer_hit = self._has_qry_hit_longer_than(
-                hits_to_qry,
+                qry_index,
                 shortest_hit_length,
                 hits_to_exclude={longest_start_hit, longest_end_hit}
             )
@@ -627,36 +892,165 @@ class Merger:
 
 
     def _index_fasta(self, infile):
-        fai = infile + '.fai'
-        if not os.path.exists(fai):
-            samtools = circlator.external_progs.make_and_check_prog('samtools')
-            circlator.common.syscall(samtools.exe() + ' faidx ' + infile, verbose=self.verbose)
+        index_fasta(infile, verbose=self.verbose)
 
 
     def _write_act_files(self, ref_fasta, qry_fasta, coords_file, outprefix):
-        '''Writes crunch file and shell script to start up ACT, showing comparison of ref and qry'''
-        if self.verbose:
-            print('Making ACT files from', ref_fasta, qry_fasta, coords_file)
-        ref_fasta = os.path.relpath(ref_fasta)
-        qry_fasta = os.path.relpath(qry_fasta)
-        coords_file = os.path.relpath(coords_file)
-        outprefix = os.path.relpath(outprefix)
-        self._index_fasta(ref_fasta)
-        self._index_fasta(qry_fasta)
-        crunch_file = outprefix + '.crunch'
-        pymummer.coords_file.convert_to_msp_crunch(
-            coords_file,
-            crunch_file,
-            ref_fai=ref_fasta + '.fai',
-            qry_fai=qry_fasta + '.fai'
+        '''Writes crunch file and shell script to start up ACT, showing comparison of ref and qry.
+           If self.act_files_list is not None, they are only added to the list of ACT files to write later'''
+        if self.act_files_list is None:
+            write_act_files(ref_fasta, qry_fasta, coords_file, outprefix, verbose=self.verbose)
+        else:
+            self.deferred_act_files.append([os.path.relpath(x) for x in (ref_fasta, qry_fasta, coords_file, outprefix)])
+
+
+    def _map_reads(self, ref_fasta, reads, bam):
+        circlator.mapping.bwa_mem(
+          ref_fasta,
+          reads,
+          bam,
+          threads=self.threads,
+          verbose=self.verbose,
+          sort_threads=self.sort_threads,
+          sort_mem=self.sort_mem,
+          index_cache=self.bwa_index_cache,
+          index_cache_size_gb=self.bwa_index_cache_size_gb,
         )
 
-        bash_script = outprefix + '.start_act.sh'
-        with open(bash_script, 'w') as f:
-            print('#!/usr/bin/env bash', file=f)
-            print('act', ref_fasta, crunch_file, qry_fasta, file=f)
 
-        pyfastaq.utils.syscall('chmod +x ' + bash_script)
+    def _filter_reads(self, bam, reads_prefix, contigs_to_use=None, discard_unmapped=False):
+        '''Runs BamFilter on bam. Returns the name of the reads file'''
+        bam_filter = circlator.bamfilter.BamFilter(
+            bam,
+            reads_prefix,
+            fastq_out=not self.spades_only_assembler,
+            contigs_to_use=contigs_to_use,
+            discard_unmapped=discard_unmapped,
+            split_all_reads=self.split_all_reads,
+            threads=self.threads,
+            compress=self.compress_reads,
+            compress_level=self.compress_level,
+        )
+        bam_filter.run()
+        return bam_filter.reads_outfile
+
+
+    def _reassemble(self, reads, assembler_dir):
+        '''Assembles the reads. Returns an Assembly'''
+        a = circlator.assemble.Assembler(
+            reads,
+            assembler_dir,
+            threads=self.threads,
+            careful=self.spades_careful,
+            only_assembler=self.spades_only_assembler,
+            verbose=self.verbose,
+            spades_kmers=self.spades_kmers,
+            spades_use_first_success=self.spades_use_first_success,
+            spades_concurrent_runs=self.spades_concurrent_runs,
+            spades_adaptive=self.spades_adaptive,
+            cache_dir=self.reassembly_cache_dir,
+            cache_size_gb=self.reassembly_cache_size_gb,
+            assembler=self.assembler,
+            genomeSize=self.length_cutoff,
+            data_type=self.data_type
+        )
+        a.run()
+        return circlator.assembly.Assembly(assembler_dir, assembler=self.assembler)
+
+
+    def _concatenate_reads(self, infiles, reads_prefix):
+        '''Concatenates the reads files made by _filter_reads (gzip and bgzip
+           files can be concatenated too), deleting them. Returns the name of the new file'''
+        outfile = circlator.bamfilter.reads_filename(reads_prefix, fastq_out=not self.spades_only_assembler, compress=self.compress_reads)
+        with open(outfile, 'wb') as f_out:
+            for filename in infiles:
+                with open(filename, 'rb') as f_in:
+                    shutil.copyfileobj(f_in, f_out)
+                os.unlink(filename)
+        return outfile
+
+
+    def _reads_from_contig_bams(self, contigs, reads_prefix):
+        '''Writes the reads that BamFilter gets from the contigs, using the BAM file
+           in self.contig_bams of each contig. Unmapped reads are not written.
+           Returns the name of the reads file'''
+        contigs_by_bam = {}
+        for contig in contigs:
+            contigs_by_bam.setdefault(self.contig_bams[contig], set()).add(contig)
+
+        reads_files = []
+        for i, bam in enumerate(sorted(contigs_by_bam)):
+            reads_files.append(self._filter_reads(bam, reads_prefix + '.' + str(i + 1), contigs_to_use=contigs_by_bam[bam], discard_unmapped=True))
+        return self._concatenate_reads(reads_files, reads_prefix)
+
+
+    @staticmethod
+    def _contigs_connected_by_hits(nucmer_hits, ref_names):
+        '''Input: dict of ref name => list of nucmer hits, and set of ref names.
+           Returns tuple (set of ref names, set of qry names) of all the contigs that
+           can be reached from ref_names by following hits, ref to qry to ref etc'''
+        qrys_by_ref = {}
+        refs_by_qry = {}
+        for ref_name, hits in nucmer_hits.items():
+            for hit in hits:
+                qrys_by_ref.setdefault(ref_name, set()).add(hit.qry_name)
+                refs_by_qry.setdefault(hit.qry_name, set()).add(ref_name)
+
+        refs = set()
+        qrys = set()
+        to_visit = list(ref_names)
+        while len(to_visit):
+            ref_name = to_visit.pop()
+            if ref_name in refs:
+                continue
+            refs.add(ref_name)
+            for qry_name in qrys_by_ref.get(ref_name, set()).difference(qrys):
+                qrys.add(qry_name)
+                to_visit.extend(refs_by_qry[qry_name])
+
+        return refs, qrys
+
+
+    def _local_remap_and_reassemble(self, nucmer_hits, iteration_prefix, iteration, log_fh, log_prefix):
+        '''After contigs were joined, remaps and reassembles only around the joins.
+           The reads that BamFilter took from the joined contigs (using their BAM files
+           from earlier rounds) are mapped to the new contigs. Those reads are
+           reassembled, together with the reads of the contigs connected to the joined
+           contigs by nucmer hits. The reassembly contigs that have no hits to the
+           connected contigs are kept, so their reads are not reassembled.
+           Returns False if nothing was done because all the contigs are connected'''
+        joined = set(self.contig_bams).difference(self.original_contigs)
+        new_contigs = set(self.original_contigs).difference(self.contig_bams)
+        connected_refs, connected_qrys = self._contigs_connected_by_hits(nucmer_hits, joined)
+        neighbours = connected_refs.difference(joined)
+        if len(connected_refs) == len(self.contig_bams):
+            print(log_prefix, '\tAll contigs are connected to the joined contigs by nucmer matches, so remapping and reassembling all reads', sep='', file=log_fh)
+            return False
+
+        print(log_prefix, '\tRemapping reads from joined contigs: ', ' '.join(sorted(joined)), sep='', file=log_fh)
+        print(log_prefix, '\tAlso reassembling reads from contigs: ', ' '.join(sorted(neighbours)), sep='', file=log_fh)
+        joined_reads = self._reads_from_contig_bams(joined, iteration_prefix + '.joined_contigs.reads')
+        new_contigs_fasta = iteration_prefix + '.new_contigs.fasta'
+        self._contigs_dict_to_file({x: self.original_contigs[x] for x in new_contigs}, new_contigs_fasta)
+        bam = iteration_prefix + '.bam'
+        self._map_reads(new_contigs_fasta, joined_reads, bam)
+        reads_files = [self._filter_reads(bam, iteration_prefix + '.new_contigs.reads')]
+        if len(neighbours):
+            reads_files.append(self._reads_from_contig_bams(neighbours, iteration_prefix + '.neighbours.reads'))
+        reads = self._concatenate_reads(reads_files, iteration_prefix + '.reads')
+
+        local_assembly = self._reassemble(reads, iteration_prefix + '.assembly')
+        kept_contigs = set(self.reassembly_contigs).difference(connected_qrys)
+        self.reassembly = circlator.assembly.SplicedAssembly(
+            iteration_prefix + '.reassembly.fasta',
+            [(self.reassembly, kept_contigs, ''), (local_assembly, None, 'iter' + str(iteration) + '.')],
+            self.assembler,
+        )
+
+        for contig in joined:
+            del self.contig_bams[contig]
+        self.contig_bams.update({x: bam for x in new_contigs})
+        return True
 
 
     def _iterative_bridged_contig_pair_merge(self, outprefix):
@@ -676,54 +1070,43 @@ class Merger:
         iteration = 1
 
         while made_a_join:
-            this_log_prefix = '[' + self.log_prefix + ' iterative_merge ' + str(iteration) + ']'
-            print(this_log_prefix, '\tUsing nucmer matches from ', nucmer_coords, sep='', file=log_fh)
-            self._run_nucmer(genome_fasta, self.reassembly.contigs_fasta, nucmer_coords)
-            act_prefix = outprefix + '.iter.' + str(iteration)
-            print(this_log_prefix, '\tYou can view the nucmer matches with ACT using: ./', act_prefix, '.start_act.sh', sep='', file=log_fh)
-            self._write_act_files(genome_fasta, self.reassembly.contigs_fasta, nucmer_coords, act_prefix)
-            nucmer_hits_by_ref = self._load_nucmer_hits(nucmer_coords)
-            made_a_join = self._merge_all_bridged_contigs(nucmer_hits_by_ref, self.original_contigs, self.reassembly_contigs, log_fh, this_log_prefix)
-            iteration += 1
-
-            if made_a_join:
-                print(this_log_prefix, '\tMade at least one merge. Remapping reads and reassembling',sep='', file=log_fh)
-                nucmer_coords = outprefix + '.iter.' + str(iteration) + '.coords'
-                genome_fasta = outprefix + '.iter.' + str(iteration) + '.merged.fasta'
-                self._contigs_dict_to_file(self.original_contigs, genome_fasta)
-                bam = outprefix + '.iter.' + str(iteration) + '.bam'
-
-                circlator.mapping.bwa_mem(
-                  genome_fasta,
-                  reads_to_map,
-                  bam,
-                  threads=self.threads,
-                  verbose=self.verbose,
-                )
-
-                reads_prefix = outprefix + '.iter.' + str(iteration) + '.reads'
-                reads_to_map =  reads_prefix + ('.fasta' if self.spades_only_assembler else '.fastq')
-                bam_filter = circlator.bamfilter.BamFilter(bam, reads_prefix, fastq_out=not self.spades_only_assembler, split_all_reads=self.split_all_reads)
-                bam_filter.run()
-                assembler_dir = outprefix + '.iter.' + str(iteration) + '.assembly'
-                a = circlator.assemble.Assembler(
-                    reads_prefix + ('.fasta' if self.spades_only_assembler else '.fastq'),
-                    assembler_dir,
-                    threads=self.threads,
-                    careful=self.spades_careful,
-                    only_assembler=self.spades_only_assembler,
-                    verbose=self.verbose,
-                    spades_kmers=self.spades_kmers,
-                    spades_use_first_success=self.spades_use_first_success,
-                    assembler=self.assembler,
-                    genomeSize=self.length_cutoff,
-                    data_type=self.data_type
-                )
-                a.run()
-                self.reassembly = circlator.assembly.Assembly(assembler_dir, assembler=self.assembler)
-                self.reassembly_contigs = self.reassembly.get_contigs()
-            elif iteration <= 2:
-                print(this_log_prefix, '\tNo contig merges were made',sep='', file=log_fh)
+            with circlator.perf.record('iteration ' + str(iteration)):
+                this_log_prefix = '[' + self.log_prefix + ' iterative_merge ' + str(iteration) + ']'
+                print(this_log_prefix, '\tUsing nucmer matches from ', nucmer_coords, sep='', file=log_fh)
+                if self.nucmer_hit_cache is None:
+                    self._run_nucmer(genome_fasta, self.reassembly.contigs_fasta, nucmer_coords)
+                    nucmer_hits_by_ref = self._load_nucmer_hits(nucmer_coords)
+                else:
+                    nucmer_hits_by_ref = self.nucmer_hit_cache.run(genome_fasta, self.reassembly.contigs_fasta, nucmer_coords).group_by('ref_name')
+                    print(this_log_prefix, '\tReused nucmer matches of ', self.nucmer_hit_cache.reused_pairs, ' contig pairs, aligned ', self.nucmer_hit_cache.aligned_pairs, ' contig pairs', sep='', file=log_fh)
+                act_prefix = outprefix + '.iter.' + str(iteration)
+                print(this_log_prefix, '\tYou can view the nucmer matches with ACT using: ./', act_prefix, '.start_act.sh', sep='', file=log_fh)
+                self._write_act_files(genome_fasta, self.reassembly.contigs_fasta, nucmer_coords, act_prefix)
+                made_a_join = self._merge_all_bridged_contigs(nucmer_hits_by_ref, self.original_contigs, self.reassembly_contigs, log_fh, this_log_prefix)
+                iteration += 1
+
+                if made_a_join:
+                    print(this_log_prefix, '\tMade at least one merge. Remapping reads and reassembling',sep='', file=log_fh)
+                    iteration_prefix = outprefix + '.iter.' + str(iteration)
+                    nucmer_coords = iteration_prefix + '.coords'
+                    genome_fasta = iteration_prefix + '.merged.fasta'
+                    self._contigs_dict_to_file(self.original_contigs, genome_fasta)
+
+                    # The local remap needs the BAM files of a full remap, so the first
+                    # remap is always of all the reads. If a later round does a full
+                    # remap, reads_to_map are the reads of the last full remap, which
+                    # include the reads of all the contigs' ends
+                    if len(self.contig_bams) == 0 or not self._local_remap_and_reassemble(nucmer_hits_by_ref, iteration_prefix, iteration, log_fh, this_log_prefix):
+                        bam = iteration_prefix + '.bam'
+                        self._map_reads(genome_fasta, reads_to_map, bam)
+                        reads_to_map = self._filter_reads(bam, iteration_prefix + '.reads')
+                        self.reassembly = self._reassemble(reads_to_map, iteration_prefix + '.assembly')
+                        if self.local_reassembly:
+                            self.contig_bams = {x: bam for x in self.original_contigs}
+
+                    self.reassembly_contigs = self.reassembly.get_contigs()
+                elif iteration <= 2:
+                    print(this_log_prefix, '\tNo contig merges were made',sep='', file=log_fh)
 
         pyfastaq.utils.close(log_fh)
         return genome_fasta, nucmer_coords, act_prefix + '.start_act.sh'
@@ -819,7 +1202,15 @@ class Merger:
             self._write_act_files(self.original_fasta, self.reassembly.contigs_fasta, nucmer_circularise_coords, self.outprefix + '.circularise')
         else:
             os.symlink(nucmer_coords_file, nucmer_circularise_coords)
-            os.symlink(act_script, self.outprefix + '.circularise.start_act.sh')
+            if self.act_files_list is None:
+                os.symlink(act_script, self.outprefix + '.circularise.start_act.sh')
+            else:
+                self.deferred_act_files.append([act_script, os.path.relpath(self.outprefix + '.circularise.start_act.sh')])
+
+        if self.act_files_list is not None:
+            with open(self.act_files_list, 'w') as f:
+                for l in self.deferred_act_files:
+                    print(*l, sep='\t', file=f)
 
         nucmer_hits = self._load_nucmer_hits(nucmer_circularise_coords)
         self._circularise_contigs(nucmer_hits)
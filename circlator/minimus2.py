@@ -53,9 +53,9 @@ class Merger:
         amos_afg_prefix = os.path.join(outdir, 'minimus2')
         amos_afg = amos_afg_prefix + '.afg'
         cmd = 'toAmos -s ' + infile + ' -o ' + amos_afg
-        common.syscall(cmd)
+        common.syscall(cmd, name='toAmos')
         cmd = 'minimus2 ' + amos_afg_prefix
-        return common.syscall(cmd, allow_fail=True)
+        return common.syscall(cmd, allow_fail=True, name='minimus2')
 
 
     def _run_minimus2_on_one_contig(self, contig):
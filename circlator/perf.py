@@ -0,0 +1,198 @@
+import json
+import time
+import resource
+import threading
+import contextlib
+from circlator import runner
+
+class Error (Exception): pass
+
+
+# columns of the summary table made by Profiler.summary_table
+summary_columns = [
+    ('name', 'Stage'),
+    ('wall_seconds', 'Wall(s)'),
+    ('cpu_seconds', 'CPU(s)'),
+    ('process_cpu_seconds', 'Process CPU(s)*'),
+    ('external_wall_seconds', 'Tools wall(s)'),
+    ('external_cpu_seconds', 'Tools CPU(s)'),
+    ('process_peak_rss_mb', 'Peak RSS so far(MB)*'),
+    ('external_max_rss_mb', 'Tools RSS(MB)'),
+    ('read_mb', 'Read(MB)*'),
+    ('written_mb', 'Written(MB)*'),
+]
+
+# what the columns of the summary table mean (with the names of the metrics in
+# the records in brackets), and their limits. Written to the JSON file, and meant
+# to be printed under the summary table
+notes = [
+    'CPU(s) (cpu_seconds): CPU time of the thread that ran the stage, plus python worker processes (eg the BamFilter and circularise pools) that finished during the stage. External tools are not included',
+    'Process CPU(s)* (process_cpu_seconds): as CPU(s), but of every thread of the python process, including helper threads such as the bgzf compressors',
+    'Peak RSS so far(MB)* (process_peak_rss_kb, in KB): peak memory of the python process from its start to the end of the stage, so it never goes down. stage_rss_increase_kb is how much the stage raised it, which is 0 unless it set a new peak',
+    'Read(MB)* and Written(MB)* (bytes_read and bytes_written): bytes read from and written to storage by every thread of the python process, its worker processes and the external tools. Reads from the page cache are not counted. Writes are counted when they are made, even if the file is deleted before it gets to the disk. Not known (.) if /proc/self/io cannot be read',
+    'Tools (external_*): totals of the external tools run in the stage, from the process report',
+    'When stages run at the same time, worker processes, and for columns marked *, all threads, are counted in each of them',
+]
+
+
+def _process_io_bytes():
+    '''Returns tuple (bytes read, bytes written) to and from storage by this process
+       so far, or None if /proc/self/io cannot be read (eg not on Linux)'''
+    try:
+        with open('/proc/self/io') as f:
+            fields = dict(line.split(':') for line in f)
+    except OSError:
+        return None
+    return int(fields['read_bytes']), int(fields['write_bytes'])
+
+
+def _children_io_bytes():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_inblock * runner.rusage_block_bytes, usage.ru_oublock * runner.rusage_block_bytes
+
+
+def _children_cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Profiler:
+    '''Collects performance metrics of blocks of code (see record). The metrics of
+       external programs come from the current runner.Report, so one must be set
+       for them to be included'''
+    def __init__(self):
+        self.records = []
+        self.lock = threading.Lock()
+
+
+    @contextlib.contextmanager
+    def record(self, name):
+        '''Measures the with block, which is called name. It gives the dict of metrics,
+           so that the caller can add to them. Records made
+           inside the block (in the same thread) have this one as their parent.
+           See notes for what the metrics mean'''
+        parents = runner.get_labels()
+        metrics = {
+            'name': name,
+            'parent': parents[-1] if len(parents) else None,
+            'bytes_read': None,
+            'bytes_written': None,
+        }
+        with self.lock:
+            self.records.append(metrics)
+
+        start_time = time.perf_counter()
+        start_cpu = time.thread_time()
+        start_process_cpu = time.process_time()
+        start_children_cpu = _children_cpu_seconds()
+        start_peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start_io = _process_io_bytes()
+        start_children_io = _children_io_bytes()
+        try:
+            with runner.label(name):
+                yield metrics
+        finally:
+            metrics['wall_seconds'] = round(time.perf_counter() - start_time, 3)
+            report = runner.get_report()
+            processes = [] if report is None else report.get_processes(labels=parents + (name,))
+            metrics['external_processes'] = len(processes)
+            metrics['external_wall_seconds'] = round(sum(x['wall_seconds'] for x in processes), 3)
+            metrics['external_cpu_seconds'] = round(sum(x['user_cpu_seconds'] + x['system_cpu_seconds'] for x in processes), 3)
+            metrics['external_max_rss_kb'] = max([x['max_rss_kb'] for x in processes], default=0)
+            metrics['external_bytes_read'] = sum(x['bytes_read'] for x in processes)
+            metrics['external_bytes_written'] = sum(x['bytes_written'] for x in processes)
+
+            # the external tools are child processes too, so they are taken off
+            # to leave the python worker processes
+            workers_cpu = max(0, _children_cpu_seconds() - start_children_cpu - metrics['external_cpu_seconds'])
+            metrics['cpu_seconds'] = round(time.thread_time() - start_cpu + workers_cpu, 3)
+            metrics['process_cpu_seconds'] = round(time.process_time() - start_process_cpu + workers_cpu, 3)
+            metrics['process_peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            metrics['stage_rss_increase_kb'] = metrics['process_peak_rss_kb'] - start_peak_rss
+
+            end_io = _process_io_bytes()
+            if start_io is not None and end_io is not None:
+                children_io = _children_io_bytes()
+                workers_read = max(0, children_io[0] - start_children_io[0] - metrics['external_bytes_read'])
+                workers_written = max(0, children_io[1] - start_children_io[1] - metrics['external_bytes_written'])
+                metrics['bytes_read'] = end_io[0] - start_io[0] + workers_read + metrics['external_bytes_read']
+                metrics['bytes_written'] = end_io[1] - start_io[1] + workers_written + metrics['external_bytes_written']
+
+
+    def get_records(self):
+        with self.lock:
+            return list(self.records)
+
+
+    def write_json(self, filename, **kwargs):
+        '''Writes all the records to a JSON file. Anything in kwargs is also written'''
+        data = dict(kwargs, notes=notes, records=self.get_records())
+        with open(filename, 'w') as f:
+            json.dump(data, f, indent=2)
+
+
+    def summary_table(self):
+        '''Returns list of lines of a table of the records, meant for people to read.
+           Records with a parent are indented under it'''
+        records = self.get_records()
+        children = {}
+        for record in records:
+            children.setdefault(record['parent'], []).append(record)
+
+        rows = []
+
+        seconds = lambda x: '.' if x is None else '{:.2f}'.format(x)
+        megabytes = lambda x, divisor: '.' if x is None else '{:.1f}'.format(x / divisor)
+
+        def add_rows(parent, depth):
+            for record in children.get(parent, []):
+                rows.append({
+                    'name': '  ' * depth + record['name'],
+                    'wall_seconds': seconds(record.get('wall_seconds')),
+                    'cpu_seconds': seconds(record.get('cpu_seconds')),
+                    'process_cpu_seconds': seconds(record.get('process_cpu_seconds')),
+                    'external_wall_seconds': seconds(record.get('external_wall_seconds')),
+                    'external_cpu_seconds': seconds(record.get('external_cpu_seconds')),
+                    'process_peak_rss_mb': megabytes(record.get('process_peak_rss_kb'), 1024),
+                    'external_max_rss_mb': megabytes(record.get('external_max_rss_kb'), 1024),
+                    'read_mb': megabytes(record['bytes_read'], 1024 * 1024),
+                    'written_mb': megabytes(record['bytes_written'], 1024 * 1024),
+                })
+                add_rows(record['name'], depth + 1)
+
+        top_level = {x['parent'] for x in records}.difference({x['name'] for x in records})
+        for parent in sorted(top_level, key=lambda x: (x is not None, str(x))):
+            add_rows(parent, 0)
+
+        widths = {key: max([len(heading)] + [len(str(x[key])) for x in rows]) for key, heading in summary_columns}
+        lines = ['  '.join(heading.ljust(widths[key]) if key == 'name' else heading.rjust(widths[key]) for key, heading in summary_columns)]
+        for row in rows:
+            lines.append('  '.join(str(row[key]).ljust(widths[key]) if key == 'name' else str(row[key]).rjust(widths[key]) for key, heading in summary_columns))
+        return lines
+
+
+_profiler = None
+
+
+def set_profiler(profiler):
+    '''Sets the Profiler used by record() (None to not profile). Returns the previous one'''
+    global _profiler
+    old_profiler = _profiler
+    _profiler = profiler
+    return old_profiler
+
+
+def get_profiler():
+    return _profiler
+
+
+@contextlib.contextmanager
+def record(name):
+    '''Same as Profiler.record, using the current profiler (see set_profiler).
+       Does nothing if there is no current profiler, apart from giving a dict
+       that the caller can put metrics in'''
+    if _profiler is None:
+        yield {}
+    else:
+        with _profiler.record(name) as metrics:
+            yield metrics
@@ -0,0 +1,267 @@
+import os
+import glob
+import json
+import shutil
+import fnmatch
+import concurrent.futures
+from circlator import __version__ as circlator_version
+from circlator import cache, perf
+
+class Error (Exception): pass
+
+
+def _matches_any(path, patterns):
+    '''Returns True iff path, or its basename, matches any of the glob patterns'''
+    return any(fnmatch.fnmatch(path, x) or fnmatch.fnmatch(os.path.basename(path), x) for x in patterns)
+
+
+class Stage:
+    def __init__(self, name, function, inputs=None, outputs=None, params=None, exclude=None, depends=None, threads=1, manifest=True):
+        '''One stage of a pipeline. name is used as the prefix of the stage's manifest
+           file (eg 01.mapreads). function is called with no arguments to run the stage.
+           inputs = list of files and directories that the stage uses. outputs = list of
+           glob patterns of the files and directories that the stage makes, or a function
+           that returns the list, for outputs that are only known once the inputs have
+           been made. params = dict
+           of anything else that changes the output of the stage (must be JSON serializable).
+           exclude = glob patterns of files that match the inputs or outputs (or are
+           inside them, if they are directories), but are made by another stage.
+           depends = names of stages that must finish first, as well as those that
+           make the inputs. threads = number of CPUs that the stage uses.
+           If manifest is False, the stage is always run and no manifest is written'''
+        self.name = name
+        self.function = function
+        self.inputs = [] if inputs is None else [x for x in inputs if x is not None]
+        self.outputs = [] if outputs is None else outputs
+        self.params = {} if params is None else params
+        self.exclude = [] if exclude is None else exclude
+        self.depends = [] if depends is None else depends
+        self.threads = threads
+        self.manifest = manifest
+
+
+    def manifest_file(self):
+        return self.name + '.manifest.json'
+
+
+    def output_patterns(self):
+        return self.outputs() if callable(self.outputs) else self.outputs
+
+
+    def output_paths(self):
+        '''Returns sorted list of the files and directories that match the output patterns,
+           not including any inputs, manifest files, or excluded files'''
+        exclude = {os.path.abspath(x) for x in self.inputs}
+        paths = set()
+        for pattern in self.output_patterns():
+            for path in glob.glob(pattern):
+                if os.path.abspath(path) not in exclude and not path.endswith('.manifest.json') and not _matches_any(path, self.exclude):
+                    paths.add(path)
+        return sorted(paths)
+
+
+    def depends_on(self, other):
+        '''Returns True iff this stage must wait for the stage other to finish, because it
+           is in self.depends, or one of the inputs is (or is inside) an output of other'''
+        if other.name in self.depends:
+            return True
+
+        for path in self.inputs:
+            path = os.path.normpath(path)
+            while path not in ['', os.sep]:
+                if any(fnmatch.fnmatch(path, x) for x in other.output_patterns()) and not _matches_any(path, other.exclude):
+                    return True
+                path = os.path.dirname(path)
+
+        return False
+
+
+def path_state(path, old_state=None, exclude=None):
+    '''Returns the state of a file or directory, for writing in a manifest. Is None if
+       path does not exist. For a file, it is a dict with the size, modification time
+       and sha256. For a directory, it is {'dir': dict of name -> state of everything in
+       the directory, except names matching the glob patterns in exclude}. If old_state
+       is given and a file has the same size and modification time, its sha256 is taken
+       from old_state instead of reading the file'''
+    if not os.path.exists(path):
+        return None
+    elif os.path.isdir(path):
+        exclude = [] if exclude is None else exclude
+        old_files = old_state.get('dir', {}) if isinstance(old_state, dict) else {}
+        return {'dir': {x: path_state(os.path.join(path, x), old_files.get(x), exclude=exclude) for x in sorted(os.listdir(path)) if not _matches_any(x, exclude)}}
+
+    stat = os.stat(path)
+    if isinstance(old_state, dict) and old_state.get('size') == stat.st_size and old_state.get('mtime_ns') == stat.st_mtime_ns:
+        sha256 = old_state['sha256']
+    else:
+        sha256 = cache.file_hash(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': sha256}
+
+
+def state_hashes(state):
+    '''Returns the sha256 hashes in a state made by path_state, without the sizes and times'''
+    if state is None:
+        return None
+    elif 'dir' in state:
+        return {x: state_hashes(y) for x, y in state['dir'].items()}
+    else:
+        return state['sha256']
+
+
+class Pipeline:
+    '''Runs stages, writing a manifest file for each one when it finishes. If resume
+       is True, a stage is skipped if its manifest shows that it was already run with
+       the same inputs and parameters, and its outputs have not changed since'''
+    def __init__(self, resume=False, verbose=False):
+        self.resume = resume
+        self.verbose = verbose
+        self.stages_run = []
+        self.stages_skipped = []
+
+
+    @staticmethod
+    def _load_manifest(stage):
+        try:
+            with open(stage.manifest_file()) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+
+    def _manifest_matches(self, stage, manifest):
+        if manifest is None or manifest.get('circlator_version') != circlator_version or manifest.get('params') != stage.params:
+            return False
+
+        recorded_inputs = manifest.get('inputs', {})
+        if sorted(recorded_inputs) != sorted(stage.inputs):
+            return False
+
+        for path in stage.inputs:
+            if state_hashes(path_state(path, recorded_inputs[path], exclude=stage.exclude)) != state_hashes(recorded_inputs[path]):
+                return False
+
+        recorded_outputs = manifest.get('outputs', {})
+        if sorted(recorded_outputs) != stage.output_paths():
+            return False
+
+        for path, state in recorded_outputs.items():
+            if state_hashes(path_state(path, state, exclude=stage.exclude)) != state_hashes(state):
+                return False
+
+        return True
+
+
+    def _write_manifest(self, stage, manifest):
+        tmp_file = stage.manifest_file() + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.rename(tmp_file, stage.manifest_file())
+
+
+    @staticmethod
+    def _run_function(stage):
+        '''Runs the stage's function, profiling it if there is a current perf.Profiler'''
+        with perf.record(stage.name):
+            stage.function()
+
+
+    def run_stage(self, stage):
+        '''Runs the stage, unless resuming and it has already been run. Returns True
+           if the stage was run, False if it was skipped'''
+        if not stage.manifest:
+            self._run_function(stage)
+            self.stages_run.append(stage.name)
+            return True
+
+        old_manifest = self._load_manifest(stage)
+        if self.resume and self._manifest_matches(stage, old_manifest):
+            if self.verbose:
+                print('Skipping', stage.name, 'because it has already been run and nothing has changed', flush=True)
+            self.stages_skipped.append(stage.name)
+            return False
+
+        if self.verbose:
+            print('{:_^79}'.format(' Running ' + stage.name + ' '), flush=True)
+
+        for filename in [stage.manifest_file()] + stage.output_paths():
+            if os.path.isdir(filename):
+                shutil.rmtree(filename)
+            elif os.path.lexists(filename):
+                os.unlink(filename)
+
+        old_inputs = {} if old_manifest is None else old_manifest.get('inputs', {})
+        input_states = {x: path_state(x, old_inputs.get(x), exclude=stage.exclude) for x in stage.inputs}
+        missing_inputs = [x for x in stage.inputs if input_states[x] is None]
+        if len(missing_inputs):
+            raise Error('Input file(s) for stage ' + stage.name + ' not found: ' + ' '.join(missing_inputs))
+
+        self._run_function(stage)
+
+        self._write_manifest(stage, {
+            'stage': stage.name,
+            'circlator_version': circlator_version,
+            'params': stage.params,
+            'inputs': input_states,
+            'outputs': {x: path_state(x, exclude=stage.exclude) for x in stage.output_paths()},
+        })
+        self.stages_run.append(stage.name)
+        return True
+
+
+    @staticmethod
+    def dependencies(stages):
+        '''Returns dict of stage name -> set of names of the stages it must wait for.
+           A stage can only depend on stages before it in the list'''
+        names = [x.name for x in stages]
+        if len(set(names)) != len(names):
+            raise Error('Stage names must be unique. Got: ' + ' '.join(names))
+
+        deps = {}
+        for i, stage in enumerate(stages):
+            unknown = set(stage.depends).difference(names[:i])
+            if len(unknown):
+                raise Error('Stage ' + stage.name + ' depends on stage(s) that are not before it: ' + ' '.join(sorted(unknown)))
+            deps[stage.name] = {x.name for x in stages[:i] if stage.depends_on(x)}
+        return deps
+
+
+    def run(self, stages, threads=1):
+        '''Runs the stages (using run_stage), with each one starting as soon as all the
+           stages it depends on have finished. Stages that do not depend on each other
+           run at the same time, as long as their total threads is not more than threads
+           (a stage that needs more than threads is run on its own). If a stage fails,
+           no more stages are started, and the error is raised once the running stages
+           have finished'''
+        deps = self.dependencies(stages)
+        waiting = list(stages)
+        finished = set()
+        running = {}
+        used_threads = 0
+        error = None
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(stages))) as executor:
+            while len(waiting) or len(running):
+                while error is None:
+                    ready = [x for x in waiting if deps[x.name].issubset(finished)]
+                    to_start = [x for x in ready if used_threads + x.threads <= threads or len(running) == 0]
+                    if len(to_start) == 0:
+                        break
+                    stage = to_start[0]
+                    waiting.remove(stage)
+                    running[executor.submit(self.run_stage, stage)] = stage
+                    used_threads += stage.threads
+
+                if len(running) == 0:
+                    break
+
+                done, not_done = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    used_threads -= stage.threads
+                    if future.exception() is None:
+                        finished.add(stage.name)
+                    elif error is None:
+                        error = future.exception()
+
+        if error is not None:
+            raise error
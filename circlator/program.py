@@ -1,10 +1,65 @@
 import shutil
 import os
 import re
+import json
+import tempfile
 import subprocess
-from distutils.version import LooseVersion
+import collections
 from circlator import common
 
+# Getting the version of a program means running it, which can be slow (eg
+# spades.py). Versions are remembered, keyed by the executable's real path,
+# modification time and size, so each program is only run once per process.
+# They are also saved in a file, so each program is only run once per
+# installation. The file can be set with this environment variable (set it
+# to an empty string to not use a file). Default is in ~/.cache/circlator/
+version_cache_env = 'CIRCLATOR_PROGRAM_CACHE'
+_versions = {}
+_which = {}
+
+# counts of how each version was found: 'run', 'memory' or 'file'
+version_stats = collections.Counter()
+
+
+def version_cache_file():
+    '''Returns name of file of cached program versions, or None if not using a file'''
+    filename = os.environ.get(version_cache_env)
+    if filename is None:
+        cache_home = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+        return os.path.join(cache_home, 'circlator', 'program_versions.json')
+    return filename if filename != '' else None
+
+
+def _load_version_cache(filename):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_version_cache(filename, key, value):
+    '''Adds key => value to the cache file. Failing to write it is not an error,
+       it just means the program will be run again next time'''
+    try:
+        directory = os.path.dirname(os.path.abspath(filename))
+        os.makedirs(directory, exist_ok=True)
+        cache = _load_version_cache(filename)
+        cache[key] = value
+        fd, tmp_file = tempfile.mkstemp(prefix=os.path.basename(filename) + '.tmp.', dir=directory)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(cache, f, indent=2, sort_keys=True)
+        os.rename(tmp_file, filename)
+    except OSError:
+        pass
+
+
+def version_key(version):
+    '''Returns list that can be used to compare versions. Splits the version
+       into numbers and letters, the same as distutils LooseVersion, which is
+       not used because importing distutils is slow'''
+    return [int(x) if x.isdigit() else x for x in re.split(r'(\d+|[a-z]+|\.)', version) if x and x != '.']
+
 
 class Program:
     def __init__(self, name, version_cmd, version_regex, environment_var=None, debug=False):
@@ -27,7 +82,10 @@ class Program:
         if self.debug:
             print(self.name, '- checking which(' + self.path + ')', flush=True)
 
-        self.from_which = shutil.which(self.path)
+        which_key = (self.path, os.environ.get('PATH'))
+        if which_key not in _which:
+            _which[which_key] = shutil.which(self.path)
+        self.from_which = _which[which_key]
 
         if self.debug:
             print('   ... got: "', self.from_which, '"', sep='', flush=True)
@@ -49,8 +107,44 @@ class Program:
         if not self.in_path():
             if self.debug:
                 print(' ... not in path so cannot get version', flush=True)
+            return
+
+        try:
+            real_path = os.path.realpath(self.from_which)
+            stat = os.stat(real_path)
+        except OSError:
+            self.version = self._run_version_cmd()
+            return
+
+        memory_key = (real_path, stat.st_mtime_ns, stat.st_size, self.version_cmd)
+        if memory_key in _versions:
+            version_stats['memory'] += 1
+            self.version = _versions[memory_key]
+            if self.debug:
+                print(' ... already got version in this process:', self.version, flush=True)
+            return
+
+        cache_file = version_cache_file()
+        file_key = real_path + '\t' + self.version_cmd
+        file_value = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+        if cache_file is not None:
+            cached = _load_version_cache(cache_file).get(file_key, {})
+            if cached.get('version') is not None and {x: cached.get(x) for x in file_value} == file_value:
+                version_stats['file'] += 1
+                self.version = _versions[memory_key] = cached['version']
+                if self.debug:
+                    print(' ... got version from cache file ', cache_file, ': ', self.version, sep='', flush=True)
                 return
 
+        self.version = _versions[memory_key] = self._run_version_cmd()
+        if cache_file is not None and self.version is not None:
+            file_value['version'] = self.version
+            _save_version_cache(cache_file, file_key, file_value)
+
+
+    def _run_version_cmd(self):
+        '''Runs the program to get its version. Returns the version, or None if not found'''
+        version_stats['run'] += 1
         cmd = self.exe() + ' ' + self.version_cmd
         if self.debug:
             print('Running this command to get version:', cmd)
@@ -67,11 +161,11 @@ class Program:
                 if self.debug:
                     print('Match to this line:', line)
                     print('Got version:', hits.group(1), flush=True)
-                self.version = hits.group(1)
-                break
-        else:
-            if self.debug:
-                print('No match found to the regex', flush=True)
+                return hits.group(1)
+
+        if self.debug:
+            print('No match found to the regex', flush=True)
+        return None
 
 
 
@@ -79,14 +173,14 @@ class Program:
         v = self.version
         if v is None:
             return None
-        return LooseVersion(v) >= LooseVersion(min_version)
+        return version_key(v) >= version_key(min_version)
 
 
     def version_at_most(self, max_version):
         v = self.version
         if v is None:
             return None
-        return LooseVersion(v) <= LooseVersion(max_version)
+        return version_key(v) <= version_key(max_version)
 
 
     def exe(self):
@@ -0,0 +1,285 @@
+import os
+import json
+import time
+import signal
+import resource
+import contextlib
+import contextvars
+import tempfile
+import threading
+import subprocess
+
+class Error (Exception): pass
+
+
+# environment variable that sets the default timeout in seconds of every process
+timeout_env = 'CIRCLATOR_PROCESS_TIMEOUT'
+
+# number of bytes from the end of a process's output that are kept for error messages
+output_tail_bytes = 10000
+
+# seconds between asking a process to stop (SIGTERM) and killing it (SIGKILL)
+kill_grace_seconds = 5
+
+# shell used for commands that are run with pipefail
+bash = '/bin/bash'
+
+# size in bytes of the blocks counted by ru_inblock and ru_oublock
+rusage_block_bytes = 512
+
+
+class Report:
+    '''Collects the metrics of every process run by run() while it is the current
+       report (see set_report). If log_dir is given, the output of each process is
+       written to a numbered log file in log_dir. Otherwise the output is only kept
+       until the process finishes. timeout is the default timeout in seconds of
+       each process'''
+    def __init__(self, log_dir=None, timeout=None):
+        self.log_dir = None if log_dir is None else os.path.abspath(log_dir)
+        self.timeout = timeout
+        self.processes = []
+        self.lock = threading.Lock()
+        self.log_files = 0
+        if self.log_dir is not None:
+            os.makedirs(self.log_dir, exist_ok=True)
+            self.log_files = len([x for x in os.listdir(self.log_dir) if x.endswith('.log')])
+
+
+    def new_log_file(self, name):
+        '''Returns name of new log file for process called name, or None if not writing log files'''
+        if self.log_dir is None:
+            return None
+        with self.lock:
+            self.log_files += 1
+            return os.path.join(self.log_dir, str(self.log_files).zfill(4) + '.' + name.replace(' ', '_').replace(os.sep, '_') + '.log')
+
+
+    def add(self, metrics):
+        with self.lock:
+            self.processes.append(metrics)
+
+
+    def get_processes(self, labels=None):
+        '''Returns list of metrics of the processes. If labels is given, only
+           returns processes whose labels start with labels'''
+        with self.lock:
+            processes = list(self.processes)
+        if labels is None:
+            return processes
+        return [x for x in processes if tuple(x['labels'][:len(labels)]) == tuple(labels)]
+
+
+    def summary(self):
+        '''Returns dict of totals of all processes'''
+        processes = self.get_processes()
+        return {
+            'processes': len(processes),
+            'failed': sum(1 for x in processes if x['status'] != 'ok'),
+            'wall_seconds': round(sum(x['wall_seconds'] for x in processes), 3),
+            'user_cpu_seconds': round(sum(x['user_cpu_seconds'] for x in processes), 3),
+            'system_cpu_seconds': round(sum(x['system_cpu_seconds'] for x in processes), 3),
+            'max_rss_kb': max([x['max_rss_kb'] for x in processes], default=0),
+            'bytes_read': sum(x['bytes_read'] for x in processes),
+            'bytes_written': sum(x['bytes_written'] for x in processes),
+        }
+
+
+    def write_json(self, filename):
+        with open(filename, 'w') as f:
+            json.dump({'summary': self.summary(), 'processes': self.get_processes()}, f, indent=2)
+
+
+_report = None
+_labels = contextvars.ContextVar('circlator_runner_labels', default=())
+
+
+def set_report(report):
+    '''Sets the Report that gets the metrics of every process (None for no report).
+       Returns the previous one'''
+    global _report
+    old_report = _report
+    _report = report
+    return old_report
+
+
+def get_report():
+    return _report
+
+
+def get_labels():
+    return _labels.get()
+
+
+@contextlib.contextmanager
+def label(name):
+    '''Adds name to the end of the labels of every process run in the with block.
+       Applies to the current thread, and to threads that run their work inside
+       a copy of its context (contextvars.copy_context)'''
+    token = _labels.set(_labels.get() + (name,))
+    try:
+        yield
+    finally:
+        _labels.reset(token)
+
+
+@contextlib.contextmanager
+def timed(name, cmd=None):
+    '''For programs that are run by other packages instead of by run() (eg nucmer,
+       run by pymummer). Adds metrics of the with block to the current report. The
+       CPU time and bytes read and written are of all child processes that finished
+       in the block, and max_rss_kb is 0 unless the biggest child process so far
+       finished in the block'''
+    start_time = time.perf_counter()
+    start_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    status = 'failed'
+    try:
+        yield
+        status = 'ok'
+    finally:
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        if _report is not None:
+            _report.add({
+                'name': name,
+                'command': cmd,
+                'labels': list(_labels.get()),
+                'status': status,
+                'returncode': None,
+                'wall_seconds': round(time.perf_counter() - start_time, 3),
+                'user_cpu_seconds': round(usage.ru_utime - start_usage.ru_utime, 3),
+                'system_cpu_seconds': round(usage.ru_stime - start_usage.ru_stime, 3),
+                'max_rss_kb': usage.ru_maxrss if usage.ru_maxrss > start_usage.ru_maxrss else 0,
+                'bytes_read': (usage.ru_inblock - start_usage.ru_inblock) * rusage_block_bytes,
+                'bytes_written': (usage.ru_oublock - start_usage.ru_oublock) * rusage_block_bytes,
+                'log_file': None,
+            })
+
+
+def _default_timeout():
+    if _report is not None and _report.timeout is not None:
+        return _report.timeout
+    timeout = os.environ.get(timeout_env)
+    return None if timeout in [None, ''] else float(timeout)
+
+
+def _read_tail(fh):
+    fh.flush()
+    size = fh.seek(0, os.SEEK_END)
+    fh.seek(max(0, size - output_tail_bytes))
+    return fh.read().decode(errors='replace')
+
+
+def _exit_code(wait_status):
+    '''Returns exit code from status returned by os.wait4, the same as Popen.returncode'''
+    if os.WIFSIGNALED(wait_status):
+        return -os.WTERMSIG(wait_status)
+    return os.WEXITSTATUS(wait_status)
+
+
+def _signal_group(process, sig):
+    try:
+        os.killpg(process.pid, sig)
+    except ProcessLookupError:
+        pass
+
+
+def _kill(process, finished):
+    '''Sends SIGTERM to the process group, then SIGKILL if it has not
+       finished (the threading.Event finished is not set) after kill_grace_seconds'''
+    _signal_group(process, signal.SIGTERM)
+    if not finished.wait(kill_grace_seconds):
+        _signal_group(process, signal.SIGKILL)
+
+
+def run(cmd, name=None, log_file=None, allow_fail=False, verbose=False, timeout=None, stop=None, pipefail=False):
+    '''Runs cmd with the shell, in a new session so that it and everything it starts
+       can be killed together. stdout and stderr are written to log_file as they are
+       made (default is a file in the log directory of the current Report, or else a
+       temporary file). The process is killed if it runs for longer than timeout seconds,
+       or when stop (a threading.Event) is set: it is sent SIGTERM, then SIGKILL if it
+       is still running kill_grace_seconds later. If pipefail is True, cmd is run by
+       bash with pipefail set, so that it fails if any command in a pipe fails, not
+       only the last one. name is used in the report and log file name (default is
+       the name of the program). The labels (see label()) are added to the metrics. Returns dict of metrics, including
+       status ('ok', 'failed', 'timeout' or 'stopped'), returncode, wall_seconds,
+       user_cpu_seconds, system_cpu_seconds, max_rss_kb, bytes_read and bytes_written
+       (to and from storage, so not counting reads from the page cache), and output
+       (the end of the output). Raises Error if the status is not 'ok', unless allow_fail is True'''
+    if name is None:
+        name = os.path.basename(cmd.split()[0]) if len(cmd.split()) else 'cmd'
+    if timeout is None:
+        timeout = _default_timeout()
+    if log_file is None and _report is not None:
+        log_file = _report.new_log_file(name)
+    if verbose:
+        print('syscall:', cmd, flush=True)
+
+    with (open(log_file, 'w+b') if log_file is not None else tempfile.TemporaryFile()) as log_fh:
+        start_time = time.perf_counter()
+        if pipefail:
+            process = subprocess.Popen([bash, '-o', 'pipefail', '-c', cmd], stdout=log_fh, stderr=subprocess.STDOUT, start_new_session=True)
+        else:
+            process = subprocess.Popen(cmd, shell=True, stdout=log_fh, stderr=subprocess.STDOUT, start_new_session=True)
+        killed_because = []
+        finished = threading.Event()
+
+        def watch():
+            while not finished.wait(0.2):
+                if timeout is not None and time.perf_counter() - start_time > timeout:
+                    killed_because.append('timeout')
+                elif stop is not None and stop.is_set():
+                    killed_because.append('stopped')
+                else:
+                    continue
+                _kill(process, finished)
+                return
+
+        watcher = None
+        if timeout is not None or stop is not None:
+            watcher = threading.Thread(target=watch, daemon=True)
+            watcher.start()
+
+        # wait4 instead of process.wait(), to get the resource usage of the process
+        # and its children
+        try:
+            pid, wait_status, rusage = os.wait4(process.pid, 0)
+        except BaseException:
+            _signal_group(process, signal.SIGTERM)
+            try:
+                process.wait(timeout=kill_grace_seconds)
+            except subprocess.TimeoutExpired:
+                _signal_group(process, signal.SIGKILL)
+                process.wait()
+            raise
+        finally:
+            finished.set()
+            if watcher is not None:
+                watcher.join()
+
+        process.returncode = _exit_code(wait_status)
+        metrics = {
+            'name': name,
+            'command': cmd,
+            'labels': list(_labels.get()),
+            'status': killed_because[0] if len(killed_because) else ('ok' if process.returncode == 0 else 'failed'),
+            'returncode': process.returncode,
+            'wall_seconds': round(time.perf_counter() - start_time, 3),
+            'user_cpu_seconds': round(rusage.ru_utime, 3),
+            'system_cpu_seconds': round(rusage.ru_stime, 3),
+            'max_rss_kb': rusage.ru_maxrss,
+            'bytes_read': rusage.ru_inblock * rusage_block_bytes,
+            'bytes_written': rusage.ru_oublock * rusage_block_bytes,
+            'log_file': log_file,
+        }
+
+        if _report is not None:
+            _report.add(metrics)
+
+        metrics['output'] = _read_tail(log_fh) if metrics['status'] != 'ok' else None
+
+    if metrics['status'] != 'ok' and not allow_fail:
+        message = 'Error running this command (' + metrics['status'] + ', exit code ' + str(process.returncode) + '):\n' + cmd
+        if log_file is not None:
+            message += '\nThe output is in the file ' + log_file
+        raise Error(message + '\nThe end of the output was:\n' + metrics['output'])
+
+    return metrics
@@ -30,8 +30,7 @@ class StartFixer:
 
         if not os.path.exists(input_assembly_fa):
             raise Error('Error! File not found: ' + input_assembly_fa)
-        self.input_assembly = {}
-        pyfastaq.tasks.file_to_dict(input_assembly_fa, self.input_assembly)
+        self.input_assembly = circlator.contig_store.ContigStore(input_assembly_fa)
 
         self.min_percent_identity = min_percent_identity
         self.promer_mincluster = promer_mincluster
@@ -130,7 +129,8 @@ class StartFixer:
             maxmatch=True,
             mincluster=promer_mincluster,
         )
-        prunner.run()
+        with circlator.runner.timed('promer'):
+            prunner.run()
 
         circularized = {} # original_contig_name -> promer match
         file_reader = pymummer.coords_file.reader(promer_out)
@@ -195,7 +195,7 @@ class StartFixer:
           p_option
         ])
 
-        circlator.common.syscall(cmd)
+        circlator.common.syscall(cmd, name='prodigal')
         circularized = {}
         best_dist = {}
 
@@ -1,7 +1,10 @@
+import importlib
+
 __all__ = [
     'all',
     'assemble',
     'bam2reads',
+    'batch',
     'clean',
     'fixstart',
     'get_dnaa',
@@ -12,4 +15,13 @@ __all__ = [
     'version',
 ]
 
-from circlator.tasks import *
+
+def __getattr__(name):
+    '''Tasks are imported when they are first used (see circlator/__init__.py)'''
+    if name in __all__:
+        return importlib.import_module('circlator.tasks.' + name)
+    raise AttributeError("module 'circlator.tasks' has no attribute '" + name + "'")
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
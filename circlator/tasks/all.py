@@ -1,6 +1,8 @@
 import argparse
+import io
 import os
 import sys
+import time
 import pyfastaq
 import circlator
 
@@ -12,7 +14,7 @@ def print_message(m, opts):
         print(m)
 
 
-def run():
+def get_parser():
     parser = argparse.ArgumentParser(
         description = 'Run mapreads, bam2reads, assemble, merge, clean, fixstart',
         usage = 'circlator all [options] <assembly.fasta> <reads.fasta/q> <output directory>')
@@ -24,20 +26,33 @@ def run():
     parser.add_argument('--data_type', choices=circlator.common.allowed_data_types, help='String representing one of the 4 type of data analysed (only used for Canu) [%(default)s]', default='pacbio-corrected')
     parser.add_argument('assembly', help='Name of original assembly', metavar='assembly.fasta')
     parser.add_argument('reads', help='Name of corrected reads FASTA or FASTQ file', metavar='reads.fasta/q')
-    parser.add_argument('outdir', help='Name of output directory (must not already exist)', metavar='output directory')
+    parser.add_argument('--resume', action='store_true', help='Resume a previous run in the same output directory. Stages that have already finished are skipped, unless their input files, options or output files have changed since')
+    parser.add_argument('--timeout', type=float, help='Kill any external program (bwa, SPAdes, nucmer etc) that runs for longer than this many seconds, and fail. The output of every program is in the directory 00.process_logs, and their run times and memory use are in 00.process_report.json [no timeout]', metavar='FLOAT')
+    parser.add_argument('--profile', action='store_true', help='Record the wall time, CPU time, peak memory, bytes read and written, and time spent in external programs of each stage (and each iteration of merging) in the file 00.perf.json, and print a summary table')
+    parser.add_argument('outdir', help='Name of output directory (must not already exist, unless --resume is used)', metavar='output directory')
 
     mapreads_group = parser.add_argument_group('mapreads options')
     mapreads_group.add_argument('--bwa_opts', help='BWA options, in quotes [%(default)s]', default='-x pacbio', metavar='STRING')
+    mapreads_group.add_argument('--bwa_index_cache', help='Directory of cached bwa indexes, so that the same assembly is only indexed once, even between different runs of circlator. Can also be set with the environment variable CIRCLATOR_BWA_INDEX_CACHE', metavar='DIRNAME')
+    mapreads_group.add_argument('--bwa_index_cache_size', type=float, help='Max total size in GB of the bwa index cache. Least recently used indexes are deleted to keep below this size. Can also be set with the environment variable CIRCLATOR_BWA_INDEX_CACHE_SIZE [20]', metavar='FLOAT')
+    mapreads_group.add_argument('--sort_threads', type=int, help='Number of threads used by samtools sort [min(4, --threads)]', metavar='INT')
+    mapreads_group.add_argument('--sort_mem', type=int, help='Memory per thread used by samtools sort, in MB [500 / sort threads]', metavar='INT')
 
     bam2reads_group = parser.add_argument_group('bam2reads options')
     bam2reads_group.add_argument('--b2r_discard_unmapped', action='store_true', help='Use this to not keep unmapped reads')
     bam2reads_group.add_argument('--b2r_only_contigs', help='File of contig names (one per line). Only reads that map to these contigs are kept (and unmapped reads, unless --b2r_discard_unmapped is used). Note: the whole assembly is still used as a reference when mapping', metavar='FILENAME')
     bam2reads_group.add_argument('--b2r_length_cutoff', type=int, help='All reads mapped to contigs shorter than this will be kept [%(default)s]', default=100000, metavar='INT')
+    bam2reads_group.add_argument('--b2r_compress', choices=circlator.bgzf.allowed_formats, help='Compress the reads files written by bam2reads (and by the iterative merging)')
+    bam2reads_group.add_argument('--b2r_compress_level', type=int, choices=range(10), help='Compression level, from 0 (fastest) to 9 (smallest). Only used with --b2r_compress [%(default)s]', default=6, metavar='INT')
     bam2reads_group.add_argument('--b2r_min_read_length', type=int, help='Minimum length of read to output [%(default)s]', default=250, metavar='INT')
 
     assemble_group = parser.add_argument_group('assemble options')
     parser.add_argument('--assemble_spades_k', help='Comma separated list of kmers to use when running SPAdes. Max kmer is 127 and each kmer should be an odd integer [%(default)s]', default='127,117,107,97,87,77', metavar='k1,k2,k3,...')
     parser.add_argument('--assemble_spades_use_first', action='store_true', help='Use the first successful SPAdes assembly. Default is to try all kmers and use the assembly with the largest N50')
+    parser.add_argument('--assemble_spades_adaptive', action='store_true', help='Stop running SPAdes kmers early, once one gives an assembly with a circular contig, or the N50 has not got bigger for 2 kmers in a row. Ignored if --assemble_spades_use_first is used')
+    parser.add_argument('--assemble_spades_concurrent_runs', type=int, help='Number of SPAdes kmers to run at the same time. The threads given by --threads are split between them [threads / 4]', metavar='INT')
+    parser.add_argument('--assemble_cache_dir', help='Directory of cached assemblies. If the same reads have already been assembled with the same options, the cached assembly is used instead of running the assembler again. Can also be set with the environment variable CIRCLATOR_REASSEMBLY_CACHE', metavar='DIRNAME')
+    parser.add_argument('--assemble_cache_size', type=float, help='Max total size in GB of the assembly cache. Least recently used assemblies are deleted to keep below this size. Can also be set with the environment variable CIRCLATOR_REASSEMBLY_CACHE_SIZE [5]', metavar='FLOAT')
     parser.add_argument('--assemble_not_careful', action='store_true', help='Do not use the --careful option with SPAdes (used by default)')
     parser.add_argument('--assemble_not_only_assembler', action='store_true', help='Do not use the --assemble-only option with SPAdes (used by default). Important: with this option, the input reads must be in FASTQ format, otherwise SPAdes will crash because it needs quality scores to correct the reads.')
 
@@ -50,6 +65,8 @@ def run():
     merge_group.add_argument('--merge_breaklen', type=int, help='breaklen option used by nucmer [%(default)s]', metavar='INT', default=500)
     merge_group.add_argument('--merge_ref_end', type=int, help='max distance allowed between nucmer hit and end of input assembly contig [%(default)s]', metavar='INT', default=15000)
     merge_group.add_argument('--merge_reassemble_end', type=int, help='max distance allowed between nucmer hit and end of reassembly contig [%(default)s]', metavar='INT', default=1000)
+    merge_group.add_argument('--merge_incremental_nucmer', action='store_true', help='When iteratively merging contigs, only run nucmer on contigs that are new in each round, reusing the matches of contigs seen in earlier rounds')
+    merge_group.add_argument('--merge_local_reassembly', action='store_true', help='When iteratively merging contigs, after the first remap only remap and reassemble the reads around the new joins, reusing the earlier BAM files and reassembly contigs for the other contigs')
     merge_group.add_argument('--no_pair_merge', action='store_true', help='Do not merge pairs of contigs when running merge task')
 
     clean_group = parser.add_argument_group('clean options')
@@ -65,15 +82,24 @@ def run():
     fixstart_group.add_argument('--fixstart_mincluster', type=int, help='The -c|mincluster option of promer. If this option is used, it overrides promer\'s default value', metavar='INT')
     fixstart_group.add_argument('--fixstart_min_id', type=float, help='Minimum percent identity of promer match between contigs and gene(s) to use as start point [%(default)s]', default=70, metavar='FLOAT')
 
-    options = parser.parse_args()
+    return parser
+
 
+def check_programs(options):
+    '''Checks that all the external programs are found, exiting if not.
+       Returns the versions of everything, as written in 00.info.txt'''
     print_message('{:_^79}'.format(' Checking external programs '), options)
-    if options.verbose:
-        circlator.versions.get_all_versions(sys.stdout, raise_error=True, assembler=options.assembler)
-    else:
-        circlator.versions.get_all_versions(None, raise_error=True, assembler=options.assembler)
+    versions_info = io.StringIO()
+    circlator.versions.get_all_versions(versions_info, raise_error=True, assembler=options.assembler)
+    print_message(versions_info.getvalue().rstrip(), options)
+    return versions_info.getvalue()
 
 
+def run_all(options, command_line, versions_info):
+    '''Runs the whole pipeline with the given options (parsed by the parser from
+       get_parser). command_line and versions_info (from check_programs) are written
+       to 00.info.txt. Changes directory to the output directory. Returns dict with
+       the numbers of input contigs, output contigs, and contigs circularized'''
     files_to_check = [options.assembly, options.reads]
     if options.b2r_only_contigs:
         files_to_check.append(options.b2r_only_contigs)
@@ -88,33 +114,47 @@ def run():
         options.genes_fa = os.path.abspath(options.genes_fa)
 
     original_assembly = os.path.abspath(options.assembly)
+    if options.bwa_index_cache is not None:
+        options.bwa_index_cache = os.path.abspath(options.bwa_index_cache)
+    if options.assemble_cache_dir is not None:
+        options.assemble_cache_dir = os.path.abspath(options.assemble_cache_dir)
     original_reads = os.path.abspath(options.reads)
 
 
     try:
-        os.mkdir(options.outdir)
+        if options.resume:
+            os.makedirs(options.outdir, exist_ok=True)
+        else:
+            os.mkdir(options.outdir)
     except:
-        print('Error making output directory', options.outdir, file=sys.stderr)
-        sys.exit(1)
+        raise Error('Error making output directory ' + options.outdir)
 
     os.chdir(options.outdir)
 
     with open('00.info.txt', 'w') as f:
-        print(sys.argv[0], 'all', ' '.join(sys.argv[1:]), file=f)
-        circlator.versions.get_all_versions(f)
+        print(command_line, file=f)
+        print(versions_info, end='', file=f)
 
     original_assembly_renamed = '00.input_assembly.fasta'
     bam = '01.mapreads.bam'
     filtered_reads_prefix = '02.bam2reads'
-    filtered_reads =  filtered_reads_prefix + ('.fastq' if options.assemble_not_only_assembler else '.fasta')
+    filtered_reads = circlator.bamfilter.reads_filename(filtered_reads_prefix, fastq_out=options.assemble_not_only_assembler, compress=options.b2r_compress)
     assembly_dir = '03.assemble'
     reassembly = os.path.join(assembly_dir, 'contigs.fasta')
     merge_prefix = '04.merge'
     merged_fasta = merge_prefix + '.fasta'
+    merge_log = merge_prefix + '.circularise.log'
+    act_files_list = merge_prefix + '.act_files.tsv'
     clean_prefix = '05.clean'
     clean_fasta = clean_prefix + '.fasta'
+    clean_keep_file = clean_prefix + '.contigs_to_keep'
     fixstart_prefix = '06.fixstart'
     fixstart_fasta = fixstart_prefix + '.fasta'
+    not_fix_start_file = fixstart_prefix + '.contigs_to_not_change'
+    all_finished_file = fixstart_prefix + '.ALL_FINISHED'
+
+    if os.path.exists(all_finished_file):
+        os.unlink(all_finished_file)
 
     pyfastaq.tasks.to_fasta(
         original_assembly,
@@ -123,164 +163,334 @@ def run():
         check_unique=True
     )
 
+    pipeline = circlator.pipeline.Pipeline(resume=options.resume, verbose=options.verbose)
+    stage_params = lambda names: {x: getattr(options, x) for x in names}
+    stages = []
+    summary = {}
+
+    #--------------------------- count input contigs -------------------------
+    def count_input_contigs():
+        summary['input_contigs'] = pyfastaq.tasks.count_sequences(original_assembly_renamed)
+
+    stages.append(circlator.pipeline.Stage(
+        '00.count_input_contigs',
+        count_input_contigs,
+        inputs=[original_assembly_renamed],
+        manifest=False,
+    ))
+
+
     #-------------------------------- mapreads -------------------------------
-    print_message('{:_^79}'.format(' Running mapreads '), options)
-    circlator.mapping.bwa_mem(
-      original_assembly_renamed,
-      original_reads,
-      bam,
-      threads=options.threads,
-      bwa_options=options.bwa_opts,
-      verbose=options.verbose,
-    )
+    stages.append(circlator.pipeline.Stage(
+        '01.mapreads',
+        lambda: circlator.mapping.bwa_mem(
+          original_assembly_renamed,
+          original_reads,
+          bam,
+          threads=options.threads,
+          bwa_options=options.bwa_opts,
+          verbose=options.verbose,
+          sort_threads=options.sort_threads,
+          sort_mem=options.sort_mem,
+          index_cache=options.bwa_index_cache,
+          index_cache_size_gb=options.bwa_index_cache_size,
+        ),
+        inputs=[original_assembly_renamed, original_reads],
+        outputs=[bam + '*'],
+        params=stage_params(['bwa_opts']),
+        threads=options.threads,
+    ))
 
 
     #-------------------------------- bam2reads ------------------------------
-    print_message('{:_^79}'.format(' Running bam2reads '), options)
-    bam_filter = circlator.bamfilter.BamFilter(
-        bam,
+    bam2reads_params = stage_params([
+        'assemble_not_only_assembler',
+        'b2r_length_cutoff',
+        'b2r_min_read_length',
+        'b2r_discard_unmapped',
+        'split_all_reads',
+        'b2r_compress',
+        'b2r_compress_level',
+    ])
+    stages.append(circlator.pipeline.Stage(
         filtered_reads_prefix,
-        fastq_out=options.assemble_not_only_assembler,
-        length_cutoff=options.b2r_length_cutoff,
-        min_read_length=options.b2r_min_read_length,
-        contigs_to_use=options.b2r_only_contigs,
-        discard_unmapped=options.b2r_discard_unmapped,
-        verbose=options.verbose,
-        split_all_reads=options.split_all_reads,
-    )
-    bam_filter.run()
+        lambda: circlator.bamfilter.BamFilter(
+            bam,
+            filtered_reads_prefix,
+            fastq_out=options.assemble_not_only_assembler,
+            length_cutoff=options.b2r_length_cutoff,
+            min_read_length=options.b2r_min_read_length,
+            contigs_to_use=options.b2r_only_contigs,
+            discard_unmapped=options.b2r_discard_unmapped,
+            verbose=options.verbose,
+            split_all_reads=options.split_all_reads,
+            threads=options.threads,
+            compress=options.b2r_compress,
+            compress_level=options.b2r_compress_level,
+        ).run(),
+        inputs=[bam, options.b2r_only_contigs],
+        outputs=[filtered_reads_prefix + '.*'],
+        params=bam2reads_params,
+        threads=options.threads,
+    ))
 
 
     #-------------------------------- assemble -------------------------------
-    print_message('{:_^79}'.format(' Running assemble '), options)
-    a = circlator.assemble.Assembler(
-        filtered_reads,
+    assemble_params = stage_params([
+        'assembler',
+        'assemble_not_careful',
+        'assemble_not_only_assembler',
+        'assemble_spades_k',
+        'assemble_spades_use_first',
+        'assemble_spades_adaptive',
+        'b2r_length_cutoff',
+        'data_type',
+    ])
+    stages.append(circlator.pipeline.Stage(
         assembly_dir,
+        lambda: circlator.assemble.Assembler(
+            filtered_reads,
+            assembly_dir,
+            threads=options.threads,
+            careful=not options.assemble_not_careful,
+            only_assembler=not options.assemble_not_only_assembler,
+            spades_kmers=options.assemble_spades_k,
+            spades_use_first_success=options.assemble_spades_use_first,
+            spades_concurrent_runs=options.assemble_spades_concurrent_runs,
+            spades_adaptive=options.assemble_spades_adaptive,
+            cache_dir=options.assemble_cache_dir,
+            cache_size_gb=options.assemble_cache_size,
+            assembler=options.assembler,
+            genomeSize=options.b2r_length_cutoff,
+            data_type=options.data_type,
+            verbose=options.verbose
+        ).run(),
+        inputs=[filtered_reads],
+        outputs=[assembly_dir + '*'],
+        params=assemble_params,
+        exclude=['*.fai'],
         threads=options.threads,
-        careful=not options.assemble_not_careful,
-        only_assembler=not options.assemble_not_only_assembler,
-        spades_kmers=options.assemble_spades_k,
-        spades_use_first_success=options.assemble_spades_use_first,
-        assembler=options.assembler,
-        genomeSize=options.b2r_length_cutoff,
-        data_type=options.data_type,
-        verbose=options.verbose
-    )
-    a.run()
-
-
-    #------------------------------ filter original assembly -----------------
-    if options.b2r_only_contigs:
-        print_message('{:_^79}'.format(' --b2r_only_contigs used - filering contigs '), options)
-        assembly_to_use = merge_prefix + '.00.filtered_assembly.fa'
-        pyfastaq.tasks.filter(original_assembly_renamed, assembly_to_use, ids_file=options.b2r_only_contigs)
-    else:
-        assembly_to_use = original_assembly_renamed
+    ))
 
 
     #-------------------------------- merge ----------------------------------
-    print_message('{:_^79}'.format(' Running merge '), options)
-    if not options.no_pair_merge:
-        merge_reads = filtered_reads
-    else:
-        merge_reads = None
-
-    m = circlator.merge.Merger(
-        assembly_to_use,
-        assembly_dir,
+    def run_merge():
+        #-------------------------- filter original assembly -----------------
+        if options.b2r_only_contigs:
+            print_message('--b2r_only_contigs used - filering contigs', options)
+            assembly_to_use = merge_prefix + '.00.filtered_assembly.fa'
+            pyfastaq.tasks.filter(original_assembly_renamed, assembly_to_use, ids_file=options.b2r_only_contigs)
+        else:
+            assembly_to_use = original_assembly_renamed
+
+        if not options.no_pair_merge:
+            merge_reads = filtered_reads
+        else:
+            merge_reads = None
+
+        m = circlator.merge.Merger(
+            assembly_to_use,
+            assembly_dir,
+            merge_prefix,
+            nucmer_diagdiff=options.merge_diagdiff,
+            nucmer_min_id=options.merge_min_id,
+            nucmer_min_length=options.merge_min_length,
+            nucmer_min_length_for_merges=options.merge_min_length_merge,
+            min_spades_circular_percent=options.merge_min_spades_circ_pc,
+            spades_kmers=options.assemble_spades_k,
+            spades_use_first_success=options.assemble_spades_use_first,
+            spades_concurrent_runs=options.assemble_spades_concurrent_runs,
+            spades_adaptive=options.assemble_spades_adaptive,
+            reassembly_cache_dir=options.assemble_cache_dir,
+            reassembly_cache_size_gb=options.assemble_cache_size,
+            spades_careful=not options.assemble_not_careful,
+            spades_only_assembler=not options.assemble_not_only_assembler,
+            assembler=options.assembler,
+            length_cutoff=options.b2r_length_cutoff,
+            split_all_reads=options.split_all_reads,
+            data_type=options.data_type,
+            nucmer_breaklen=options.merge_breaklen,
+            ref_end_tolerance=options.merge_ref_end,
+            qry_end_tolerance=options.merge_reassemble_end,
+            threads=options.threads,
+            compress_reads=options.b2r_compress,
+            compress_level=options.b2r_compress_level,
+            sort_threads=options.sort_threads,
+            sort_mem=options.sort_mem,
+            bwa_index_cache=options.bwa_index_cache,
+            bwa_index_cache_size_gb=options.bwa_index_cache_size,
+            act_files_list=act_files_list,
+            incremental_nucmer=options.merge_incremental_nucmer,
+            local_reassembly=options.merge_local_reassembly,
+            verbose=options.verbose,
+            reads=merge_reads
+        )
+        m.run()
+
+    merge_params = dict(bam2reads_params, **assemble_params)
+    merge_params.update(stage_params([
+        'bwa_opts',
+        'merge_diagdiff',
+        'merge_min_id',
+        'merge_min_length',
+        'merge_min_length_merge',
+        'merge_min_spades_circ_pc',
+        'merge_breaklen',
+        'merge_ref_end',
+        'merge_reassemble_end',
+        'merge_incremental_nucmer',
+        'merge_local_reassembly',
+        'no_pair_merge',
+    ]))
+    # The ACT files are written by their own stage, which runs at the same time
+    # as clean and fixstart, so they are excluded from the merge outputs
+    act_files = ['*.crunch', '*.start_act.sh', '*.fai']
+    stages.append(circlator.pipeline.Stage(
         merge_prefix,
-        nucmer_diagdiff=options.merge_diagdiff,
-        nucmer_min_id=options.merge_min_id,
-        nucmer_min_length=options.merge_min_length,
-        nucmer_min_length_for_merges=options.merge_min_length_merge,
-        min_spades_circular_percent=options.merge_min_spades_circ_pc,
-        spades_kmers=options.assemble_spades_k,
-        spades_use_first_success=options.assemble_spades_use_first,
-        spades_careful=not options.assemble_not_careful,
-        spades_only_assembler=not options.assemble_not_only_assembler,
-        assembler=options.assembler,
-        length_cutoff=options.b2r_length_cutoff,
-        split_all_reads=options.split_all_reads,
-        data_type=options.data_type,
-        nucmer_breaklen=options.merge_breaklen,
-        ref_end_tolerance=options.merge_ref_end,
-        qry_end_tolerance=options.merge_reassemble_end,
+        run_merge,
+        inputs=[original_assembly_renamed, assembly_dir, filtered_reads, options.b2r_only_contigs],
+        outputs=[merge_prefix + '*'],
+        params=merge_params,
+        exclude=act_files,
         threads=options.threads,
-        verbose=options.verbose,
-        reads=merge_reads
-    )
-    m.run()
+    ))
+
+    stages.append(circlator.pipeline.Stage(
+        merge_prefix + '.act',
+        lambda: circlator.merge.write_act_files_from_list(act_files_list, verbose=options.verbose),
+        inputs=[act_files_list],
+        outputs=lambda: circlator.merge.act_files_from_list(act_files_list),
+    ))
+
+
+    #------------------------- contigs to keep/not change --------------------
+    def write_contigs_to_keep():
+        contigs_to_keep = []
+        contigs_to_not_fix_start = []
+        with open(merge_log) as f:
+            for line in f:
+                if not line.startswith('[merge circularised]\t'):
+                    continue
+                if line.rstrip() == '\t'.join(['[merge circularised]', '#Contig', 'repetitive_deleted', 'circl_using_nucmer', 'circl_using_spades', 'circularised']):
+                    continue
+
+                x, name, u, y, z, circularised = line.rstrip().split('\t')
+                if circularised == '1':
+                    contigs_to_keep.append(name)
+                else:
+                    contigs_to_not_fix_start.append(name)
+
+        with open(clean_keep_file, 'w') as f:
+            if len(contigs_to_keep) > 0:
+                print('\n'.join(contigs_to_keep), file=f)
+
+        with open(not_fix_start_file, 'w') as f:
+            if len(contigs_to_not_fix_start) > 0:
+                print('\n'.join(contigs_to_not_fix_start), file=f)
+
+        summary['circularized'] = len(contigs_to_keep)
+
+    stages.append(circlator.pipeline.Stage(
+        merge_prefix + '.contigs_to_keep',
+        write_contigs_to_keep,
+        inputs=[merge_log],
+        outputs=[clean_keep_file, not_fix_start_file],
+        manifest=False,
+    ))
 
 
     #-------------------------------- clean ----------------------------------
-    merge_log = merge_prefix + '.circularise.log'
-    contigs_to_keep = []
-    contigs_to_not_fix_start = []
-    with open(merge_log) as f:
-        for line in f:
-            if not line.startswith('[merge circularised]\t'):
-                continue
-            if line.rstrip() == '\t'.join(['[merge circularised]', '#Contig', 'repetitive_deleted', 'circl_using_nucmer', 'circl_using_spades', 'circularised']):
-                continue
-
-            x, name, u, y, z, circularised = line.rstrip().split('\t')
-            if circularised == '1':
-                contigs_to_keep.append(name)
-            else:
-                contigs_to_not_fix_start.append(name)
-
-    clean_keep_file = clean_prefix + '.contigs_to_keep'
-    with open(clean_keep_file, 'w') as f:
-        if len(contigs_to_keep) > 0:
-            print('\n'.join(contigs_to_keep), file=f)
-
-    not_fix_start_file = fixstart_prefix + '.contigs_to_not_change'
-    with open(not_fix_start_file, 'w') as f:
-        if len(contigs_to_not_fix_start) > 0:
-            print('\n'.join(contigs_to_not_fix_start), file=f)
-
-    print_message('{:_^79}'.format(' Running clean '), options)
-
-    cleaner = circlator.clean.Cleaner(
-        merged_fasta,
+    stages.append(circlator.pipeline.Stage(
         clean_prefix,
-        min_contig_length=options.clean_min_contig_length,
-        min_contig_percent_match=options.clean_min_contig_percent,
-        nucmer_diagdiff=options.clean_diagdiff,
-        nucmer_min_id=options.clean_min_nucmer_id,
-        nucmer_min_length=options.clean_min_nucmer_length,
-        nucmer_breaklen=options.clean_breaklen,
-        keepfile=clean_keep_file,
-        verbose=options.verbose
-    )
-    cleaner.run()
+        lambda: circlator.clean.Cleaner(
+            merged_fasta,
+            clean_prefix,
+            min_contig_length=options.clean_min_contig_length,
+            min_contig_percent_match=options.clean_min_contig_percent,
+            nucmer_diagdiff=options.clean_diagdiff,
+            nucmer_min_id=options.clean_min_nucmer_id,
+            nucmer_min_length=options.clean_min_nucmer_length,
+            nucmer_breaklen=options.clean_breaklen,
+            keepfile=clean_keep_file,
+            verbose=options.verbose
+        ).run(),
+        inputs=[merged_fasta, clean_keep_file],
+        outputs=[clean_prefix + '.*'],
+        params=stage_params([
+            'clean_min_contig_length',
+            'clean_min_contig_percent',
+            'clean_diagdiff',
+            'clean_min_nucmer_id',
+            'clean_min_nucmer_length',
+            'clean_breaklen',
+        ]),
+    ))
 
 
     #-------------------------------- fixstart -------------------------------
-    print_message('{:_^79}'.format(' Running fixstart '), options)
-    fixer = circlator.start_fixer.StartFixer(
-        clean_fasta,
+    stages.append(circlator.pipeline.Stage(
         fixstart_prefix,
-        min_percent_identity=options.fixstart_min_id,
-        promer_mincluster=options.fixstart_mincluster,
-        genes_fa=options.genes_fa,
-        ignore=not_fix_start_file,
-        verbose=options.verbose
-    )
-    fixer.run()
+        lambda: circlator.start_fixer.StartFixer(
+            clean_fasta,
+            fixstart_prefix,
+            min_percent_identity=options.fixstart_min_id,
+            promer_mincluster=options.fixstart_mincluster,
+            genes_fa=options.genes_fa,
+            ignore=not_fix_start_file,
+            verbose=options.verbose
+        ).run(),
+        inputs=[clean_fasta, not_fix_start_file, options.genes_fa],
+        outputs=[fixstart_prefix + '.*'],
+        params=stage_params(['fixstart_min_id', 'fixstart_mincluster']),
+    ))
+
+    old_report = circlator.runner.set_report(circlator.runner.Report(log_dir='00.process_logs', timeout=options.timeout))
+    old_profiler = circlator.perf.set_profiler(circlator.perf.Profiler() if options.profile else None)
+    profiler = circlator.perf.get_profiler()
+    start_time = time.perf_counter()
+    try:
+        pipeline.run(stages, threads=options.threads)
+    finally:
+        circlator.runner.get_report().write_json('00.process_report.json')
+        circlator.runner.set_report(old_report)
+        circlator.perf.set_profiler(old_profiler)
+        if profiler is not None:
+            profiler.write_json('00.perf.json',
+                threads=options.threads,
+                wall_seconds=round(time.perf_counter() - start_time, 3),
+                stages_skipped=pipeline.stages_skipped,
+            )
+
+    if profiler is not None:
+        print('{:_^79}'.format(' Performance (see 00.perf.json) '))
+        print(*profiler.summary_table(), sep='\n')
+        print('', *circlator.perf.notes, sep='\n', flush=True)
 
     #-------------------------------- summary -------------------------------
     print_message('{:_^79}'.format(' Summary '), options)
-    number_of_input_contigs = pyfastaq.tasks.count_sequences(original_assembly_renamed)
+    if len(pipeline.stages_skipped):
+        print_message('Stages skipped because they were already run: ' + ' '.join(pipeline.stages_skipped), options)
+    number_of_input_contigs = summary['input_contigs']
     final_number_of_contigs = pyfastaq.tasks.count_sequences(fixstart_fasta)
-    number_circularized = len(contigs_to_keep)
+    number_circularized = summary['circularized']
     print_message('Number of input contigs: ' + str(number_of_input_contigs), options)
     print_message('Number of contigs after merging: ' + str(final_number_of_contigs), options)
     print_message(' '.join(['Circularized', str(number_circularized), 'of', str(final_number_of_contigs), 'contig(s)']), options)
 
-    with open(fixstart_prefix + '.ALL_FINISHED', 'w') as f:
+    with open(all_finished_file, 'w') as f:
         pass
 
-    if number_of_input_contigs == final_number_of_contigs and number_circularized == 0:
-        sys.exit(options.unchanged_code)
+    return {
+        'input_contigs': number_of_input_contigs,
+        'output_contigs': final_number_of_contigs,
+        'circularized': number_circularized,
+    }
 
+
+def run():
+    options = get_parser().parse_args()
+    versions_info = check_programs(options)
+    summary = run_all(options, ' '.join([sys.argv[0], 'all'] + sys.argv[1:]), versions_info)
+
+    if summary['input_contigs'] == summary['output_contigs'] and summary['circularized'] == 0:
+        sys.exit(options.unchanged_code)
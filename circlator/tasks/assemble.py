@@ -13,6 +13,10 @@ def run():
     parser.add_argument('--verbose', action='store_true', help='Be verbose')
     parser.add_argument('--spades_k', help='Comma separated list of kmers to use when running SPAdes. Max kmer is 127 and each kmer should be an odd integer [%(default)s]', default='127,117,107,97,87,77', metavar='k1,k2,k3,...')
     parser.add_argument('--spades_use_first', action='store_true', help='Use the first successful SPAdes assembly. Default is to try all kmers and use the assembly with the largest N50')
+    parser.add_argument('--spades_adaptive', action='store_true', help='Stop running SPAdes kmers early, once one gives an assembly with a circular contig, or the N50 has not got bigger for 2 kmers in a row. Ignored if --spades_use_first is used')
+    parser.add_argument('--spades_concurrent_runs', type=int, help='Number of SPAdes kmers to run at the same time. The threads given by --threads are split between them [threads / 4]', metavar='INT')
+    parser.add_argument('--cache_dir', help='Directory of cached assemblies. If the same reads have already been assembled with the same options, the cached assembly is used instead of running the assembler again. Can also be set with the environment variable CIRCLATOR_REASSEMBLY_CACHE', metavar='DIRNAME')
+    parser.add_argument('--cache_size', type=float, help='Max total size in GB of the assembly cache. Least recently used assemblies are deleted to keep below this size. Can also be set with the environment variable CIRCLATOR_REASSEMBLY_CACHE_SIZE [5]', metavar='FLOAT')
     parser.add_argument('--assembler', choices=circlator.common.allowed_assemblers, help='Assembler to use for reassemblies [%(default)s]', default='spades')
     parser.add_argument('--data_type', choices=circlator.common.allowed_data_types, help='String representing one of the 4 type of data analysed (only used for Canu) [%(default)s]', default='pacbio-corrected')
     parser.add_argument('reads', help='Name of input reads FASTA file', metavar='in.reads.fasta')
@@ -27,6 +31,10 @@ def run():
         only_assembler=not options.not_only_assembler,
         spades_kmers=options.spades_k,
         spades_use_first_success=options.spades_use_first,
+        spades_concurrent_runs=options.spades_concurrent_runs,
+        spades_adaptive=options.spades_adaptive,
+        cache_dir=options.cache_dir,
+        cache_size_gb=options.cache_size,
         assembler=options.assembler,
         data_type=options.data_type,
         verbose=options.verbose
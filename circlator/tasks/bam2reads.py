@@ -13,6 +13,9 @@ def run():
     parser.add_argument('--length_cutoff', type=int, help='All reads mapped to contigs shorter than this will be kept [%(default)s]', default=100000, metavar='INT')
     parser.add_argument('--min_read_length', type=int, help='Minimum length of read to output [%(default)s]', default=250, metavar='INT')
     parser.add_argument('--split_all_reads', action='store_true', help='By default, reads mapped to shorter contigs are left unchanged. This option splits them into two, broken at the middle of the contig to try to force circularization. May help if the assembler does not detect circular contigs (eg canu)')
+    parser.add_argument('--compress', choices=circlator.bgzf.allowed_formats, help='Write compressed reads file (named outprefix.fasta.gz or outprefix.fastq.gz). Compression uses the number of threads given by --threads')
+    parser.add_argument('--compress_level', type=int, choices=range(10), help='Compression level, from 0 (fastest) to 9 (smallest). Only used with --compress [%(default)s]', default=6, metavar='INT')
+    parser.add_argument('--threads', type=int, help='Number of processes to use to get reads from the BAM file [%(default)s]', default=1, metavar='INT')
     parser.add_argument('--verbose', action='store_true', help='Be verbose')
     parser.add_argument('bam', help='Name of input bam file', metavar='in.bam')
     parser.add_argument('outprefix', help='Prefix of output filenames')
@@ -27,6 +30,9 @@ def run():
         contigs_to_use=options.only_contigs,
         discard_unmapped=options.discard_unmapped,
         split_all_reads=options.split_all_reads,
+        threads=options.threads,
+        compress=options.compress,
+        compress_level=options.compress_level,
         verbose=options.verbose,
     )
     bam_filter.run()
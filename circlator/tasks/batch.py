@@ -0,0 +1,138 @@
+import argparse
+import concurrent.futures
+import os
+import shlex
+import sys
+import time
+import circlator
+
+class Error (Exception): pass
+
+
+summary_columns = [
+    'assembly',
+    'reads',
+    'outdir',
+    'status',
+    'input_contigs',
+    'output_contigs',
+    'circularized',
+    'seconds',
+    'error',
+]
+
+
+def load_manifest(filename):
+    '''Returns list of (assembly, reads, outdir) from tab-delimited manifest file.
+       Blank lines and lines starting with # are ignored'''
+    isolates = []
+    with open(filename) as f:
+        for line_number, line in enumerate(f, start=1):
+            if line.strip() == '' or line.startswith('#'):
+                continue
+            fields = line.rstrip('\r\n').split('\t')
+            if len(fields) != 3:
+                raise Error('Expected 3 columns (assembly, reads, outdir) at line ' + str(line_number) + ' of manifest file ' + filename + '. Got: ' + line.rstrip())
+            isolates.append(tuple(fields))
+
+    outdirs = [os.path.abspath(x[2]) for x in isolates]
+    if len(set(outdirs)) != len(outdirs):
+        raise Error('Output directories in manifest file ' + filename + ' must be unique')
+
+    return isolates
+
+
+def split_threads(threads, jobs, isolates):
+    '''Returns tuple (number of jobs, threads per job) for running isolates
+       assemblies using threads in total. jobs is the number of jobs wanted,
+       or None for threads / 4. There are never more jobs than isolates'''
+    if jobs is None:
+        jobs = max(1, threads // 4)
+    jobs = max(1, min(jobs, isolates))
+    return jobs, max(1, threads // jobs)
+
+
+def run_isolate(argv, versions_info):
+    '''Runs circlator all with the list of command line arguments argv. Returns
+       dict of results, with the keys from summary_columns (apart from the input
+       files and output directory). Does not raise errors, they are reported in
+       the results instead'''
+    cwd = os.getcwd()
+    start_time = time.perf_counter()
+    result = {x: '.' for x in summary_columns[3:]}
+
+    try:
+        options = circlator.tasks.all.get_parser().parse_args(argv)
+        result.update(circlator.tasks.all.run_all(options, ' '.join(['circlator', 'all'] + argv), versions_info))
+        result['status'] = 'ok'
+    except (Exception, SystemExit) as error:
+        result['status'] = 'failed'
+        result['error'] = ' '.join(str(error).split()) or type(error).__name__
+    finally:
+        os.chdir(cwd)
+
+    result['seconds'] = round(time.perf_counter() - start_time, 2)
+    return result
+
+
+def run():
+    parser = argparse.ArgumentParser(
+        description = 'Runs circlator all on each assembly in a manifest file, sharing a pool of worker processes',
+        usage = 'circlator batch [options] <manifest.tsv> <summary.tsv>')
+    parser.add_argument('--threads', type=int, help='Total number of threads to use [%(default)s]', default=1, metavar='INT')
+    parser.add_argument('--jobs', type=int, help='Number of assemblies to run at the same time. The threads are split between them [threads / 4]', metavar='INT')
+    parser.add_argument('--all_opts', help='Options to use when running circlator all on every assembly, in quotes and with an equals sign, eg --all_opts="--resume --b2r_discard_unmapped". --threads is ignored', default='', metavar='STRING')
+    parser.add_argument('--cache_dir', help='Directory of bwa indexes and assemblies cached by all of the jobs. It has subdirectories bwa_index and reassembly, used by the --bwa_index_cache and --assemble_cache_dir options of circlator all', metavar='DIRNAME')
+    parser.add_argument('--verbose', action='store_true', help='Be verbose')
+    parser.add_argument('manifest', help='Tab-delimited file with one line per assembly, with columns: assembly FASTA file, reads file, output directory', metavar='manifest.tsv')
+    parser.add_argument('summary', help='Name of output summary file', metavar='summary.tsv')
+    options = parser.parse_args()
+
+    isolates = load_manifest(options.manifest)
+    if len(isolates) == 0:
+        raise Error('No assemblies found in manifest file ' + options.manifest)
+
+    options.jobs, threads_per_job = split_threads(options.threads, options.jobs, len(isolates))
+
+    extra_opts = shlex.split(options.all_opts) + ['--threads', str(threads_per_job)]
+    if options.cache_dir is not None:
+        cache_dir = os.path.abspath(options.cache_dir)
+        extra_opts += [
+            '--bwa_index_cache', os.path.join(cache_dir, 'bwa_index'),
+            '--assemble_cache_dir', os.path.join(cache_dir, 'reassembly'),
+        ]
+
+    all_parser = circlator.tasks.all.get_parser()
+    argvs = [extra_opts + [os.path.abspath(x) for x in isolate] for isolate in isolates]
+    all_options = [all_parser.parse_args(x) for x in argvs]
+
+    # Check the external programs once, instead of once per assembly
+    versions_info = circlator.tasks.all.check_programs(all_options[0])
+
+    # Start the jobs with the most reads first, so that the longest running
+    # jobs do not end up being started last
+    order = sorted(range(len(isolates)), key=lambda i: os.path.getsize(all_options[i].reads) if os.path.exists(all_options[i].reads) else 0, reverse=True)
+    results = [None] * len(isolates)
+
+    if options.verbose:
+        print('Running', len(isolates), 'assemblies,', options.jobs, 'at a time, using', threads_per_job, 'thread(s) each', flush=True)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=options.jobs) as executor:
+        futures = {executor.submit(run_isolate, argvs[i], versions_info): i for i in order}
+        for future in concurrent.futures.as_completed(futures):
+            i = futures[future]
+            results[i] = future.result()
+            if options.verbose:
+                print('Finished', isolates[i][2], results[i]['status'], results[i]['seconds'], 'seconds', sep='\t', flush=True)
+
+    failed = 0
+    with open(options.summary, 'w') as f:
+        print('#' + '\t'.join(summary_columns), file=f)
+        for isolate, result in zip(isolates, results):
+            print(*isolate, *[result[x] for x in summary_columns[3:]], sep='\t', file=f)
+            if result['status'] != 'ok':
+                failed += 1
+
+    if failed:
+        print(failed, 'of', len(isolates), 'assemblies failed. See summary file', options.summary, file=sys.stderr)
+        sys.exit(1)
@@ -8,6 +8,11 @@ def run():
         usage = 'circlator mapreads [options] <reference.fasta> <reads.fasta> <out.bam>')
     parser.add_argument('--bwa_opts', help='BWA options, in quotes [%(default)s]', default='-x pacbio', metavar='STRING')
     parser.add_argument('--threads', type=int, help='Number of threads [%(default)s]', default=1, metavar='INT')
+    parser.add_argument('--sort_threads', type=int, help='Number of threads used by samtools sort [min(4, --threads)]', metavar='INT')
+    parser.add_argument('--sort_mem', type=int, help='Memory per thread used by samtools sort, in MB [500 / sort threads]', metavar='INT')
+    parser.add_argument('--no_stream', action='store_true', help='Write unsorted BAM file from bwa, then sort it. Default is to sort the output of bwa as it is made')
+    parser.add_argument('--bwa_index_cache', help='Directory of cached bwa indexes, so that the same reference is only indexed once. Can also be set with the environment variable CIRCLATOR_BWA_INDEX_CACHE', metavar='DIRNAME')
+    parser.add_argument('--bwa_index_cache_size', type=float, help='Max total size in GB of the bwa index cache. Least recently used indexes are deleted to keep below this size. Can also be set with the environment variable CIRCLATOR_BWA_INDEX_CACHE_SIZE [20]', metavar='FLOAT')
     parser.add_argument('--verbose', action='store_true', help='Be verbose')
     parser.add_argument('ref', help='Name of input reference FASTA file', metavar='reference.fasta')
     parser.add_argument('reads', help='Name of corrected reads FASTA file', metavar='reads.fasta')
@@ -21,4 +26,9 @@ def run():
       threads=options.threads,
       bwa_options=options.bwa_opts,
       verbose=options.verbose,
+      sort_threads=options.sort_threads,
+      sort_mem=options.sort_mem,
+      stream=not options.no_stream,
+      index_cache=options.bwa_index_cache,
+      index_cache_size_gb=options.bwa_index_cache_size,
     )
@@ -17,13 +17,23 @@ def run():
     parser.add_argument('--assemble_not_only_assembler', action='store_true', help='Do not use the --assemble-only option with SPAdes (used by default)')
     parser.add_argument('--spades_k', help='Comma separated list of kmers to use when running SPAdes. Max kmer is 127 and each kmer should be an odd integer [%(default)s]', default='127,117,107,97,87,77', metavar='k1,k2,k3,...')
     parser.add_argument('--spades_use_first', action='store_true', help='Use the first successful SPAdes assembly. Default is to try all kmers and use the assembly with the largest N50')
+    parser.add_argument('--spades_adaptive', action='store_true', help='Stop running SPAdes kmers early, once one gives an assembly with a circular contig, or the N50 has not got bigger for 2 kmers in a row. Ignored if --spades_use_first is used')
+    parser.add_argument('--spades_concurrent_runs', type=int, help='Number of SPAdes kmers to run at the same time. The threads given by --threads are split between them [threads / 4]', metavar='INT')
+    parser.add_argument('--assemble_cache_dir', help='Directory of cached assemblies, used when reassembling (only applies if --reads is used). If the same reads have already been assembled with the same options, the cached assembly is used instead of running the assembler again. Can also be set with the environment variable CIRCLATOR_REASSEMBLY_CACHE', metavar='DIRNAME')
+    parser.add_argument('--assemble_cache_size', type=float, help='Max total size in GB of the assembly cache. Least recently used assemblies are deleted to keep below this size. Can also be set with the environment variable CIRCLATOR_REASSEMBLY_CACHE_SIZE [5]', metavar='FLOAT')
     parser.add_argument('--assembler', choices=circlator.common.allowed_assemblers, help='Assembler to use for reassemblies [%(default)s]', default='spades')
     parser.add_argument('--data_type', choices=circlator.common.allowed_data_types, help='String representing one of the 4 type of data analysed (only used for Canu) [%(default)s]', default='pacbio-corrected')
     parser.add_argument('--b2r_length_cutoff', type=int, help='All reads mapped to contigs shorter than this will be kept [%(default)s]', default=100000, metavar='INT')
     parser.add_argument('--b2r_split_all_reads', action='store_true', help='By default, reads mapped to shorter contigs are left unchanged. This option splits them into two, broken at the middle of the contig to try to force circularization. May help if the assembler does not detect circular contigs (eg canu)')
+    parser.add_argument('--b2r_compress', choices=circlator.bgzf.allowed_formats, help='Compress the reads files made when iteratively merging contigs')
+    parser.add_argument('--b2r_compress_level', type=int, choices=range(10), help='Compression level, from 0 (fastest) to 9 (smallest). Only used with --b2r_compress [%(default)s]', default=6, metavar='INT')
     parser.add_argument('--ref_end', type=int, help='max distance allowed between nucmer hit and end of input assembly contig [%(default)s]', metavar='INT', default=15000)
     parser.add_argument('--reassemble_end', type=int, help='max distance allowed between nucmer hit and end of reassembly contig [%(default)s]', metavar='INT', default=1000)
     parser.add_argument('--threads', type=int, help='Number of threads for remapping/assembly (only applies if --reads is used) [%(default)s]', default=1, metavar='INT')
+    parser.add_argument('--bwa_index_cache', help='Directory of cached bwa indexes, used when remapping reads (only applies if --reads is used). Can also be set with the environment variable CIRCLATOR_BWA_INDEX_CACHE', metavar='DIRNAME')
+    parser.add_argument('--incremental_nucmer', action='store_true', help='When iteratively merging contigs, only run nucmer on contigs that are new in each round, reusing the matches of contigs seen in earlier rounds (only applies if --reads is used)')
+    parser.add_argument('--local_reassembly', action='store_true', help='When iteratively merging contigs, after the first remap only remap and reassemble the reads around the new joins, reusing the earlier BAM files and reassembly contigs for the other contigs (only applies if --reads is used)')
+    parser.add_argument('--bwa_index_cache_size', type=float, help='Max total size in GB of the bwa index cache. Can also be set with the environment variable CIRCLATOR_BWA_INDEX_CACHE_SIZE [20]', metavar='FLOAT')
     parser.add_argument('--reads', help='FASTA file of corrected reads that made the new assembly. Using this triggers iterative contig pair merging', metavar='FILENAME')
     parser.add_argument('--verbose', action='store_true', help='Be verbose')
     parser.add_argument('original_assembly', help='Name of original assembly', metavar='original.fasta')
@@ -45,6 +55,10 @@ def run():
         spades_only_assembler=not options.assemble_not_only_assembler,
         spades_kmers=options.spades_k,
         spades_use_first_success=options.spades_use_first,
+        spades_concurrent_runs=options.spades_concurrent_runs,
+        spades_adaptive=options.spades_adaptive,
+        reassembly_cache_dir=options.assemble_cache_dir,
+        reassembly_cache_size_gb=options.assemble_cache_size,
         assembler=options.assembler,
         length_cutoff=options.b2r_length_cutoff,
         split_all_reads=options.b2r_split_all_reads,
@@ -52,6 +66,12 @@ def run():
         ref_end_tolerance=options.ref_end,
         qry_end_tolerance=options.reassemble_end,
         threads=options.threads,
+        compress_reads=options.b2r_compress,
+        compress_level=options.b2r_compress_level,
+        bwa_index_cache=options.bwa_index_cache,
+        bwa_index_cache_size_gb=options.bwa_index_cache_size,
+        incremental_nucmer=options.incremental_nucmer,
+        local_reassembly=options.local_reassembly,
         verbose=options.verbose,
         reads=options.reads,
     )
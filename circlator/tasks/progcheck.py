@@ -1,6 +1,6 @@
 import argparse
 import sys
-from circlator import versions
+from circlator import program, versions
 
 def run():
     parser = argparse.ArgumentParser(
@@ -10,3 +10,9 @@ def run():
     parser.add_argument('--debug', action='store_true', help='Debug mode with very verbose output')
     options = parser.parse_args()
     versions.get_all_versions(sys.stdout, raise_error=False, debug=options.debug)
+
+    if options.debug:
+        saved = program.version_stats['memory'] + program.version_stats['file']
+        print('\nPrograms run to get their version:', program.version_stats['run'])
+        print('Versions already known, so program not run:', saved, '(' + str(program.version_stats['memory']), 'from this process,', program.version_stats['file'], 'from cache file ' + str(program.version_cache_file()) + ')')
+        print('The cache file can be changed with the environment variable', program.version_cache_env, '(set it to an empty string to not use a file)')
@@ -60,6 +60,67 @@ class TestAssembleSpades(unittest.TestCase):
 
         self.assembler.threads = 2
         self.assertEqual(cmd_start + ' -o out -t 2 -k 41 --careful --only-assembler', self.assembler._make_spades_command(41, 'out'))
+        self.assertEqual(cmd_start + ' -o out -t 3 -k 41 --careful --only-assembler', self.assembler._make_spades_command(41, 'out', threads=3))
+
+
+    def test_spades_runs_and_threads(self):
+        '''test _spades_runs_and_threads'''
+        self.assembler.spades_kmers = [127, 117, 107, 97, 87, 77]
+        tests = [
+            (1, None, (1, 1)),
+            (4, None, (1, 4)),
+            (16, None, (4, 4)),
+            (64, None, (6, 10)),
+            (16, 2, (2, 8)),
+            (16, 10, (6, 2)),
+            (2, 6, (2, 1)),
+        ]
+
+        for threads, runs, expected in tests:
+            self.assembler.threads = threads
+            self.assembler.spades_concurrent_runs = runs
+            self.assertEqual(expected, self.assembler._spades_runs_and_threads())
+
+
+    def test_stop_sweep_after(self):
+        '''test _stop_sweep_after'''
+        def result(n50, circular=False):
+            if n50 is None:
+                return {'status': 'failed', 'seconds': 1, 'N50': None, 'circular': False}
+            return {'status': 'ok', 'seconds': 1, 'N50': n50, 'circular': circular}
+
+        self.assembler.spades_adaptive = False
+        self.assertEqual(None, self.assembler._stop_sweep_after([result(None)], False))
+        self.assertEqual(None, self.assembler._stop_sweep_after([result(None)], True))
+        self.assertEqual(None, self.assembler._stop_sweep_after([result(0)], True))
+        self.assertEqual('first success', self.assembler._stop_sweep_after([result(None), result(10)], True))
+        self.assertEqual(None, self.assembler._stop_sweep_after([result(10, circular=True), result(5), result(5)], False))
+
+        self.assembler.spades_adaptive = True
+        self.assertEqual(None, self.assembler._stop_sweep_after([result(10)], False))
+        self.assertEqual('circular contig', self.assembler._stop_sweep_after([result(10, circular=True)], False))
+        self.assertEqual(None, self.assembler._stop_sweep_after([result(10), result(5)], False))
+        self.assertEqual('N50 plateau', self.assembler._stop_sweep_after([result(10), result(5), result(6)], False))
+        self.assertEqual(None, self.assembler._stop_sweep_after([result(10), result(5), result(None)], False))
+        self.assertEqual('N50 plateau', self.assembler._stop_sweep_after([result(10), result(None), result(6)], False))
+        self.assertEqual(None, self.assembler._stop_sweep_after([result(10), result(5), result(11)], False))
+
+
+class TestFastaLengthStats(unittest.TestCase):
+    def test_fasta_length_stats(self):
+        '''test fasta_length_stats'''
+        infile = os.path.join(data_dir, 'assemble_test_fasta_length_stats.fa')
+        got = assemble.fasta_length_stats(infile)
+        self.assertEqual({'seq1': 10, 'seq2': 130, 'seq3': 0, 'seq4': 61}, got.pop('lengths'))
+        expected = {'longest': 130, 'shortest': 0, 'mean': 50.25, 'N50': 130, 'total_length': 201, 'number': 4}
+        self.assertEqual(expected, got)
+
+        tmp_file = 'tmp.assemble_test_fasta_length_stats.fa'
+        open(tmp_file, 'w').close()
+        got = assemble.fasta_length_stats(tmp_file)
+        self.assertEqual({}, got.pop('lengths'))
+        self.assertEqual({'longest': 0, 'shortest': 0, 'mean': 0, 'N50': 0, 'total_length': 0, 'number': 0}, got)
+        os.unlink(tmp_file)
 
 
 class TestAssembleCanu(unittest.TestCase):
@@ -99,3 +160,22 @@ class TestAssembleCanu(unittest.TestCase):
         assemble.Assembler._rename_canu_contigs(infile, tmpfile)
         self.assertTrue(filecmp.cmp(expected, tmpfile, shallow=False))
         os.unlink(tmpfile)
+
+
+class TestReassemblyCache(unittest.TestCase):
+    def test_copy_files(self):
+        '''test copy_files'''
+        from_dir = 'tmp.assemble_test_copy_files.from'
+        to_dir = 'tmp.assemble_test_copy_files.to'
+        os.mkdir(from_dir)
+        os.mkdir(to_dir)
+        for filename in 'contigs.fasta', 'contigs.paths', 'assembly_graph.fastg', 'spades.log':
+            with open(os.path.join(from_dir, filename), 'w') as f:
+                print(filename, file=f)
+
+        assemble.ReassemblyCache.copy_files(from_dir, to_dir)
+        self.assertEqual(['assembly_graph.fastg', 'contigs.fasta', 'contigs.paths'], sorted(os.listdir(to_dir)))
+        for filename in os.listdir(to_dir):
+            self.assertTrue(filecmp.cmp(os.path.join(from_dir, filename), os.path.join(to_dir, filename), shallow=False))
+        shutil.rmtree(from_dir)
+        shutil.rmtree(to_dir)
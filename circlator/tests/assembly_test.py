@@ -163,3 +163,27 @@ class TestAssembly(unittest.TestCase):
         got = a.circular_contigs()
         expected = set()
         self.assertEqual(expected, got)
+
+
+    def test_spliced_assembly(self):
+        '''Test SplicedAssembly'''
+        spades = assembly.Assembly(os.path.join(data_dir, 'assembly_test_spliced_assembly_spades'), 'spades')
+        fasta = assembly.Assembly(os.path.join(data_dir, 'assembly_test_get_contigs.fasta'), 'spades')
+        tmp_fasta = 'tmp.test_spliced_assembly.fa'
+        a = assembly.SplicedAssembly(tmp_fasta, [(fasta, {'contig2'}, ''), (spades, None, 'new.')], 'spades')
+        expected = {
+            'contig2': pyfastaq.sequences.Fasta('contig2', 'AAAA'),
+            'new.NODE_1_length_5_cov_42.42_ID_1': pyfastaq.sequences.Fasta('new.NODE_1_length_5_cov_42.42_ID_1', 'ACGTA'),
+            'new.NODE_2_length_1_cov_42_ID_2': pyfastaq.sequences.Fasta('new.NODE_2_length_1_cov_42_ID_2', 'A'),
+            'new.NODE_4_length_4_cov_43_ID_4': pyfastaq.sequences.Fasta('new.NODE_4_length_4_cov_43_ID_4', 'TAAC'),
+        }
+        self.assertEqual(expected, a.get_contigs())
+        self.assertEqual({'new.NODE_1_length_5_cov_42.42_ID_1'}, a.circular_contigs())
+
+        # a spliced assembly can be made from another spliced assembly
+        tmp_fasta2 = 'tmp.test_spliced_assembly.2.fa'
+        a2 = assembly.SplicedAssembly(tmp_fasta2, [(a, {'contig2', 'new.NODE_1_length_5_cov_42.42_ID_1'}, '')], 'spades')
+        self.assertEqual(['contig2', 'new.NODE_1_length_5_cov_42.42_ID_1'], sorted(a2.get_contigs()))
+        self.assertEqual({'new.NODE_1_length_5_cov_42.42_ID_1'}, a2.circular_contigs())
+        os.unlink(tmp_fasta)
+        os.unlink(tmp_fasta2)
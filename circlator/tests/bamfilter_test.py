@@ -1,5 +1,6 @@
 import unittest
 import filecmp
+import gzip
 import os
 import pyfastaq
 from circlator import bamfilter
@@ -199,3 +200,98 @@ class TestBamfilter(unittest.TestCase):
         os.unlink(outprefix + '.fasta')
         os.unlink(outprefix + '.log')
 
+
+    def test_use_single_pass(self):
+        '''test _use_single_pass'''
+        ref_lengths = {'ref1': 1000, 'ref2': 100000}
+        tests = [
+            (None, {'ref1': [None]}, False),
+            (None, {'ref1': [None], 'ref2': [(0, 4999), (95000, 100000)]}, False),
+            (None, {'ref1': [None], 'ref2': [(0, 19999), (80000, 100000)]}, True),
+            (None, {'ref2': [(0, 49999), (50000, 100000)]}, True),
+            (True, {'ref1': [None]}, True),
+            (False, {'ref1': [None], 'ref2': [None]}, False),
+        ]
+        for single_pass, plan, expected in tests:
+            b = bamfilter.BamFilter(os.path.join(data_dir, 'bamfilter_test_get_ref_lengths.bam'), 'out', single_pass=single_pass)
+            self.assertEqual(expected, b._use_single_pass(ref_lengths, plan))
+
+
+    def test_run_single_pass_same_as_fetch(self):
+        '''test run gives same output using one pass of BAM as using fetch on each region'''
+        outprefix = 'tmp.bamfilter_run'
+        for bam in 'bamfilter_test_run_no_qual.bam', 'bamfilter_test_run_with_qual.bam':
+            for split_all_reads in True, False:
+                for discard_unmapped in True, False:
+                    got = []
+                    for single_pass in True, False:
+                        b = bamfilter.BamFilter(
+                            os.path.join(data_dir, bam),
+                            outprefix + '.' + str(single_pass),
+                            fastq_out=True,
+                            length_cutoff=600,
+                            min_read_length=50,
+                            discard_unmapped=discard_unmapped,
+                            split_all_reads=split_all_reads,
+                            single_pass=single_pass,
+                        )
+                        b.run()
+                        got.append((b.reads_outfile, b.log))
+
+                    self.assertTrue(filecmp.cmp(got[0][0], got[1][0], shallow=False))
+                    self.assertTrue(filecmp.cmp(got[0][1], got[1][1], shallow=False))
+                    for filenames in got:
+                        for filename in filenames:
+                            os.unlink(filename)
+
+
+    def test_run_in_parallel_same_as_fetch(self):
+        '''test run gives same output using more than one process'''
+        outprefix = 'tmp.bamfilter_run'
+        for bam in 'bamfilter_test_run_no_qual.bam', 'bamfilter_test_run_with_qual.bam':
+            for discard_unmapped in True, False:
+                got = []
+                for threads in 1, 3:
+                    b = bamfilter.BamFilter(
+                        os.path.join(data_dir, bam),
+                        outprefix + '.' + str(threads),
+                        fastq_out=True,
+                        length_cutoff=600,
+                        min_read_length=50,
+                        discard_unmapped=discard_unmapped,
+                        single_pass=False,
+                        threads=threads,
+                    )
+                    b.run()
+                    got.append((b.reads_outfile, b.log))
+
+                self.assertTrue(filecmp.cmp(got[0][0], got[1][0], shallow=False))
+                self.assertTrue(filecmp.cmp(got[0][1], got[1][1], shallow=False))
+                for filenames in got:
+                    for filename in filenames:
+                        os.unlink(filename)
+
+
+    def test_run_compressed(self):
+        '''test run with compressed output'''
+        outprefix = 'tmp.bamfilter_run'
+        bam = os.path.join(data_dir, 'bamfilter_test_run_with_qual.bam')
+        b = bamfilter.BamFilter(bam, outprefix, fastq_out=True, length_cutoff=600, min_read_length=50)
+        b.run()
+        with open(b.reads_outfile) as f:
+            expected = f.read()
+        os.unlink(b.reads_outfile)
+        os.unlink(b.log)
+
+        for compress in 'bgzip', 'gzip':
+            for threads in 1, 3:
+                b = bamfilter.BamFilter(bam, outprefix, fastq_out=True, length_cutoff=600, min_read_length=50, threads=threads, compress=compress)
+                self.assertEqual(os.path.abspath(outprefix + '.fastq.gz'), b.reads_outfile)
+                b.run()
+                with gzip.open(b.reads_outfile, 'rt') as f:
+                    self.assertEqual(expected, f.read())
+                os.unlink(b.reads_outfile)
+                os.unlink(b.log)
+
+        with self.assertRaises(bamfilter.Error):
+            bamfilter.BamFilter(bam, outprefix, compress='zip')
@@ -0,0 +1,88 @@
+import unittest
+import os
+import shutil
+import circlator
+from circlator.tasks import batch
+
+modules_dir = os.path.dirname(os.path.abspath(circlator.__file__))
+data_dir = os.path.join(modules_dir, 'tests', 'data')
+
+
+class TestBatch(unittest.TestCase):
+    def test_load_manifest(self):
+        '''test load_manifest'''
+        expected = [
+            ('assembly1.fa', 'reads1.fq', 'out1'),
+            ('assembly2.fa', 'reads2.fq.gz', 'out2'),
+        ]
+        self.assertEqual(expected, batch.load_manifest(os.path.join(data_dir, 'batch_test_load_manifest.tsv')))
+
+        with self.assertRaises(batch.Error):
+            batch.load_manifest(os.path.join(data_dir, 'batch_test_load_manifest_bad_columns.tsv'))
+
+        with self.assertRaises(batch.Error):
+            batch.load_manifest(os.path.join(data_dir, 'batch_test_load_manifest_duplicate_outdirs.tsv'))
+
+
+    def test_split_threads(self):
+        '''test split_threads'''
+        tests = [
+            ((1, None, 10), (1, 1)),
+            ((8, None, 10), (2, 4)),
+            ((16, None, 2), (2, 8)),
+            ((16, 3, 10), (3, 5)),
+            ((2, 4, 10), (4, 1)),
+            ((4, 4, 1), (1, 4)),
+            ((4, 0, 1), (1, 4)),
+        ]
+        for args, expected in tests:
+            self.assertEqual(expected, batch.split_threads(*args))
+
+
+    def test_run_isolate_bad_options(self):
+        '''test run_isolate when the options are wrong'''
+        result = batch.run_isolate(['--not_an_option'], 'versions')
+        self.assertEqual('failed', result['status'])
+        self.assertEqual('2', result['error'])
+        self.assertEqual(['circularized', 'error', 'input_contigs', 'output_contigs', 'seconds', 'status'], sorted(result))
+
+        result = batch.run_isolate(['not_a_file.fa', 'not_a_file.fq', 'tmp.batch_test.out'], 'versions')
+        self.assertEqual('failed', result['status'])
+        self.assertEqual('File(s) not found. Cannot continue', result['error'])
+        self.assertFalse(os.path.exists('tmp.batch_test.out'))
+
+
+    def test_run_isolate(self):
+        '''test run_isolate restores the working directory'''
+        tmp_dir = 'tmp.batch_test.run_isolate'
+        os.mkdir(tmp_dir)
+        cwd = os.getcwd()
+        run_all = circlator.tasks.all.run_all
+        got_args = []
+
+        def fake_run_all(options, command_line, versions_info):
+            got_args.extend([options.outdir, options.threads, command_line, versions_info])
+            os.chdir(tmp_dir)
+            if options.threads == 2:
+                raise Exception('Oh\nno')
+            return {'input_contigs': 3, 'output_contigs': 2, 'circularized': 1}
+
+        try:
+            circlator.tasks.all.run_all = fake_run_all
+            result = batch.run_isolate(['--threads', '3', 'assembly.fa', 'reads.fq', 'out'], 'versions')
+            self.assertEqual(cwd, os.getcwd())
+            self.assertEqual(['out', 3, 'circlator all --threads 3 assembly.fa reads.fq out', 'versions'], got_args)
+            self.assertEqual('ok', result['status'])
+            self.assertEqual('.', result['error'])
+            self.assertEqual((3, 2, 1), (result['input_contigs'], result['output_contigs'], result['circularized']))
+            self.assertGreaterEqual(result['seconds'], 0)
+
+            result = batch.run_isolate(['--threads', '2', 'assembly.fa', 'reads.fq', 'out'], 'versions')
+            self.assertEqual(cwd, os.getcwd())
+            self.assertEqual('failed', result['status'])
+            self.assertEqual('Oh no', result['error'])
+            self.assertEqual('.', result['input_contigs'])
+        finally:
+            circlator.tasks.all.run_all = run_all
+            os.chdir(cwd)
+            shutil.rmtree(tmp_dir)
@@ -0,0 +1,44 @@
+import unittest
+import gzip
+import os
+import random
+import pysam
+from circlator import bgzf
+
+
+class TestBgzf(unittest.TestCase):
+    def _random_lines(self, number_of_lines):
+        rng = random.Random(42)
+        return [''.join(rng.choice('ACGT') for x in range(rng.randint(0, 1000))) + '\n' for i in range(number_of_lines)]
+
+
+    def test_writer_bad_options(self):
+        '''test Writer with bad options'''
+        with self.assertRaises(bgzf.Error):
+            bgzf.Writer('tmp.bgzf_test.gz', file_format='zip')
+        with self.assertRaises(bgzf.Error):
+            bgzf.Writer('tmp.bgzf_test.gz', level=10)
+        self.assertFalse(os.path.exists('tmp.bgzf_test.gz'))
+
+
+    def test_writer(self):
+        '''test Writer'''
+        tmpfile = 'tmp.bgzf_test.gz'
+        for lines in [], self._random_lines(1), self._random_lines(1000):
+            for file_format in bgzf.allowed_formats:
+                for threads in 1, 3:
+                    for level in 0, 6:
+                        with bgzf.Writer(tmpfile, file_format=file_format, level=level, threads=threads) as f:
+                            for line in lines:
+                                print(line, end='', file=f)
+
+                        with gzip.open(tmpfile, 'rt') as f:
+                            self.assertEqual(''.join(lines), f.read())
+
+                        if file_format == 'bgzip':
+                            with pysam.BGZFile(tmpfile) as f:
+                                self.assertEqual(''.join(lines), f.read().decode())
+                            with open(tmpfile, 'rb') as f:
+                                self.assertTrue(f.read().endswith(bgzf.bgzf_eof))
+
+                        os.unlink(tmpfile)
@@ -0,0 +1,115 @@
+import unittest
+import fcntl
+import hashlib
+import os
+import shutil
+from circlator import cache
+
+modules_dir = os.path.dirname(os.path.abspath(cache.__file__))
+data_dir = os.path.join(modules_dir, 'tests', 'data')
+
+
+class TestCache(unittest.TestCase):
+    def test_file_hash(self):
+        '''test file_hash'''
+        infile = os.path.join(data_dir, 'cache_test_file_hash.txt')
+        with open(infile, 'rb') as f:
+            contents = f.read()
+        self.assertEqual(hashlib.sha256(contents).hexdigest(), cache.file_hash(infile))
+        h = hashlib.sha256(b'foo')
+        self.assertEqual(hashlib.sha256(b'foo' + contents).hexdigest(), cache.file_hash(infile, h))
+
+
+    def test_get(self):
+        '''test get'''
+        tmp_dir = 'tmp.cache_test_get'
+        c = cache.Cache(tmp_dir, 1)
+        key = 'a' * 64
+        made = []
+
+        def make(directory):
+            made.append(directory)
+            with open(os.path.join(directory, 'result'), 'w') as f:
+                print('result', file=f)
+
+        self.assertFalse(c.contains(key))
+        for i in range(2):
+            with c.get(key, make) as directory:
+                self.assertEqual(os.path.join(os.path.abspath(tmp_dir), key), directory)
+                self.assertTrue(os.path.exists(os.path.join(directory, 'result')))
+        self.assertEqual(1, len(made))
+        self.assertTrue(c.contains(key))
+
+        def make_fail(directory):
+            raise Exception('oops')
+
+        with self.assertRaises(Exception):
+            with c.get('b' * 64, make_fail):
+                pass
+        self.assertFalse(c.contains('b' * 64))
+        self.assertEqual(['a' * 64], [x[2] for x in c._entries()])
+
+        # the lock file of the failed result is deleted next time the cache is used
+        self.assertTrue(os.path.exists(os.path.join(tmp_dir, 'b' * 64 + '.lock')))
+        with c.get(key, make):
+            pass
+        self.assertEqual(['a' * 64, 'a' * 64 + '.lock', 'evict.lock'], sorted(os.listdir(tmp_dir)))
+
+        with self.assertRaises(cache.Error):
+            with c.get('c', make):
+                pass
+
+        shutil.rmtree(tmp_dir)
+
+
+    def test_evict(self):
+        '''test _evict'''
+        tmp_dir = 'tmp.cache_test_evict'
+        c = cache.Cache(tmp_dir, max_size_gb=2500 / 1024 ** 3)
+        names = [str(i) * 64 for i in range(4)]
+        for i, name in enumerate(names):
+            os.makedirs(os.path.join(tmp_dir, name, 'subdir'))
+            with open(os.path.join(tmp_dir, name, 'subdir', 'file'), 'w') as f:
+                print('x' * 999, file=f)
+            os.utime(os.path.join(tmp_dir, name), (i, i))
+
+        os.mkdir(os.path.join(tmp_dir, 'not_a_result'))
+        c._evict(names[0])
+        self.assertEqual([names[0], names[3]], sorted(x[2] for x in c._entries()))
+        self.assertTrue(os.path.exists(os.path.join(tmp_dir, 'not_a_result')))
+        self.assertEqual([names[0], names[3], 'evict.lock', 'not_a_result'], sorted(os.listdir(tmp_dir)))
+        shutil.rmtree(tmp_dir)
+
+
+    def test_remove_stale_files(self):
+        '''test _evict removes stale temporary directories and lock files'''
+        tmp_dir = 'tmp.cache_test_remove_stale_files'
+        c = cache.Cache(tmp_dir, 1)
+        result, old_result, making, killed = [str(i) * 64 for i in range(4)]
+        os.mkdir(os.path.join(tmp_dir, result))
+        os.mkdir(os.path.join(tmp_dir, making + '.tmp.abc'))
+        os.mkdir(os.path.join(tmp_dir, killed + '.tmp.def'))
+        with open(os.path.join(tmp_dir, killed + '.tmp.def', 'file'), 'w') as f:
+            print('x', file=f)
+        for key in result, old_result, making, killed:
+            open(os.path.join(tmp_dir, key + '.lock'), 'w').close()
+        os.mkdir(os.path.join(tmp_dir, 'not_a_result.tmp.x'))
+
+        # another process is making this one
+        with open(os.path.join(tmp_dir, making + '.lock')) as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            c._evict(result)
+
+        expected = [
+            result,
+            result + '.lock',
+            making + '.lock',
+            making + '.tmp.abc',
+            'evict.lock',
+            'not_a_result.tmp.x',
+        ]
+        self.assertEqual(expected, sorted(os.listdir(tmp_dir)))
+
+        c._evict(result)
+        self.assertEqual([result, result + '.lock', 'evict.lock', 'not_a_result.tmp.x'], sorted(os.listdir(tmp_dir)))
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,28 @@
+import unittest
+import os
+import subprocess
+import sys
+import circlator
+
+modules_dir = os.path.dirname(os.path.abspath(circlator.__file__))
+
+
+class TestCirclator(unittest.TestCase):
+    def test_lazy_imports(self):
+        '''test importing circlator does not import all the modules'''
+        code = 'import sys, circlator.tasks.version; print(" ".join(sorted(sys.modules)))'
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(modules_dir))
+        output = subprocess.check_output([sys.executable, '-c', code], env=env, universal_newlines=True)
+        imported = set(output.split())
+        for module in ['circlator.mapping', 'circlator.merge', 'distutils', 'pkg_resources', 'pymummer', 'pysam']:
+            self.assertNotIn(module, imported)
+
+
+    def test_getattr(self):
+        '''test modules and __version__ are got when they are used'''
+        self.assertEqual('mapping', circlator.mapping.__name__.split('.')[-1])
+        self.assertEqual('all', circlator.tasks.all.__name__.split('.')[-1])
+        self.assertIsInstance(circlator.__version__, str)
+        self.assertIn('merge', dir(circlator))
+        with self.assertRaises(AttributeError):
+            circlator.not_a_module
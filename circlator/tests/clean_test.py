@@ -1,6 +1,8 @@
 import unittest
+import copy
 import filecmp
 import os
+import random
 import pymummer
 from circlator import clean
 
@@ -8,6 +10,48 @@ modules_dir = os.path.dirname(os.path.abspath(clean.__file__))
 data_dir = os.path.join(modules_dir, 'tests', 'data')
 
 
+def collapse_list_of_sets_slow(sets):
+    '''This is how Cleaner._collapse_list_of_sets used to work'''
+    found = True
+    while found:
+        found = False
+        to_intersect = None
+        for i in range(len(sets)):
+            for j in range(len(sets)):
+                if i == j:
+                    continue
+                elif sets[i].intersection(sets[j]):
+                    to_intersect = i, j
+                    break
+
+            if to_intersect is not None:
+                break
+
+        if to_intersect is not None:
+            found = True
+            sets[i].update(sets[j])
+            sets.pop(j)
+
+    return sets
+
+
+def get_all_containing_slow(containing_contigs, name, exclude=None, max_depth=10):
+    '''This is how Cleaner._get_all_containing used to work, for one contig'''
+    contains_name = set()
+    if max_depth < 0:
+        return contains_name
+
+    if name in containing_contigs:
+        for containing_contig in containing_contigs[name]:
+            if containing_contig==exclude:
+                continue
+            contains_name.add(containing_contig)
+            new_names = get_all_containing_slow(containing_contigs, containing_contig, exclude=name,max_depth=max_depth-1)
+            new_names.discard(name)
+            contains_name.update(new_names)
+    return contains_name
+
+
 class TestClean(unittest.TestCase):
     def test_get_contigs_to_keep(self):
         '''test _get_contigs_to_keep'''
@@ -42,7 +86,7 @@ class TestClean(unittest.TestCase):
             '\t'.join(['481', '780', '241', '540', '300', '300', '100.00', '1002', '540', '1', '1', 'contig2', 'contig4']),
             '\t'.join(['1', '410', '1', '410', '410', '410', '100.00', '960', '1000', '1', '1', 'contig3', 'contig1']),
         ]
-        hits = [pymummer.alignment.Alignment(x) for x in hits]
+        hits = [clean.hits.Hit.from_coords_line(x) for x in hits]
 
         expected_hits = {
             'contig3': [hits[0], hits[1]],
@@ -80,6 +124,23 @@ class TestClean(unittest.TestCase):
         for i in range(len(hits)):
             self.assertEqual(expected[i], cleaner._contains(hits[i]))
 
+        hit_table = clean.hits.HitTable()
+        for hit in hits:
+            hit_table.append(clean.hits.Hit(*[getattr(hit, x) for x in clean.hits.columns]))
+        self.assertEqual(expected, [bool(x) for x in cleaner._contains_mask(hit_table)])
+
+
+    def test_get_containing_contigs_from_table(self):
+        '''test _get_containing_contigs_from_table gives the same as _get_containing_contigs'''
+        cleaner = clean.Cleaner('infile', 'outprefix', min_contig_percent_match=40)
+        cleaner.contigs_to_keep = {'contig4'}
+        coords_file = os.path.join(data_dir, 'clean_test_load_nucmer_hits.coords')
+        hit_table = cleaner._load_hit_table(coords_file)
+        got = cleaner._get_containing_contigs_from_table(hit_table)
+        lengths, hits_dict = cleaner._load_nucmer_hits(coords_file)
+        self.assertEqual(cleaner._get_containing_contigs(hits_dict), got)
+        self.assertEqual({'contig3': {'contig1', 'contig2'}, 'contig1': {'contig3'}}, got)
+
 
     def test_containing_contigs(self):
         '''test _containing_contigs'''
@@ -127,8 +188,37 @@ class TestClean(unittest.TestCase):
             ('f', {'e', 'g'})
         ]
 
+        got = cleaner._get_all_containing(dict_in)
+        self.assertEqual(set(dict_in), set(got))
         for name, expected in name_and_expected:
-            self.assertEqual(expected, cleaner._get_all_containing(dict_in, name))
+            self.assertEqual(expected, got[name])
+            self.assertEqual(get_all_containing_slow(dict_in, name), got[name])
+
+        # check against the old (slow) way. Use graphs small enough that it
+        # did not hit its max depth
+        rng = random.Random(42)
+        for i in range(100):
+            nodes = list(range(rng.randint(1, 8)))
+            dict_in = {x: set(rng.sample(nodes, rng.randint(1, min(2, len(nodes))))) - {x} for x in nodes}
+            dict_in = {x: y for x, y in dict_in.items() if len(y)}
+            got = cleaner._get_all_containing(dict_in)
+            for name in dict_in:
+                self.assertEqual(get_all_containing_slow(dict_in, name), got[name])
+
+
+    def test_get_all_containing_long_chain(self):
+        '''test _get_all_containing with chains longer than the old max depth and the recursion limit'''
+        cleaner = clean.Cleaner('infile', 'outprefix')
+        dict_in = {i: {i + 1} for i in range(2000)}
+        dict_in[2000] = {0}
+        got = cleaner._get_all_containing(dict_in)
+        for i in [0, 1000, 2000]:
+            self.assertEqual(set(range(2001)) - {i}, got[i])
+
+        dict_in = {i: {i + 1} for i in range(20)}
+        got = cleaner._get_all_containing(dict_in)
+        self.assertEqual(set(range(1, 21)), got[0])
+        self.assertEqual({20}, got[19])
 
 
     def test_expand_containing_using_transitivity(self):
@@ -187,6 +277,12 @@ class TestClean(unittest.TestCase):
         for list_in, expected in tests:
             self.assertEqual(cleaner._collapse_list_of_sets(list_in), expected)
 
+        # check against the old (slow) way, including the order of the sets
+        rng = random.Random(42)
+        for i in range(200):
+            list_in = [set(rng.sample(range(30), rng.randint(0, 3))) for j in range(rng.randint(0, 20))]
+            self.assertEqual(collapse_list_of_sets_slow(copy.deepcopy(list_in)), cleaner._collapse_list_of_sets(list_in))
+
 
     def test_get_identical_contigs(self):
         '''test _get_identical_contigs'''
@@ -0,0 +1,105 @@
+import unittest
+import copy
+import os
+import pickle
+import pyfastaq
+from circlator import contig_store
+
+modules_dir = os.path.dirname(os.path.abspath(contig_store.__file__))
+data_dir = os.path.join(modules_dir, 'tests', 'data')
+
+
+class TestContigStore(unittest.TestCase):
+    def setUp(self):
+        self.infile = os.path.join(data_dir, 'contig_store_test.fa')
+        self.expected = {}
+        pyfastaq.tasks.file_to_dict(self.infile, self.expected)
+
+
+    def test_init(self):
+        '''test init is the same as file_to_dict'''
+        with self.assertRaises(contig_store.Error):
+            contig_store.ContigStore('notafile')
+
+        store = contig_store.ContigStore(self.infile)
+        self.assertEqual(list(self.expected), list(store))
+        self.assertEqual(self.expected, store)
+        self.assertEqual(store, self.expected)
+        self.assertIsInstance(store['contig1'], contig_store.Contig)
+        self.assertNotIsInstance(store['contig2 with a description'], contig_store.Contig)
+        self.assertEqual(['contig1', 'contig3', 'contig4'], sorted(x for x in store if isinstance(store[x], contig_store.Contig)))
+        for name, contig in self.expected.items():
+            self.assertEqual(len(contig), len(store[name]))
+            self.assertEqual(str(contig), str(store[name]))
+
+
+    def test_not_indexed(self):
+        '''test files that cannot be indexed are loaded into memory'''
+        tmp_file = 'tmp.contig_store_test.fa'
+        with open(tmp_file, 'w', newline='') as f:
+            print('>contig1\r\nACGT\r\nAC\r\n>contig2\r\nA', file=f)
+        expected = {
+            'contig1': pyfastaq.sequences.Fasta('contig1', 'ACGTAC'),
+            'contig2': pyfastaq.sequences.Fasta('contig2', 'A'),
+        }
+        store = contig_store.ContigStore(tmp_file)
+        os.unlink(tmp_file)
+        self.assertEqual(expected, store)
+        self.assertEqual(['contig2'], [x for x in store if isinstance(store[x], contig_store.Contig)])
+
+        infile = os.path.join(data_dir, 'merge_test_circularise_contigs.ref.fa')
+        gz_file = 'tmp.contig_store_test.fa.gz'
+        pyfastaq.tasks.to_fasta(infile, gz_file)
+        expected = {}
+        pyfastaq.tasks.file_to_dict(infile, expected)
+        store = contig_store.ContigStore(gz_file)
+        os.unlink(gz_file)
+        self.assertEqual(expected, store)
+
+
+    def test_slicing(self):
+        '''test slicing a Contig is the same as slicing its sequence'''
+        store = contig_store.ContigStore(self.infile)
+        for name in 'contig1', 'contig3', 'contig4':
+            contig = store[name]
+            seq = self.expected[name].seq
+            coords = [None, -300, -61, -60, -1, 0, 1, 59, 60, 61, 119, 120, 200, 249, 250, 300]
+            for start in coords:
+                for end in coords:
+                    self.assertEqual(seq[start:end], contig[start:end])
+                    self.assertEqual(seq[start:end:2], contig[start:end:2])
+            for i in range(-len(seq), len(seq)):
+                self.assertEqual(seq[i], contig[i])
+            with self.assertRaises(IndexError):
+                contig[len(seq)]
+            self.assertEqual(pyfastaq.sequences.Fasta(name, seq[10:42]), contig.subseq(10, 42))
+
+
+    def test_copy_on_write(self):
+        '''test changing contigs does not change the file'''
+        store = contig_store.ContigStore(self.infile)
+        contig = copy.copy(store['contig1'])
+        contig.revcomp()
+        expected = copy.copy(self.expected['contig1'])
+        expected.revcomp()
+        self.assertEqual(expected, contig)
+        self.assertEqual(expected.seq[10:20], contig[10:20])
+        self.assertEqual(self.expected['contig1'], store['contig1'])
+
+        store['contig1'].seq = 'ACGT'
+        self.assertEqual(4, len(store['contig1']))
+        store['new'] = pyfastaq.sequences.Fasta('new', 'AAA')
+        del store['contig3']
+        self.assertEqual(['contig1', 'contig2 with a description', 'empty', 'contig4', 'new'], list(store))
+        self.assertNotIn('contig3', store)
+
+        store = contig_store.ContigStore(self.infile)
+        self.assertEqual(self.expected, store)
+
+
+    def test_pickle(self):
+        '''test pickle'''
+        store = contig_store.ContigStore(self.infile)
+        store['contig4'].revcomp()
+        self.expected['contig4'].revcomp()
+        self.assertEqual(self.expected, pickle.loads(pickle.dumps(store)))
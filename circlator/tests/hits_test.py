@@ -0,0 +1,209 @@
+import unittest
+import copy
+import os
+import random
+import pymummer
+from circlator import hits
+
+modules_dir = os.path.dirname(os.path.abspath(hits.__file__))
+data_dir = os.path.join(modules_dir, 'tests', 'data')
+
+
+def random_coords_lines(number, seed=42):
+    '''Returns list of random nucmer lines, with hits in both orientations and near the ends of the contigs'''
+    rng = random.Random(seed)
+    lines = []
+    for i in range(number):
+        ref_length = rng.randint(100, 2000)
+        qry_length = rng.randint(100, 2000)
+        ref_start = rng.randint(1, ref_length)
+        ref_end = rng.randint(ref_start, ref_length)
+        qry_start = rng.randint(1, qry_length)
+        qry_end = rng.randint(qry_start, qry_length)
+        if rng.random() < 0.5:
+            qry_start, qry_end = qry_end, qry_start
+        hit_length_ref = ref_end - ref_start + 1
+        hit_length_qry = abs(qry_end - qry_start) + 1
+        identity = '{:.2f}'.format(rng.uniform(90, 100))
+        names = ['ctg' + str(rng.randint(1, 5)), 'ctg' + str(rng.randint(1, 5))]
+        values = [ref_start, ref_end, qry_start, qry_end, hit_length_ref, hit_length_qry, identity, ref_length, qry_length, 1, 1 if qry_start < qry_end else -1] + names
+        lines.append('\t'.join(str(x) for x in values))
+    return lines
+
+
+# A Hit is equal to a pymummer Alignment with the same values, but not the other
+# way round, because Alignment.__eq__ needs the same type. So Hits go on the left
+class TestHit(unittest.TestCase):
+    def test_from_coords_line(self):
+        '''test Hit.from_coords_line is the same as pymummer Alignment'''
+        lines = [
+            '\t'.join(['61', '500', '61', '500', '440', '440', '100.00', '500', '500', '1', '1', 'ref1', 'qry1']),
+            '\t'.join(['10', '50', '52', '11', '51', '52', '99.42', '500', '500', '1', '-1', 'ref1', 'qry1', '[CONTAINS]']),
+            '\t'.join(['1', '1398', '4891054', '4892445', '1398', '1392', '89.55', '93.18', '0.21', '1398', '5349013', '1', '1', 'ref', 'qry', '[CONTAINED]']),
+        ]
+
+        for line in lines:
+            hit = hits.Hit.from_coords_line(line)
+            alignment = pymummer.alignment.Alignment(line)
+            for column in hits.columns:
+                self.assertEqual(getattr(alignment, column), getattr(hit, column))
+            self.assertEqual(hit, alignment)
+            self.assertEqual(hash(hit), hash(alignment))
+            self.assertEqual(str(alignment), str(hit))
+            self.assertEqual(alignment.ref_coords(), hit.ref_coords())
+            self.assertEqual(alignment.qry_coords(), hit.qry_coords())
+            self.assertEqual(alignment.on_same_strand(), hit.on_same_strand())
+            self.assertEqual(hit, copy.copy(hit))
+            self.assertIn(alignment, {hit})
+
+        self.assertNotEqual(hits.Hit.from_coords_line(lines[0]), hits.Hit.from_coords_line(lines[1]))
+        self.assertNotEqual(hits.Hit.from_coords_line(lines[0]), None)
+
+        with self.assertRaises(hits.Error):
+            hits.Hit.from_coords_line('1\t2\t3')
+
+
+    def test_reader(self):
+        '''test reader'''
+        infile = os.path.join(data_dir, 'merge_test_load_nucmer_hits.coords')
+        expected = list(pymummer.coords_file.reader(infile))
+        self.assertEqual(list(hits.reader(infile)), expected)
+
+
+class TestHitTable(unittest.TestCase):
+    def test_from_coords_file(self):
+        '''test from_coords_file'''
+        infile = os.path.join(data_dir, 'clean_test_load_nucmer_hits.coords')
+        alignments = list(pymummer.coords_file.reader(infile))
+        table = hits.HitTable.from_coords_file(infile)
+        self.assertEqual(len(alignments), len(table))
+        self.assertEqual(list(table), alignments)
+        self.assertEqual(table.hits(), alignments)
+        self.assertEqual(table.hits([1, 3]), [alignments[1], alignments[3]])
+        self.assertEqual(['contig1', 'contig2', 'contig3', 'contig4'], sorted(table.names))
+        self.assertEqual({'contig1': 1000, 'contig2': 1002, 'contig3': 960, 'contig4': 540}, table.lengths())
+
+        expected = {
+            'contig1': alignments[:2],
+            'contig2': alignments[2:5],
+            'contig3': alignments[5:],
+        }
+        self.assertEqual(table.group_by('ref_name'), expected)
+
+        table = hits.HitTable.from_coords_file(infile, skip_self_hits=True)
+        expected = {
+            'contig3': [alignments[1], alignments[3]],
+            'contig4': [alignments[4]],
+            'contig1': [alignments[5]],
+        }
+        self.assertEqual(table.group_by('qry_name'), expected)
+        self.assertEqual(table.group_by('ref_name', indexes=[0]), {'contig1': [alignments[1]]})
+
+        with self.assertRaises(hits.Error):
+            table.group_by('frame')
+
+
+    def test_extend_from_lines(self):
+        '''test _extend_from_lines'''
+        lines = [
+            '\t'.join(['61', '500', '61', '500', '440', '440', '100.00', '500', '500', '1', '1', 'ref1', 'qry1']) + '\n',
+            '\t'.join(['10', '50', '52', '11', '51', '52', '99.42', '500', '500', '1', '-1', 'ref1', 'qry1', '[CONTAINS]']) + '\n',
+            '\t'.join(['1', '500', '1', '500', '500', '500', '100.00', '500', '500', '1', '1', 'ref1', 'ref1', '[IDENTITY]']) + '\n',
+            '\t'.join(['1', '1398', '4891054', '4892445', '1398', '1392', '89.55', '93.18', '0.21', '1398', '5349013', '1', '1', 'ref', 'qry', '[CONTAINED]']) + '\n',
+        ]
+        expected = [pymummer.alignment.Alignment(x) for x in lines]
+
+        for skip_self_hits in False, True:
+            for end in 3, 4:
+                table = hits.HitTable()
+                table._extend_from_lines(lines[:end], skip_self_hits=skip_self_hits)
+                wanted = [x for x in expected[:end] if not (skip_self_hits and x.ref_name == x.qry_name)]
+                self.assertEqual(table.hits(), wanted)
+
+        with self.assertRaises(hits.Error):
+            hits.HitTable()._extend_from_lines(lines[:1] + ['1\t2\tx\t4\t5\t6\t7\t8\t9\t10\t11\tref\tqry\n'])
+
+
+    def test_append(self):
+        '''test append'''
+        line = '\t'.join(['61', '500', '61', '500', '440', '440', '100.00', '500', '500', '1', '1', 'ref1', 'qry1'])
+        table = hits.HitTable()
+        table.append(hits.Hit.from_coords_line(line))
+        table.append(hits._parse_line(line))
+        self.assertEqual(2, len(table))
+        self.assertEqual(['ref1', 'qry1'], table.names)
+        self.assertEqual(table[0], table[1])
+        self.assertEqual(table[0], pymummer.alignment.Alignment(line))
+
+
+    def test_masks(self):
+        '''test the masks are the same as testing each hit'''
+        lines = random_coords_lines(500)
+        alignments = [pymummer.alignment.Alignment(x) for x in lines]
+        table = hits.HitTable()
+        for line in lines:
+            table.append(hits._parse_line(line))
+        self.assertEqual(table.hits(), alignments)
+
+        def check(mask, function):
+            self.assertEqual(len(alignments), len(mask))
+            self.assertEqual([i for i, x in enumerate(alignments) if function(x)], table.indexes(mask))
+
+        for tolerance in [1, 50, 500]:
+            check(table.at_ref_start(tolerance), lambda x: x.ref_coords().start < tolerance)
+            check(table.at_ref_end(tolerance), lambda x: x.ref_coords().end >= x.ref_length - tolerance)
+            check(table.at_qry_start(tolerance), lambda x: x.qry_coords().start < tolerance)
+            check(table.at_qry_end(tolerance), lambda x: x.qry_coords().end >= x.qry_length - tolerance)
+
+        check(table.min_qry_hit_length(500), lambda x: x.hit_length_qry >= 500)
+        check(table.min_qry_percent(95), lambda x: 100 * x.hit_length_qry / x.qry_length >= 95)
+        check(table.min_percent_identity(95), lambda x: x.percent_identity >= 95)
+        check(table.different_names(), lambda x: x.ref_name != x.qry_name)
+        check(table.qry_not_in({'ctg1', 'ctg2', 'not_a_contig'}), lambda x: x.qry_name not in {'ctg1', 'ctg2'})
+
+        expected = [i for i, x in enumerate(alignments) if x.hit_length_qry >= 500 and x.percent_identity >= 95]
+        self.assertEqual(expected, table.indexes(table.min_qry_hit_length(500), table.min_percent_identity(95)))
+        self.assertEqual(list(range(len(alignments))), table.indexes())
+
+
+class TestHitIndex(unittest.TestCase):
+    def test_longest(self):
+        '''test longest'''
+        lines = [
+            '\t'.join(['1', '100', '1', '100', '100', '100', '100.00', '1000', '1000', '1', '1', 'ref1', 'qry1']),
+            '\t'.join(['1', '200', '1', '200', '200', '200', '100.00', '1000', '1000', '1', '1', 'ref1', 'qry1']),
+            '\t'.join(['2', '201', '1', '200', '200', '200', '100.00', '1000', '1000', '1', '1', 'ref1', 'qry1']),
+            '\t'.join(['801', '1000', '1', '200', '200', '200', '100.00', '1000', '1000', '1', '1', 'ref1', 'qry1']),
+        ]
+        hit_list = [hits.Hit.from_coords_line(x) for x in lines]
+        calls = []
+
+        def at_start(hit):
+            calls.append(hit)
+            return hit.ref_start < 10
+
+        index = hits.HitIndex(hit_list, {'start': at_start, 'end': lambda x: x.ref_end > 900, 'none': lambda x: False})
+        self.assertEqual(4, len(index))
+        self.assertEqual([], calls)
+        self.assertIs(hit_list[1], index.longest('start'))
+        self.assertIs(hit_list[2], index.longest('start', exclude={hit_list[1]}))
+        self.assertIs(hit_list[0], index.longest('start', exclude={hit_list[1], hit_list[2]}))
+        self.assertIsNone(index.longest('start', exclude=set(hit_list)))
+        self.assertIs(hit_list[3], index.longest('end'))
+        self.assertIsNone(index.longest('none'))
+        self.assertEqual(hit_list, calls)
+
+
+    def test_has_qry_hit_longer_than(self):
+        '''test has_qry_hit_longer_than'''
+        lines = [
+            '\t'.join(['42', '43', '42', '43', '2', '2', '100.00', '424242', '4242', '1', '1', 'ref42', 'qry42']),
+            '\t'.join(['42', '44', '42', '44', '3', '3', '100.00', '424242', '4242', '1', '1', 'ref43', 'qry42']),
+            '\t'.join(['42', '45', '42', '45', '4', '4', '100.00', '424242', '4242', '1', '1', 'ref44', 'qry42']),
+        ]
+        hit_list = [hits.Hit.from_coords_line(x) for x in lines]
+        index = hits.HitIndex(hit_list, {})
+        self.assertTrue(index.has_qry_hit_longer_than(3))
+        self.assertTrue(index.has_qry_hit_longer_than(1, exclude={hit_list[2]}))
+        self.assertFalse(index.has_qry_hit_longer_than(2, exclude={hit_list[1], hit_list[2]}))
+        self.assertFalse(index.has_qry_hit_longer_than(4))
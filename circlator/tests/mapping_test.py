@@ -2,9 +2,10 @@ import unittest
 import copy
 import filecmp
 import os
+import shutil
 import pysam
 import pyfastaq
-from circlator import mapping
+from circlator import cache, mapping, runner
 
 modules_dir = os.path.dirname(os.path.abspath(mapping.__file__))
 data_dir = os.path.join(modules_dir, 'tests', 'data')
@@ -39,15 +40,21 @@ class TestMapping(unittest.TestCase):
             self.assertFalse(os.path.exists(filename))
 
 
+    def test_run_timed(self):
+        '''test _run_timed fails if the first command in a pipe fails'''
+        timings = {}
+        mapping._run_timed('true | cat', 'ok', timings)
+        self.assertEqual(['ok'], list(timings))
+        with self.assertRaises(runner.Error):
+            mapping._run_timed('sh -c "exit 3" | cat', 'fail', timings)
+        self.assertEqual(['ok'], list(timings))
+
+
     def test_bwa_mem(self):
         '''test bwa_mem'''
         ref = os.path.join(data_dir, 'mapping_test_bwa_mem.ref.fa')
         reads = os.path.join(data_dir, 'mapping_test_bwa_mem.reads.fq')
         outfile = 'tmp.mapping_test_bwa_mem.bam'
-        mapping.bwa_mem(ref, reads, outfile)
-        self.assertTrue(os.path.exists(outfile))
-        self.assertTrue(os.path.exists(outfile + '.bai'))
-
         expected_reads = [
             '1:2:49:172',
             '1:1:113:235',
@@ -57,16 +64,41 @@ class TestMapping(unittest.TestCase):
             '2:6:214:330',
         ]
 
-        sam_reader = pysam.Samfile(outfile, "rb")
-        got_reads = []
+        for stream in True, False:
+            timings = mapping.bwa_mem(ref, reads, outfile, stream=stream, sort_threads=2, sort_mem=100)
+            self.assertTrue(os.path.exists(outfile))
+            self.assertTrue(os.path.exists(outfile + '.bai'))
+            self.assertFalse(os.path.exists(outfile + '.tmp.unsorted.bam'))
+            self.assertEqual('samtools index', list(timings.keys())[-1])
+
+            sam_reader = pysam.Samfile(outfile, "rb")
+            got_reads = []
 
-        for read in sam_reader.fetch():
-            got_reads.append(read.qname)
-            self.assertFalse(read.is_unmapped)
+            for read in sam_reader.fetch():
+                got_reads.append(read.qname)
+                self.assertFalse(read.is_unmapped)
+
+            self.assertEqual(expected_reads, got_reads)
+            os.unlink(outfile)
+            os.unlink(outfile + '.bai')
+
+
+    def test_bwa_index_cache(self):
+        '''test BwaIndexCache index'''
+        ref = os.path.join(data_dir, 'mapping_test_bwa_index.fa')
+        tmp_dir = 'tmp.mapping_test_bwa_index_cache'
+        index_cache = mapping.BwaIndexCache(tmp_dir)
+        with index_cache.index(ref) as prefix:
+            self.assertEqual(os.path.join(os.path.abspath(tmp_dir), cache.file_hash(ref), 'index'), prefix)
+            for e in mapping.index_extensions:
+                self.assertTrue(os.path.exists(prefix + '.' + e))
+            mtime = os.path.getmtime(prefix + '.bwt')
 
-        self.assertEqual(expected_reads, got_reads)
-        os.unlink(outfile)
-        os.unlink(outfile + '.bai')
+        with index_cache.index(ref) as prefix2:
+            self.assertEqual(prefix, prefix2)
+            self.assertEqual(mtime, os.path.getmtime(prefix + '.bwt'))
+
+        shutil.rmtree(tmp_dir)
 
 
     def test_aligned_read_to_read(self):
@@ -86,3 +118,28 @@ class TestMapping(unittest.TestCase):
         self.assertEqual(read2, mapping.aligned_read_to_read(aln2))
         self.assertEqual(read2_rev, mapping.aligned_read_to_read(aln2, revcomp=False))
 
+
+    def test_wrap(self):
+        '''test _wrap'''
+        for length in 0, 1, 59, 60, 61, 120, 121:
+            seq = pyfastaq.sequences.Fasta('x', 'ACGTN' * length)
+            seq.seq = seq.seq[:length]
+            self.assertEqual(str(seq), '>x\n' + mapping._wrap(seq.seq, 60))
+            self.assertEqual(seq.seq, mapping._wrap(seq.seq, 0))
+
+
+    def test_aligned_read_to_record(self):
+        '''test aligned_read_to_record'''
+        infile = os.path.join(data_dir, 'mapping_test_aligned_read_to_read.bam')
+        sam_reader = pysam.Samfile(infile, "rb")
+        for aln in sam_reader.fetch():
+            for revcomp in True, False:
+                for ignore_quality in True, False:
+                    expected = str(mapping.aligned_read_to_read(aln, revcomp=revcomp, ignore_quality=ignore_quality)) + '\n'
+                    self.assertEqual(expected, mapping.aligned_read_to_record(aln, revcomp=revcomp, ignore_quality=ignore_quality))
+
+                    seq = mapping.aligned_read_to_read(aln, revcomp=False, ignore_quality=ignore_quality).subseq(5, 50)
+                    if revcomp and aln.is_reverse:
+                        seq.revcomp()
+                    self.assertEqual(str(seq) + '\n', mapping.aligned_read_to_record(aln, revcomp=revcomp, ignore_quality=ignore_quality, start=5, end=50))
+
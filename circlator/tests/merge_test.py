@@ -1,8 +1,10 @@
 import unittest
+import io
 import shutil
 import filecmp
 import copy
 import os
+import random
 import pymummer
 import pyfastaq
 from circlator import merge
@@ -222,6 +224,49 @@ class TestMerge(unittest.TestCase):
         self.assertEqual(expected, self.merger._get_longest_hit_at_qry_end(hits))
 
 
+    def test_get_longest_hit_at_random(self):
+        '''test _get_longest_hit_at_* and _has_qry_hit_longer_than on random hits, with and without a HitIndex'''
+        rng = random.Random(42)
+        merger = merge.Merger(
+            os.path.join(data_dir, 'merge_test_original.fa'),
+            os.path.join(data_dir, 'merge_test_reassembly.fa'),
+            'tmp.merge_test',
+            ref_end_tolerance=100,
+            qry_end_tolerance=50,
+        )
+
+        def longest(hits, is_at, exclude):
+            longest_hit = None
+            for hit in hits:
+                if is_at(hit) and hit not in exclude and (longest_hit is None or hit.hit_length_ref > longest_hit.hit_length_ref):
+                    longest_hit = hit
+            return longest_hit
+
+        for i in range(50):
+            hits = []
+            for j in range(rng.randint(1, 30)):
+                ref_start, ref_end = sorted(rng.sample(range(1, 501), 2))
+                qry_start, qry_end = sorted(rng.sample(range(1, 301), 2))
+                if rng.random() < 0.5:
+                    qry_start, qry_end = qry_end, qry_start
+                values = [ref_start, ref_end, qry_start, qry_end, ref_end - ref_start + 1, abs(qry_end - qry_start) + 1, '100.00', 500, 300, 1, 1, 'ref1', 'qry1']
+                hits.append(pymummer.alignment.Alignment('\t'.join([str(x) for x in values])))
+            hits += rng.sample(hits, min(3, len(hits)))
+            exclude = set(rng.sample(hits, min(2, len(hits))))
+            index = merger._hit_index(hits)
+            self.assertIs(index, merger._hit_index(index))
+
+            for nucmer_hits in hits, index:
+                self.assertEqual(longest(hits, merger._is_at_ref_start, set()), merger._get_longest_hit_at_ref_start(nucmer_hits))
+                self.assertEqual(longest(hits, merger._is_at_ref_start, exclude), merger._get_longest_hit_at_ref_start(nucmer_hits, hits_to_exclude=exclude))
+                self.assertEqual(longest(hits, merger._is_at_ref_end, exclude), merger._get_longest_hit_at_ref_end(nucmer_hits, hits_to_exclude=exclude))
+                self.assertEqual(longest(hits, merger._is_at_qry_start, set()), merger._get_longest_hit_at_qry_start(nucmer_hits))
+                self.assertEqual(longest(hits, merger._is_at_qry_end, set()), merger._get_longest_hit_at_qry_end(nucmer_hits))
+                for min_length in 1, 100, 200:
+                    expected = len([x for x in hits if x not in exclude and x.hit_length_qry > min_length]) > 0
+                    self.assertEqual(expected, merger._has_qry_hit_longer_than(nucmer_hits, min_length, hits_to_exclude=exclude))
+
+
     def test_hits_have_same_query(self):
         '''test _hits_have_same_query'''
         hits = [
@@ -578,6 +623,50 @@ class TestMerge(unittest.TestCase):
             os.unlink(f)
 
 
+    def test_write_act_files_deferred(self):
+        '''test _write_act_files and write_act_files_from_list when act_files_list is used'''
+        merger = merge.Merger(
+            os.path.join(data_dir, 'merge_test_original.fa'),
+            os.path.join(data_dir, 'merge_test_reassembly.fa'),
+            'tmp.merge_test',
+            act_files_list='tmp.merge_test.act_files.tsv'
+        )
+        outprefix = 'tmp.test_write_act_files_deferred'
+        merger._write_act_files('ref.fa', 'qry.fa', 'hits.coords', outprefix)
+        self.assertFalse(os.path.exists(outprefix + '.start_act.sh'))
+        self.assertEqual([['ref.fa', 'qry.fa', 'hits.coords', outprefix]], merger.deferred_act_files)
+
+        act_list = 'tmp.test_write_act_files_deferred.tsv'
+        with open(act_list, 'w') as f:
+            print('target.sh', outprefix + '.start_act.sh', sep='\t', file=f)
+        merge.write_act_files_from_list(act_list)
+        self.assertEqual('target.sh', os.readlink(outprefix + '.start_act.sh'))
+        os.unlink(outprefix + '.start_act.sh')
+        os.unlink(act_list)
+
+
+    def test_act_files_from_list(self):
+        '''test act_files_from_list'''
+        act_list = 'tmp.test_act_files_from_list.tsv'
+        self.assertEqual([], merge.act_files_from_list(act_list))
+        with open(act_list, 'w') as f:
+            print(os.path.abspath('ref.fa'), 'dir/qry.fa', 'hits.coords', os.path.abspath('out1'), sep='\t', file=f)
+            print('ref.fa', 'dir2/qry.fa', 'hits2.coords', 'out2', sep='\t', file=f)
+            print('out1.start_act.sh', 'link.start_act.sh', sep='\t', file=f)
+        expected = [
+            'dir/qry.fa.fai',
+            'dir2/qry.fa.fai',
+            'link.start_act.sh',
+            'out1.crunch',
+            'out1.start_act.sh',
+            'out2.crunch',
+            'out2.start_act.sh',
+            'ref.fa.fai',
+        ]
+        self.assertEqual(expected, merge.act_files_from_list(act_list))
+        os.unlink(act_list)
+
+
     def test_contigs_dict_to_file(self):
         '''test _contigs_dict_to_file'''
         d = {
@@ -618,9 +707,181 @@ class TestMerge(unittest.TestCase):
         self.assertEqual(got, expected)
 
 
+    def test_contigs_connected_by_hits(self):
+        '''test _contigs_connected_by_hits'''
+        pairs = [('ref1', 'qry1'), ('ref2', 'qry1'), ('ref2', 'qry2'), ('ref3', 'qry2'), ('ref4', 'qry3'), ('ref5', 'qry4'), ('ref5', 'qry4')]
+        nucmer_hits = {}
+        for ref_name, qry_name in pairs:
+            line = '\t'.join(['1', '100', '1', '100', '100', '100', '100.00', '1000', '1000', '1', '1', ref_name, qry_name])
+            nucmer_hits.setdefault(ref_name, []).append(pymummer.alignment.Alignment(line))
+
+        self.assertEqual(({'ref1', 'ref2', 'ref3'}, {'qry1', 'qry2'}), self.merger._contigs_connected_by_hits(nucmer_hits, {'ref1'}))
+        self.assertEqual(({'ref1', 'ref2', 'ref3', 'ref5'}, {'qry1', 'qry2', 'qry4'}), self.merger._contigs_connected_by_hits(nucmer_hits, {'ref3', 'ref5'}))
+        self.assertEqual(({'ref4'}, {'qry3'}), self.merger._contigs_connected_by_hits(nucmer_hits, {'ref4'}))
+        self.assertEqual(({'ref6'}, set()), self.merger._contigs_connected_by_hits(nucmer_hits, {'ref6'}))
+
+
+    def test_reads_from_contig_bams(self):
+        '''test _reads_from_contig_bams'''
+        bam1 = os.path.join(data_dir, 'bamfilter_test_run_no_qual.bam')
+        bam2 = os.path.join(data_dir, 'bamfilter_test_run_with_qual.bam')
+        self.merger.contig_bams = {'contig1': bam1, 'contig3': bam1, 'contig2': bam2, 'contig4': bam2}
+        expected = []
+        for bam, contigs in [(bam1, {'contig1'}), (bam2, {'contig2', 'contig4'})]:
+            b = merge.circlator.bamfilter.BamFilter(bam, 'tmp.merge_test_reads_from_contig_bams.expected', contigs_to_use=contigs, discard_unmapped=True)
+            b.run()
+            with open(b.reads_outfile) as f:
+                expected.append(f.read())
+            os.unlink(b.reads_outfile)
+            os.unlink(b.log)
+
+        got = self.merger._reads_from_contig_bams({'contig1', 'contig2', 'contig4'}, 'tmp.merge_test_reads_from_contig_bams')
+        self.assertEqual(os.path.abspath('tmp.merge_test_reads_from_contig_bams.fasta'), os.path.abspath(got))
+        with open(got) as f:
+            self.assertEqual(''.join(expected), f.read())
+        os.unlink(got)
+        for i in 1, 2:
+            self.assertFalse(os.path.exists('tmp.merge_test_reads_from_contig_bams.' + str(i) + '.fasta'))
+            os.unlink('tmp.merge_test_reads_from_contig_bams.' + str(i) + '.log')
+
+
+    def test_local_remap_and_reassemble_all_connected(self):
+        '''test _local_remap_and_reassemble does nothing when all contigs are connected to the joins'''
+        self.merger.original_contigs = {'ref1.ref2': pyfastaq.sequences.Fasta('ref1.ref2', 'ACGT')}
+        self.merger.contig_bams = {'ref1': 'bam', 'ref2': 'bam', 'ref3': 'bam'}
+        lines = [
+            '\t'.join(['1', '100', '1', '100', '100', '100', '100.00', '1000', '1000', '1', '1', 'ref1', 'qry1']),
+            '\t'.join(['1', '100', '1', '100', '100', '100', '100.00', '1000', '1000', '1', '1', 'ref3', 'qry1']),
+        ]
+        nucmer_hits = {x.ref_name: [x] for x in [pymummer.alignment.Alignment(line) for line in lines]}
+        log_fh = io.StringIO()
+        self.assertFalse(self.merger._local_remap_and_reassemble(nucmer_hits, 'tmp.merge_test', 2, log_fh, 'log'))
+        self.assertEqual('log\tAll contigs are connected to the joined contigs by nucmer matches, so remapping and reassembling all reads\n', log_fh.getvalue())
+        self.assertEqual({'ref1': 'bam', 'ref2': 'bam', 'ref3': 'bam'}, self.merger.contig_bams)
+
+
+    def test_circularise_contigs(self):
+        '''test _circularise_contigs gives the same files with and without a process pool'''
+        outprefixes = []
+        min_contigs_for_pool = merge.min_contigs_for_circularise_pool
+        merge.min_contigs_for_circularise_pool = 1
+        for threads in 1, 2:
+            outprefix = 'tmp.merge_test_circularise_contigs.' + str(threads)
+            merger = merge.Merger(
+                os.path.join(data_dir, 'merge_test_circularise_contigs.ref.fa'),
+                os.path.join(data_dir, 'merge_test_circularise_contigs.assembly'),
+                outprefix,
+                nucmer_min_length_for_merges=50,
+                ref_end_tolerance=10,
+                qry_end_tolerance=10,
+                threads=threads,
+            )
+            pyfastaq.tasks.file_to_dict(merger.original_fasta, merger.original_contigs)
+            merger._circularise_contigs(merger._load_nucmer_hits(os.path.join(data_dir, 'merge_test_circularise_contigs.coords')))
+            outprefixes.append(outprefix)
+        merge.min_contigs_for_circularise_pool = min_contigs_for_pool
+
+        with open(outprefixes[0] + '.circularise.log') as f:
+            got = [line.rstrip().split('\t')[1:] for line in f][1:]
+        expected = [
+            ['ref1', '0', '0', '1', '1'],
+            ['ref2', '1', '0', '0', '0'],
+            ['ref3', '0', '1', '0', '1'],
+            ['ref4', '0', '0', '0', '0'],
+        ]
+        self.assertEqual(expected, got)
+
+        for suffix in '.circularise_details.log', '.circularise.log', '.fasta':
+            self.assertTrue(filecmp.cmp(outprefixes[0] + suffix, outprefixes[1] + suffix, shallow=False))
+            for outprefix in outprefixes:
+                os.unlink(outprefix + suffix)
+
+
     def test_get_spades_circular_nodes(self):
         fastg = os.path.join(data_dir, 'merge_test_get_spades_circular_nodes.fastg')
         got = self.merger._get_spades_circular_nodes(fastg)
         expected = set(['NODE_1_length_5_cov_42.42_ID_1'])
         self.assertEqual(expected, got)
 
+
+
+def fake_nucmer(ref_fasta, qry_fasta, outfile):
+    '''Stand-in for nucmer: one hit for each query that is a substring of a
+       reference, sorted like show-coords -r'''
+    refs = {}
+    qrys = {}
+    pyfastaq.tasks.file_to_dict(ref_fasta, refs)
+    pyfastaq.tasks.file_to_dict(qry_fasta, qrys)
+    lines = []
+    for ref_name in sorted(refs):
+        for qry_name, qry in sorted(qrys.items()):
+            start = refs[ref_name].seq.find(qry.seq)
+            if start != -1:
+                values = [start + 1, start + len(qry), 1, len(qry), len(qry), len(qry), '100.00', len(refs[ref_name]), len(qry), 1, 1, ref_name, qry_name, '']
+                lines.append('\t'.join(str(x) for x in values))
+
+    with open(outfile, 'w') as f:
+        print(ref_fasta, qry_fasta, 'NUCMER', '', sep='\n', file=f)
+        print('[S1]', '[E1]', '[S2]', '[E2]', '[LEN 1]', '[LEN 2]', '[% IDY]', '[LEN R]', '[LEN Q]', '[FRM]', '[TAGS]', sep='\t', file=f)
+        for line in lines:
+            print(line, file=f)
+
+
+class TestNucmerHitCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = 'tmp.merge_test_nucmer_hit_cache'
+        if os.path.exists(self.tmp_dir):
+            shutil.rmtree(self.tmp_dir)
+        os.mkdir(self.tmp_dir)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+    def _write_fasta(self, name, seqs):
+        filename = os.path.join(self.tmp_dir, name)
+        with open(filename, 'w') as f:
+            for seq_name, seq in seqs:
+                print('>' + seq_name, seq, sep='\n', file=f)
+        return filename
+
+
+    def test_run(self):
+        '''test NucmerHitCache run is the same as running nucmer every time'''
+        rng = random.Random(42)
+        seqs = [''.join(rng.choice('ACGT') for _ in range(100)) for _ in range(4)]
+        calls = []
+
+        def run_nucmer(ref_fasta, qry_fasta, outfile):
+            calls.append([[x.id for x in pyfastaq.sequences.file_reader(fname)] for fname in (ref_fasta, qry_fasta)])
+            fake_nucmer(ref_fasta, qry_fasta, outfile)
+
+        cache = merge.NucmerHitCache(run_nucmer)
+        rounds = [
+            ([('ref1', seqs[0] + seqs[1]), ('ref2', seqs[2])], [('qry1', seqs[1][10:60]), ('qry2', seqs[2][:50])]),
+            # ref1 and qry2 are the same, but renamed. ref3 and qry3 are new
+            ([('ref3', seqs[3] + seqs[2]), ('new_ref1', seqs[0] + seqs[1])], [('new_qry2', seqs[2][:50]), ('qry3', seqs[0][20:70])]),
+            # everything has been seen before
+            ([('ref3', seqs[3] + seqs[2])], [('qry1', seqs[1][10:60]), ('qry3', seqs[0][20:70])]),
+        ]
+        # number of ref and qry sequences in each run of nucmer
+        expected_calls = [[(2, 2)], [(1, 2), (1, 1)], [(1, 1)]]
+        expected_reused = [0, 1, 1]
+
+        for i, (refs, qrys) in enumerate(rounds):
+            calls.clear()
+            ref_fasta = self._write_fasta('ref.' + str(i) + '.fa', refs)
+            qry_fasta = self._write_fasta('qry.' + str(i) + '.fa', qrys)
+            expected_file = os.path.join(self.tmp_dir, 'expected.' + str(i) + '.coords')
+            got_file = os.path.join(self.tmp_dir, 'got.' + str(i) + '.coords')
+            fake_nucmer(ref_fasta, qry_fasta, expected_file)
+            got = cache.run(ref_fasta, qry_fasta, got_file)
+            expected = list(pymummer.coords_file.reader(expected_file))
+            self.assertEqual(got.hits(), expected)
+            self.assertEqual(list(pymummer.coords_file.reader(got_file)), expected)
+            self.assertEqual(expected_calls[i], [(len(x), len(y)) for x, y in calls])
+            self.assertEqual(expected_reused[i], cache.reused_pairs)
+            self.assertEqual(len(refs) * len(qrys) - expected_reused[i], cache.aligned_pairs)
+
+        self.assertEqual([], [x for x in os.listdir(self.tmp_dir) if x.startswith('tmp.')])
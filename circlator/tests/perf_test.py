@@ -0,0 +1,120 @@
+import unittest
+import os
+import json
+import time
+import shutil
+import resource
+import threading
+import multiprocessing
+from circlator import perf, runner
+
+
+def busy(seconds):
+    start_time = time.process_time()
+    while time.process_time() - start_time < seconds:
+        pass
+
+
+class TestPerf(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = 'tmp.perf_test'
+        if os.path.exists(self.tmp_dir):
+            shutil.rmtree(self.tmp_dir)
+        os.mkdir(self.tmp_dir)
+
+
+    def tearDown(self):
+        runner.set_report(None)
+        perf.set_profiler(None)
+        shutil.rmtree(self.tmp_dir)
+
+
+    def test_record_no_profiler(self):
+        '''test record does nothing when there is no profiler'''
+        with perf.record('x') as metrics:
+            metrics['bytes_read'] = 1
+        self.assertIsNone(perf.get_profiler())
+
+
+    def test_profiler(self):
+        '''test Profiler'''
+        runner.set_report(runner.Report())
+        profiler = perf.Profiler()
+        self.assertIsNone(perf.set_profiler(profiler))
+
+        megabyte = 1024 * 1024
+        with perf.record('stage1') as metrics:
+            runner.run('true')
+            with perf.record('iteration 1'):
+                runner.run('sleep 0.1; head -c ' + str(megabyte) + ' /dev/zero > ' + os.path.join(self.tmp_dir, 'external'))
+            with open(os.path.join(self.tmp_dir, 'python'), 'wb') as f:
+                f.write(b'x' * megabyte)
+            metrics['extra'] = 42
+        with perf.record('stage2'):
+            pass
+        runner.run('true')
+
+        records = profiler.get_records()
+        self.assertEqual(['stage1', 'iteration 1', 'stage2'], [x['name'] for x in records])
+        self.assertEqual([None, 'stage1', None], [x['parent'] for x in records])
+        self.assertEqual([2, 1, 0], [x['external_processes'] for x in records])
+        self.assertGreaterEqual(records[0]['wall_seconds'], records[1]['wall_seconds'])
+        self.assertGreaterEqual(records[1]['external_wall_seconds'], 0.1)
+        self.assertEqual(42, records[0]['extra'])
+        self.assertEqual(records[0]['external_bytes_written'], records[1]['external_bytes_written'])
+        self.assertGreaterEqual(records[1]['external_bytes_written'], megabyte)
+        self.assertGreaterEqual(records[1]['bytes_written'], megabyte)
+        self.assertGreaterEqual(records[0]['bytes_written'], 2 * megabyte)
+        self.assertLess(records[2]['bytes_written'], megabyte)
+
+        lines = profiler.summary_table()
+        self.assertEqual(4, len(lines))
+        self.assertTrue(lines[0].startswith('Stage'))
+        self.assertTrue(lines[1].startswith('stage1 '))
+        self.assertTrue(lines[2].startswith('  iteration 1 '))
+        self.assertTrue(lines[3].startswith('stage2 '))
+        self.assertGreaterEqual(float(lines[1].split()[-1]), 2)
+        self.assertGreaterEqual(float(lines[2].split()[-1]), 1)
+
+        json_file = os.path.join(self.tmp_dir, 'perf.json')
+        profiler.write_json(json_file, threads=2)
+        with open(json_file) as f:
+            got = json.load(f)
+        self.assertEqual(2, got['threads'])
+        self.assertEqual(perf.notes, got['notes'])
+        self.assertEqual(records, got['records'])
+
+
+    def test_profiler_cpu_and_memory(self):
+        '''test Profiler counts worker processes and threads, but not external programs twice'''
+        runner.set_report(runner.Report())
+        profiler = perf.Profiler()
+        perf.set_profiler(profiler)
+
+        with perf.record('pool'):
+            with multiprocessing.Pool(1) as pool:
+                pool.map(busy, [0.3])
+        with perf.record('thread'):
+            thread = threading.Thread(target=busy, args=(0.3,))
+            thread.start()
+            thread.join()
+        with perf.record('external'):
+            runner.run('i=0; while [ $i -lt 100000 ]; do i=$((i+1)); done')
+        with perf.record('memory'):
+            # more than the peak so far, so that it has to make a new peak
+            data = bytearray(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 + 50 * 1024 * 1024)
+            data[::4096] = b'x' * len(data[::4096])
+            del data
+        with perf.record('after'):
+            pass
+
+        pool, thread, external, memory, after = profiler.get_records()
+        self.assertGreaterEqual(pool['cpu_seconds'], 0.3)
+        self.assertGreaterEqual(pool['process_cpu_seconds'], 0.3)
+        self.assertLess(thread['cpu_seconds'], 0.3)
+        self.assertGreaterEqual(thread['process_cpu_seconds'], 0.3)
+        self.assertGreater(external['external_cpu_seconds'], 0)
+        self.assertLess(external['cpu_seconds'], external['external_cpu_seconds'])
+        self.assertGreaterEqual(memory['stage_rss_increase_kb'], 50 * 1024)
+        self.assertEqual(0, after['stage_rss_increase_kb'])
+        self.assertEqual(memory['process_peak_rss_kb'], after['process_peak_rss_kb'])
@@ -0,0 +1,224 @@
+import unittest
+import os
+import shutil
+import threading
+import time
+from circlator import cache, pipeline
+
+
+def write_file(filename, contents):
+    with open(filename, 'w') as f:
+        f.write(contents)
+
+
+class TestPipeline(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = 'tmp.pipeline_test'
+        if os.path.exists(self.tmp_dir):
+            shutil.rmtree(self.tmp_dir)
+        os.mkdir(self.tmp_dir)
+        self.infile = os.path.join(self.tmp_dir, 'in.txt')
+        self.outprefix = os.path.join(self.tmp_dir, '01.stage')
+        self.outfile = self.outprefix + '.out'
+        write_file(self.infile, 'input\n')
+        self.runs = 0
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+    def _run(self):
+        self.runs += 1
+        with open(self.infile) as f_in, open(self.outfile, 'w') as f_out:
+            f_out.write(f_in.read().upper())
+
+
+    def _stage(self, params=None):
+        return pipeline.Stage(self.outprefix, self._run, inputs=[self.infile, None], outputs=[self.outprefix + '.*'], params=params)
+
+
+    def test_path_state(self):
+        '''test path_state and state_hashes'''
+        self.assertIsNone(pipeline.path_state(os.path.join(self.tmp_dir, 'notthere')))
+        self.assertIsNone(pipeline.state_hashes(None))
+        sha256 = cache.file_hash(self.infile)
+        state = pipeline.path_state(self.infile)
+        self.assertEqual(sha256, state['sha256'])
+        self.assertEqual(6, state['size'])
+        self.assertEqual(sha256, pipeline.state_hashes(state))
+
+        # the sha256 is only reused if the size and modification time are the same
+        old_state = dict(state, sha256='x')
+        self.assertEqual('x', pipeline.path_state(self.infile, old_state)['sha256'])
+        old_state['mtime_ns'] -= 1
+        self.assertEqual(sha256, pipeline.path_state(self.infile, old_state)['sha256'])
+
+        dir_state = pipeline.path_state(self.tmp_dir)
+        self.assertEqual({'in.txt': sha256}, pipeline.state_hashes(dir_state))
+
+
+    def test_stage_output_paths(self):
+        '''test Stage output_paths'''
+        stage = self._stage()
+        self.assertEqual(self.outprefix + '.manifest.json', stage.manifest_file())
+        self.assertEqual([self.infile], stage.inputs)
+        self.assertEqual([], stage.output_paths())
+        write_file(stage.manifest_file(), '')
+        write_file(self.outfile, '')
+        self.assertEqual([self.outfile], stage.output_paths())
+
+        outputs = []
+        stage = pipeline.Stage('x', None, outputs=lambda: outputs)
+        self.assertEqual([], stage.output_paths())
+        outputs.append(self.outfile)
+        self.assertEqual([self.outfile], stage.output_patterns())
+        self.assertEqual([self.outfile], stage.output_paths())
+
+
+    def test_run_stage_no_resume(self):
+        '''test run_stage always runs when not resuming'''
+        p = pipeline.Pipeline()
+        self.assertTrue(p.run_stage(self._stage()))
+        self.assertTrue(os.path.exists(self._stage().manifest_file()))
+        self.assertTrue(p.run_stage(self._stage()))
+        self.assertEqual(2, self.runs)
+        self.assertEqual([self.outprefix, self.outprefix], p.stages_run)
+
+
+    def test_run_stage_resume(self):
+        '''test run_stage skips stages when resuming and nothing has changed'''
+        p = pipeline.Pipeline(resume=True)
+        self.assertTrue(p.run_stage(self._stage(params={'x': 1})))
+        self.assertFalse(p.run_stage(self._stage(params={'x': 1})))
+        self.assertEqual(1, self.runs)
+        self.assertEqual([self.outprefix], p.stages_skipped)
+
+        # rewriting the input with the same contents does not matter
+        write_file(self.infile, 'input\n')
+        self.assertFalse(p.run_stage(self._stage(params={'x': 1})))
+        self.assertEqual(1, self.runs)
+
+        # changing a parameter
+        self.assertTrue(p.run_stage(self._stage(params={'x': 2})))
+        self.assertEqual(2, self.runs)
+
+        # changing an input
+        write_file(self.infile, 'changed\n')
+        self.assertTrue(p.run_stage(self._stage(params={'x': 2})))
+        self.assertEqual(3, self.runs)
+        with open(self.outfile) as f:
+            self.assertEqual('CHANGED\n', f.read())
+
+        # changing an output
+        write_file(self.outfile, 'oops\n')
+        self.assertTrue(p.run_stage(self._stage(params={'x': 2})))
+        self.assertEqual(4, self.runs)
+
+        # an extra output file
+        write_file(self.outprefix + '.extra', '')
+        self.assertTrue(p.run_stage(self._stage(params={'x': 2})))
+        self.assertEqual(5, self.runs)
+        self.assertFalse(os.path.exists(self.outprefix + '.extra'))
+
+        # deleting an output
+        os.unlink(self.outfile)
+        self.assertTrue(p.run_stage(self._stage(params={'x': 2})))
+        self.assertEqual(6, self.runs)
+        self.assertFalse(p.run_stage(self._stage(params={'x': 2})))
+        self.assertEqual(6, self.runs)
+
+
+    def test_run_stage_missing_input(self):
+        '''test run_stage when input file is missing'''
+        os.unlink(self.infile)
+        p = pipeline.Pipeline(resume=True)
+        with self.assertRaises(pipeline.Error):
+            p.run_stage(self._stage())
+        self.assertEqual(0, self.runs)
+
+
+class TestPipelineRun(unittest.TestCase):
+    def test_depends_on(self):
+        '''test Stage depends_on'''
+        a = pipeline.Stage('a', None, outputs=['a.*', 'dir_a'], exclude=['*.fai'])
+        self.assertTrue(pipeline.Stage('b', None, inputs=['a.fa']).depends_on(a))
+        self.assertTrue(pipeline.Stage('b', None, inputs=['dir_a/file']).depends_on(a))
+        self.assertFalse(pipeline.Stage('b', None, inputs=['a.fa.fai']).depends_on(a))
+        self.assertFalse(pipeline.Stage('b', None, inputs=['b.fa', 'dir_ab']).depends_on(a))
+        self.assertTrue(pipeline.Stage('b', None, depends=['a']).depends_on(a))
+
+
+    def test_dependencies(self):
+        '''test Pipeline dependencies'''
+        stages = [
+            pipeline.Stage('a', None, inputs=['in'], outputs=['a.out']),
+            pipeline.Stage('b', None, inputs=['in'], outputs=['b.out']),
+            pipeline.Stage('c', None, inputs=['a.out', 'b.out'], outputs=['c.out']),
+            pipeline.Stage('d', None, inputs=['a.out'], depends=['b']),
+        ]
+        expected = {'a': set(), 'b': set(), 'c': {'a', 'b'}, 'd': {'a', 'b'}}
+        self.assertEqual(expected, pipeline.Pipeline.dependencies(stages))
+
+        with self.assertRaises(pipeline.Error):
+            pipeline.Pipeline.dependencies(stages + [pipeline.Stage('a', None)])
+
+        with self.assertRaises(pipeline.Error):
+            pipeline.Pipeline.dependencies([pipeline.Stage('a', None, depends=['b']), pipeline.Stage('b', None)])
+
+
+    def test_run(self):
+        '''test Pipeline run'''
+        lock = threading.Lock()
+        running = set()
+        max_threads = [0]
+        order = []
+        alone = []
+
+        def make_function(name, threads):
+            def f():
+                with lock:
+                    running.add((name, threads))
+                    if threads > 3:
+                        alone.append(len(running) == 1)
+                    else:
+                        max_threads[0] = max(max_threads[0], sum(x[1] for x in running))
+                    order.append(name + ' start')
+                time.sleep(0.05)
+                with lock:
+                    running.remove((name, threads))
+                    order.append(name + ' end')
+            return f
+
+        stages = [
+            pipeline.Stage('a', make_function('a', 2), depends=[], threads=2, manifest=False),
+            pipeline.Stage('b', make_function('b', 1), threads=1, manifest=False),
+            pipeline.Stage('c', make_function('c', 1), depends=['a'], threads=1, manifest=False),
+            pipeline.Stage('d', make_function('d', 1), depends=['b'], threads=1, manifest=False),
+            pipeline.Stage('e', make_function('e', 4), depends=['c', 'd'], threads=4, manifest=False),
+        ]
+        p = pipeline.Pipeline()
+        p.run(stages, threads=3)
+        self.assertEqual(['a', 'b', 'c', 'd', 'e'], sorted(p.stages_run))
+        self.assertEqual(3, max_threads[0])
+        self.assertEqual([True], alone)
+        self.assertLess(order.index('b start'), order.index('a end'))
+        self.assertLess(order.index('a end'), order.index('c start'))
+        self.assertLess(order.index('b end'), order.index('d start'))
+        self.assertLess(max(order.index('c end'), order.index('d end')), order.index('e start'))
+
+
+    def test_run_fail(self):
+        '''test Pipeline run when a stage fails'''
+        ran = []
+
+        def fail():
+            raise pipeline.Error('oops')
+
+        stages = [
+            pipeline.Stage('a', fail, manifest=False),
+            pipeline.Stage('b', lambda: ran.append('b'), depends=['a'], manifest=False),
+        ]
+        with self.assertRaises(pipeline.Error):
+            pipeline.Pipeline().run(stages, threads=2)
+        self.assertEqual([], ran)
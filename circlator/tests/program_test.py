@@ -0,0 +1,91 @@
+import unittest
+import os
+import re
+import shutil
+from circlator import program
+
+
+class TestProgram(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = os.path.abspath('tmp.program_test')
+        if os.path.exists(self.tmp_dir):
+            shutil.rmtree(self.tmp_dir)
+        os.mkdir(self.tmp_dir)
+        self.exe = os.path.join(self.tmp_dir, 'prog')
+        self.runs_file = os.path.join(self.tmp_dir, 'runs')
+        self._write_exe('1.2.3')
+        self.cache_file = os.path.join(self.tmp_dir, 'cache', 'versions.json')
+        self.old_env = os.environ.get(program.version_cache_env)
+        os.environ[program.version_cache_env] = self.cache_file
+        program._versions.clear()
+
+
+    def tearDown(self):
+        if self.old_env is None:
+            del os.environ[program.version_cache_env]
+        else:
+            os.environ[program.version_cache_env] = self.old_env
+        program._versions.clear()
+        shutil.rmtree(self.tmp_dir)
+
+
+    def _write_exe(self, version):
+        with open(self.exe, 'w') as f:
+            print('#!/bin/sh', file=f)
+            print('echo run >> ' + self.runs_file, file=f)
+            print('echo Version: ' + version, file=f)
+        os.chmod(self.exe, 0o755)
+
+
+    def _runs(self):
+        if not os.path.exists(self.runs_file):
+            return 0
+        with open(self.runs_file) as f:
+            return len(f.readlines())
+
+
+    def _program(self):
+        return program.Program(self.exe, '', re.compile(r'^Version: ([0-9\.]+)'))
+
+
+    def test_version_cache(self):
+        '''test program versions are only got once'''
+        self.assertEqual('1.2.3', self._program().version)
+        self.assertEqual(1, self._runs())
+        self.assertTrue(os.path.exists(self.cache_file))
+
+        # same process
+        stats = program.version_stats.copy()
+        self.assertEqual('1.2.3', self._program().version)
+        self.assertEqual(1, self._runs())
+        self.assertEqual(1, program.version_stats['memory'] - stats['memory'])
+
+        # new process, so only the cache file is used
+        program._versions.clear()
+        self.assertEqual('1.2.3', self._program().version)
+        self.assertEqual(1, self._runs())
+        self.assertEqual(1, program.version_stats['file'] - stats['file'])
+
+        # program changed, so must be run again
+        program._versions.clear()
+        self._write_exe('1.2.40')
+        self.assertEqual('1.2.40', self._program().version)
+        self.assertEqual(2, self._runs())
+
+
+    def test_version_cache_no_file(self):
+        '''test program versions when not using a cache file'''
+        os.environ[program.version_cache_env] = ''
+        self.assertIsNone(program.version_cache_file())
+        self.assertEqual('1.2.3', self._program().version)
+        program._versions.clear()
+        self.assertEqual('1.2.3', self._program().version)
+        self.assertEqual(2, self._runs())
+        self.assertFalse(os.path.exists(self.cache_file))
+
+
+    def test_not_in_path(self):
+        '''test program that is not in the path'''
+        p = program.Program(os.path.join(self.tmp_dir, 'notthere'), '', re.compile(r'^Version: ([0-9\.]+)'))
+        self.assertFalse(p.in_path())
+        self.assertIsNone(p.version)
@@ -0,0 +1,154 @@
+import unittest
+import os
+import json
+import shutil
+import threading
+import time
+from circlator import runner
+
+
+class TestRunner(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = 'tmp.runner_test'
+        if os.path.exists(self.tmp_dir):
+            shutil.rmtree(self.tmp_dir)
+        os.mkdir(self.tmp_dir)
+
+
+    def tearDown(self):
+        runner.set_report(None)
+        shutil.rmtree(self.tmp_dir)
+
+
+    def test_run_ok(self):
+        '''test run when the command works'''
+        log_file = os.path.join(self.tmp_dir, 'log')
+        metrics = runner.run('echo out; echo err >&2', log_file=log_file)
+        self.assertEqual('ok', metrics['status'])
+        self.assertEqual(0, metrics['returncode'])
+        self.assertEqual('echo', metrics['name'])
+        self.assertIsNone(metrics['output'])
+        self.assertGreaterEqual(metrics['wall_seconds'], 0)
+        self.assertGreater(metrics['max_rss_kb'], 0)
+        with open(log_file) as f:
+            self.assertEqual('out\nerr\n', f.read())
+
+
+    def test_run_fail(self):
+        '''test run when the command fails'''
+        with self.assertRaises(runner.Error):
+            runner.run('echo oops; exit 2')
+
+        metrics = runner.run('echo oops; exit 2', name='test', allow_fail=True)
+        self.assertEqual('failed', metrics['status'])
+        self.assertEqual(2, metrics['returncode'])
+        self.assertEqual('test', metrics['name'])
+        self.assertEqual('oops\n', metrics['output'])
+
+
+    def test_run_pipefail(self):
+        '''test run with pipefail when the first command in a pipe fails'''
+        metrics = runner.run('sh -c "exit 3" | cat', allow_fail=True)
+        self.assertEqual('ok', metrics['status'])
+
+        metrics = runner.run('sh -c "echo oops; exit 3" | cat', name='pipe', allow_fail=True, pipefail=True)
+        self.assertEqual('failed', metrics['status'])
+        self.assertEqual(3, metrics['returncode'])
+        self.assertEqual('oops\n', metrics['output'])
+        self.assertEqual('ok', runner.run('true | cat', pipefail=True)['status'])
+
+
+    def test_run_timeout(self):
+        '''test run kills the command after the timeout'''
+        start_time = time.perf_counter()
+        metrics = runner.run('sleep 10', timeout=0.5, allow_fail=True)
+        self.assertLess(time.perf_counter() - start_time, 5)
+        self.assertEqual('timeout', metrics['status'])
+
+        with self.assertRaises(runner.Error):
+            runner.run('sleep 10', timeout=0.5)
+
+
+    def test_run_stop(self):
+        '''test run kills the command when stop is set'''
+        stop = threading.Event()
+        threading.Timer(0.3, stop.set).start()
+        start_time = time.perf_counter()
+        metrics = runner.run('sleep 10', stop=stop, allow_fail=True)
+        self.assertLess(time.perf_counter() - start_time, 5)
+        self.assertEqual('stopped', metrics['status'])
+
+
+    def test_run_ignores_sigterm(self):
+        '''test run kills a command that ignores SIGTERM'''
+        old_grace = runner.kill_grace_seconds
+        runner.kill_grace_seconds = 0.5
+        try:
+            start_time = time.perf_counter()
+            metrics = runner.run('trap "" TERM; sleep 10', timeout=0.5, allow_fail=True)
+            self.assertLess(time.perf_counter() - start_time, 5)
+            self.assertEqual('timeout', metrics['status'])
+
+            stop = threading.Event()
+            stop.set()
+            metrics = runner.run('trap "" TERM; sleep 10', stop=stop, allow_fail=True)
+            self.assertEqual('stopped', metrics['status'])
+        finally:
+            runner.kill_grace_seconds = old_grace
+
+        # killed, even though the exit code is 0
+        metrics = runner.run('trap "exit 0" TERM; sleep 10 & wait', timeout=0.5, allow_fail=True)
+        self.assertEqual(0, metrics['returncode'])
+        self.assertEqual('timeout', metrics['status'])
+
+
+    def test_report(self):
+        '''test run with a Report'''
+        log_dir = os.path.join(self.tmp_dir, 'logs')
+        report = runner.Report(log_dir=log_dir, timeout=0.5)
+        self.assertIsNone(runner.set_report(report))
+        runner.run('echo hello', name='hello world')
+        runner.run('sleep 10', allow_fail=True)
+        self.assertEqual(report, runner.get_report())
+
+        self.assertEqual(['0001.hello_world.log', '0002.sleep.log'], sorted(os.listdir(log_dir)))
+        with open(os.path.join(log_dir, '0001.hello_world.log')) as f:
+            self.assertEqual('hello\n', f.read())
+
+        summary = report.summary()
+        self.assertEqual(2, summary['processes'])
+        self.assertEqual(1, summary['failed'])
+        self.assertEqual(['ok', 'timeout'], [x['status'] for x in report.processes])
+
+        json_file = os.path.join(self.tmp_dir, 'report.json')
+        report.write_json(json_file)
+        with open(json_file) as f:
+            got = json.load(f)
+        self.assertEqual(summary, got['summary'])
+        self.assertEqual(['hello world', 'sleep'], [x['name'] for x in got['processes']])
+
+        # a new report in the same directory carries on the numbering
+        runner.set_report(runner.Report(log_dir=log_dir))
+        runner.run('true')
+        self.assertTrue(os.path.exists(os.path.join(log_dir, '0003.true.log')))
+
+
+    def test_labels(self):
+        '''test label and timed'''
+        report = runner.Report()
+        runner.set_report(report)
+        self.assertEqual((), runner.get_labels())
+        with runner.label('a'):
+            with runner.label('b'):
+                self.assertEqual(('a', 'b'), runner.get_labels())
+                runner.run('true')
+            with runner.timed('sleep'):
+                time.sleep(0.1)
+        runner.run('true')
+
+        self.assertEqual([['a', 'b'], ['a'], []], [x['labels'] for x in report.processes])
+        self.assertEqual(2, len(report.get_processes(labels=('a',))))
+        self.assertEqual(1, len(report.get_processes(labels=('a', 'b'))))
+        self.assertEqual(3, len(report.get_processes()))
+        self.assertGreaterEqual(report.processes[1]['wall_seconds'], 0.1)
+        self.assertEqual('ok', report.processes[1]['status'])
@@ -1,9 +1,7 @@
 import sys
-import openpyxl
-import pyfastaq
-import pymummer
-import pysam
-from circlator import external_progs, __version__
+import importlib.util
+from importlib import metadata
+from circlator import external_progs
 from circlator import __version__ as circlator_version
 
 
@@ -21,10 +19,12 @@ def get_all_versions(filehandle, raise_error=True, debug=False, assembler=None):
 
     found_bad_module = False
 
+    # Get the versions and paths without importing the modules, because
+    # importing them is slow
     for module in ['openpyxl', 'pyfastaq', 'pymummer', 'pysam']:
         try:
-            version = eval(module + '.__version__')
-            path = eval(module + '.__file__')
+            version = metadata.version(module)
+            path = importlib.util.find_spec(module).origin
         except:
             version = 'NOT_FOUND'
             path = 'NOT_FOUND'